@@ -0,0 +1,55 @@
+'''
+Time of classifying wide and nested structs with the single-pass x86-64
+classifier versus the recursive one creating a classifier per field.
+
+    python benchmarks/bench_classify.py [repeat]
+
+Structs over two eightbytes are settled by their first field, so a struct
+walked to the end is at most 16 bytes: the 1024-field struct is mostly
+empty-struct members.
+'''
+from __future__ import print_function
+import sys
+import time
+from llcc.target import TargetInfo
+from llcc.abi import X86_64Classifier
+from llcc.tests.reference import RecursiveClassifier
+
+
+def make_structs(ti):
+    ts = ti.typesystem
+    empty = ts.get_unnamed_struct([])
+    flags = ts.get_unnamed_struct([('f%d' % i, ts.get_uint(8), 1)
+                                   for i in range(128)])
+    wide = ts.get_unnamed_struct([('e%d' % i, empty) for i in range(1023)] +
+                                 [('x', ts.get_double())])
+    pair = ts.get_unnamed_struct([ts.get_char(), ts.get_char()])
+    nested = ts.get_unnamed_struct([ts.get_array(
+                                    ts.get_unnamed_struct([ts.get_array(
+                                        pair, 4)]), 2)])
+    return [('128 bit-fields', flags),
+            ('1024 fields', wide),
+            ('nested arrays', nested)]
+
+
+def timeit(cls, ti, ty, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        classifier = cls(ti, ty, 0)
+        classifier.classify()
+    return (time.time() - start) / repeat * 1e6
+
+
+def main(argv):
+    repeat = int(argv[0]) if argv else 1000
+    ti = TargetInfo.get_host_target()
+    for name, ty in make_structs(ti):
+        ty = ty.type
+        single = timeit(X86_64Classifier, ti, ty, repeat)
+        recursive = timeit(RecursiveClassifier, ti, ty, repeat)
+        print('%-15s single pass %8.1f us   recursive %8.1f us' % (
+              name, single, recursive))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
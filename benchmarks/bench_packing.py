@@ -0,0 +1,58 @@
+'''
+Throughput of packing argument buffers with a precompiled ArgPacker versus
+walking the types on every call.
+
+    python benchmarks/bench_packing.py [calls]
+'''
+from __future__ import print_function
+import sys
+import time
+import struct
+from llcc.target import TargetInfo
+from llcc.packing import get_packer, type_format
+
+
+def make_signature(ti):
+    ts = ti.typesystem
+    fty = ts.get_float()
+    pair = ts.get_unnamed_struct([fty, fty])
+    args = [ts.get_char(), ts.get_int(), ts.get_double(), pair,
+            ts.get_pointer(ts.get_int())]
+    return ts.get_function(ts.get_void(), args)
+
+
+def naive_pack(ti, fnty, args):
+    # re-derive the formats of every argument for each call
+    buf = []
+    for argty, value in zip(fnty.type.args, args):
+        fmt = '=' + type_format(argty, ti)
+        if argty.type.is_aggregate:
+            buf.append(struct.pack(fmt, *value))
+        else:
+            buf.append(struct.pack(fmt, value))
+    return b''.join(buf)
+
+
+def timeit(fn, calls):
+    start = time.time()
+    for _ in range(calls):
+        fn()
+    return calls / (time.time() - start)
+
+
+def main(argv):
+    calls = int(argv[0]) if argv else 100000
+    ti = TargetInfo.get_host_target()
+    fnty = make_signature(ti)
+    args = (1, 2, 3.0, (4.0, 5.0), 0x1000)
+
+    packer = get_packer(ti, fnty)
+    print('precompiled: %10.0f calls/s' % timeit(lambda: packer.pack(*args),
+                                                 calls))
+    print('type walk:   %10.0f calls/s' % timeit(lambda: naive_pack(ti, fnty,
+                                                                    args),
+                                                 calls))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,62 @@
+'''
+Throughput of ABI queries against a frozen TargetInfo shared by a pool of
+reader threads.
+
+    python benchmarks/bench_threads.py [seconds-per-run]
+
+Readers take no locks, so throughput is bounded only by the interpreter:
+with the GIL expect roughly flat totals, on a free-threaded build it should
+scale with the thread count.
+'''
+from __future__ import print_function
+import sys
+import time
+import threading
+from llcc.target import TargetInfo
+
+
+def make_target():
+    ti = TargetInfo.get_host_target()
+    ts = ti.typesystem
+    fty = ts.get_float()
+    sigs = []
+    for i in range(1, 5):
+        st = ts.get_struct('rec%d' % i, [fty] * i)
+        sigs.append(ts.get_function(ts.get_void(), [ts.get_int(), st]))
+    ti.freeze()
+    return ti, sigs
+
+
+def run(ti, sigs, nthreads, duration):
+    counts = [0] * nthreads
+    stop = threading.Event()
+
+    def worker(idx):
+        n = 0
+        while not stop.is_set():
+            for fnty in sigs:
+                ti.compute_abi_info(fnty)
+            n += len(sigs)
+        counts[idx] = n
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(nthreads)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / duration
+
+
+def main(argv):
+    duration = float(argv[0]) if argv else 1.0
+    ti, sigs = make_target()
+    for nthreads in (1, 2, 4, 8):
+        rate = run(ti, sigs, nthreads, duration)
+        print('%2d threads: %10.0f signatures/s' % (nthreads, rate))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -7,9 +7,68 @@ Reference to
     See X86_32ABIInfo, computeInfo, classifyArgumentType
 '''
 from __future__ import print_function
-from llcc import support
+import sys
+import time
+import threading
+import itertools
+import contextlib
+from collections import namedtuple
+from llcc import adt, support
 import llcc.typesystem
 
+#-------------------------------------------------------------------------------
+# Tracing
+#-------------------------------------------------------------------------------
+
+class _TraceState(threading.local):
+    # The Tracer installed in this thread or None.  Classification code
+    # checks it before building any trace message so tracing costs nothing
+    # when disabled.
+    tracer = None
+
+_tracing = _TraceState()
+
+class Tracer(object):
+    '''Records the decisions made while computing ABI info.
+
+    Events are ``(depth, kind, message)`` tuples; depth follows nested
+    aggregate classification.
+    '''
+    def __init__(self):
+        self.events = []
+        self.depth = 0
+
+    def event(self, kind, fmt, *args):
+        self.events.append((self.depth, kind, fmt % args))
+
+    def enter(self):
+        self.depth += 1
+
+    def leave(self):
+        self.depth -= 1
+
+    def __str__(self):
+        return '\n'.join('%s%-9s %s' % ('  ' * depth, kind, msg)
+                         for depth, kind, msg in self.events)
+
+@contextlib.contextmanager
+def trace(tracer=None):
+    '''Install a Tracer for the duration of a with-block:
+
+        with trace() as tracer:
+            target.compute_abi_info(fnty)
+        print(tracer)
+
+    Only the calling thread is traced; other threads classifying on a
+    shared target are not recorded.
+    '''
+    previous = _tracing.tracer
+    _tracing.tracer = tracer if tracer is not None else Tracer()
+    try:
+        yield _tracing.tracer
+    finally:
+        _tracing.tracer = previous
+
 #-------------------------------------------------------------------------------
 # ABI conventions
 #-------------------------------------------------------------------------------
@@ -67,27 +126,52 @@ class IgnoreArgInfo(ArgInfo):
 class IndirectArgInfo(ArgInfo):
     is_indirect = True
 
-    def __init__(self, align=1, byval=False, realign=False):
+    def __init__(self, align=1, byval=False, realign=False, elide_copy=False):
         self.align = align
         self.byval = byval
         self.realign = realign
+        # the caller's object is passed by reference, without a copy
+        self.elide_copy = elide_copy
+
+    def describe(self):
+        out = 'align=%s byval=%s' % (self.align, self.byval)
+        if self.elide_copy:
+            out += ' elide_copy'
+        return out
 
 class ExpandArgInfo(ArgInfo):
+    '''The aggregate is passed as one argument per scalar leaf.
+    `leaves` are ``(byte offset, type)`` pairs.
+    '''
     is_expand = True
 
+    def __init__(self, leaves):
+        self.leaves = tuple(leaves)
+
+    def describe(self):
+        return 'leaves=%s' % ', '.join('%s@%d' % (ty, off)
+                                       for off, ty in self.leaves)
+
 #-------------------------------------------------------------------------------
 # ABI Info
 #-------------------------------------------------------------------------------
 
+ABIResult = namedtuple('ABIResult', ['return_info', 'arg_infos', 'call_plan'])
+
 class ABIInfo(object):
+    call_plan = None
+
     @staticmethod
     def get_class(abiname):
         '''Returns a ABIInfo subclass
         '''
         return ABI_INFOS[abiname]
 
-    def __init__(self, target):
+    def __init__(self, target, internal=False):
         self.target = target
+        # Internal functions are only called from code we generate, so
+        # they may use a cheaper convention than the platform ABI.
+        self.internal = internal
 
     def compute_info(self, fnty):
         self.return_info = self.classify_return_type(fnty.return_type)
@@ -102,21 +186,279 @@ class ABIInfo(object):
     def classify_argument_type(self, argty):
         raise NotImplementedError
 
+    def elide_indirect_copy(self, argty, info):
+        '''For internal functions: an aggregate that the ABI copies to
+        memory is passed as a pointer to the caller's object if the
+        parameter is const, since the callee cannot modify it.  Returns the
+        ArgInfo to use.
+        '''
+        if (self.internal and info.is_indirect and
+                llcc.typesystem.Qualifiers.CONST in argty.qualifiers):
+            return IndirectArgInfo(align=info.align, elide_copy=True)
+        return info
+
+    def get_expansion(self, ty, max_leaves):
+        '''Returns the ``(byte offset, type)`` leaves of a struct that can
+        be passed as separate scalar arguments, or None.  Leaves must be
+        naturally aligned integers, pointers, floats or doubles (no x87,
+        vectors or bytes shared by bit-fields).
+        '''
+        if not ty.is_struct:
+            return None
+        index = self.target.get_leaf_index(ty)
+        if not 0 < len(index) <= max_leaves:
+            return None
+        leaves = []
+        for start, end, leaf in zip(index.starts, index.ends, index.types):
+            if not (leaf.is_pointer or leaf.is_scalar):
+                return None
+            size = self.target.get_sizeof(leaf) // 8
+            if (end - start != size or size > 8 or
+                    start % (self.target.get_align(leaf) // 8)):
+                return None
+            leaves.append((start, leaf))
+        return tuple(leaves)
+
+    def compact(self):
+        '''Returns the result as an immutable ABIResult, dropping the
+        reference to the target and any classification state.
+        '''
+        return ABIResult(self.return_info, tuple(self.arg_infos),
+                         self.call_plan)
+
     def __str__(self):
         buf = ['ArgInfo %s {' % type(self).__name__]
         buf.append('    return %s' % (self.return_info,)    )
         buf.append('    args:')
         for idx, arg in enumerate(self.arg_infos):
             buf.append('    %4d: %s' % (idx, arg))
+        if self.call_plan is not None:
+            buf.append('    plan:')
+            for line in str(self.call_plan).splitlines():
+                buf.append('    %s' % line)
         buf.append('}')
         return '\n'.join(buf)
 
+#-------------------------------------------------------------------------------
+# Call Plan
+#-------------------------------------------------------------------------------
+
+LOC_GPR = 0     # general purpose register
+LOC_SSE = 1     # vector register
+LOC_STACK = 2   # stack argument area
+LOC_RET_GPR = 3 # general purpose return register
+LOC_RET_SSE = 4 # vector return register
+LOC_X87 = 5     # x87 register stack
+
+SRET_ARG = -1   # argument index of the hidden struct-return pointer
+RETURN_ARG = -2 # argument index of the return value
+
+class CallPlan(object):
+    '''Location of every part of every argument of a call.
+
+    A part is a register-sized piece of an argument (or the whole argument
+    if it goes on the stack).  An argument passed by reference without a
+    copy, like the sret pointer, has a single pointer-sized part.  Parts are
+    stored column-wise in tuples:
+
+    - arg: index of the C argument, SRET_ARG or RETURN_ARG
+    - offset: byte offset of the part inside the argument
+    - kind: one of the LOC_* constants
+    - loc: register number, or byte offset in the stack argument area
+    - size: byte size of the part
+    - align: byte alignment of a stack part (0 for register parts)
+
+    A plan is immutable once built, columns included, so memoized plans
+    can be shared between callers and threads; consumers can index it
+    directly instead of re-deriving register assignment for every call site.
+    '''
+    __slots__ = ('arg', 'offset', 'kind', 'loc', 'size', 'align',
+                 'stack_size', 'reg_names')
+
+    def __init__(self, reg_names, stack_size, parts):
+        setattr_ = super(CallPlan, self).__setattr__
+        columns = list(zip(*parts)) or [()] * 6
+        for name, column in zip(self.__slots__, columns):
+            setattr_(name, tuple(column))
+        setattr_('stack_size', stack_size)
+        setattr_('reg_names', reg_names)
+
+    def __setattr__(self, k, v):
+        raise TypeError("CallPlan is immutable")
+
+    def __len__(self):
+        return len(self.arg)
+
+    def parts_of(self, arg):
+        '''Returns the part indices of an argument, in order.
+        '''
+        return [i for i, a in enumerate(self.arg) if a == arg]
+
+    def location(self, part):
+        '''Returns a human-readable location of a part.
+        '''
+        kind = self.kind[part]
+        if kind == LOC_STACK:
+            return 'stack+%d' % self.loc[part]
+        name = self.reg_names[kind][self.loc[part]]
+        if name.startswith('xmm') and self.size[part] > 16:
+            # AVX vectors use the wider alias of the register
+            name = name.replace('xmm', 'ymm' if self.size[part] <= 32
+                                       else 'zmm')
+        return name
+
+    def __str__(self):
+        buf = []
+        for i in range(len(self)):
+            arg = self.arg[i]
+            if arg == SRET_ARG:
+                argname = 'sret'
+            elif arg == RETURN_ARG:
+                argname = 'ret'
+            else:
+                argname = '%d' % arg
+            buf.append('%4s+%d: %s (%d bytes, align %d)' % (argname,
+                                                          self.offset[i],
+                                                          self.location(i),
+                                                          self.size[i],
+                                                          self.align[i]))
+        return '\n'.join(buf)
+
 #------------------------------------------------------------------------------
 # X86-32 ABI Info
 #------------------------------------------------------------------------------
 
 class X86_32ABIInfo(ABIInfo):
+    '''i386 System V ABI: every argument goes on the stack, except the
+    first three 128-bit vectors which get xmm registers.  Small structs
+    whose stack image is a sequence of 4 and 8 byte scalars are expanded
+    into those scalars.
+
+    Corresponds to clang X86_32ABIInfo on Linux (no regparm)
+    '''
     MIN_ABI_STACK_ALIGN = 4    # bytes
+    MAX_EXPAND_SIZE = 16       # bytes
+
+    # registers indexed by LOC_* kind
+    REG_NAMES = ((),
+                 ('xmm0', 'xmm1', 'xmm2'),
+                 (),
+                 ('eax', 'edx'),
+                 ('xmm0',),
+                 ('st0',))
+
+    def classify_return_type(self, retty):
+        if isinstance(retty, llcc.typesystem.QualType):
+            retty = retty.type
+        if retty.is_void:
+            return IgnoreArgInfo()
+        size = self.target.get_sizeof(retty) // 8
+        if retty.is_vector:
+            if size == 16:
+                return DirectArgInfo()
+            return IndirectArgInfo(align=self.target.get_align(retty) // 8)
+        elif retty.is_aggregate:
+            if size == 0:
+                return IgnoreArgInfo()
+            if retty.is_complex and size <= 8:
+                # edx:eax
+                return DirectArgInfo(self.target.typesystem.get_uint(
+                                                            size * 8).type)
+            return IndirectArgInfo(align=self.target.get_align(retty) // 8)
+        elif retty.is_scalar and retty.is_integer and retty.is_promotable:
+            return ExtendArgInfo()
+        return DirectArgInfo()
+
+    def classify_argument_type(self, argty):
+        if isinstance(argty, llcc.typesystem.QualType):
+            argty = argty.type
+        if argty.is_vector:
+            if self.target.get_sizeof(argty) <= 128:
+                return DirectArgInfo()
+            return self.get_indirect_result(argty)
+        elif argty.is_aggregate:
+            size = self.target.get_sizeof(argty) // 8
+            if size == 0:
+                return IgnoreArgInfo()
+            if size <= self.MAX_EXPAND_SIZE:
+                leaves = self.get_expansion(argty, size // 4)
+                # the scalars must form the same stack image as the struct
+                if (leaves is not None and
+                        all(self.target.get_sizeof(ty) in (32, 64)
+                            for _, ty in leaves) and
+                        sum(self.target.get_sizeof(ty) // 8
+                            for _, ty in leaves) == size):
+                    return ExpandArgInfo(leaves)
+            return self.get_indirect_result(argty)
+        elif argty.is_scalar and argty.is_integer and argty.is_promotable:
+            return ExtendArgInfo()
+        return DirectArgInfo()
+
+    def get_indirect_result(self, ty):
+        '''Aggregates are copied to the stack, which is only 4-byte
+        aligned; more aligned types are realigned by the callee.
+
+        Corresponds to clang X86_32ABIInfo::getIndirectResult
+        '''
+        align = self.target.get_align(ty) // 8
+        return IndirectArgInfo(align=self.MIN_ABI_STACK_ALIGN, byval=True,
+                               realign=align > self.MIN_ABI_STACK_ALIGN)
+
+    def compute_info(self, fnty):
+        tracer = _tracing.tracer
+        if tracer is not None:
+            tracer.event('function', '%s', fnty)
+        ptrsize = self.target.ptrsize // 8
+        parts = []
+        stack = 0
+
+        def push(arg, offset, size, align=self.MIN_ABI_STACK_ALIGN):
+            stack_ = support.align_to(stack, align)
+            parts.append((arg, offset, LOC_STACK, stack_, size, align))
+            return stack_ + support.align_to(size, self.MIN_ABI_STACK_ALIGN)
+
+        retty = fnty.return_type.type
+        self.return_info = self.classify_return_type(retty)
+        if self.return_info.is_indirect:
+            stack = push(SRET_ARG, 0, ptrsize)
+            parts.append((RETURN_ARG, 0, LOC_RET_GPR, 0, ptrsize, 0))
+        elif not self.return_info.is_ignore:
+            size = self.target.get_sizeof(retty) // 8
+            if retty.is_vector:
+                parts.append((RETURN_ARG, 0, LOC_RET_SSE, 0, size, 0))
+            elif retty.is_scalar and retty.is_float:
+                parts.append((RETURN_ARG, 0, LOC_X87, 0, size, 0))
+            else:
+                # eax, then edx
+                for offset in range(0, size, 4):
+                    parts.append((RETURN_ARG, offset, LOC_RET_GPR,
+                                  offset // 4, min(size - offset, 4), 0))
+
+        self.arg_infos = []
+        freesse = len(self.REG_NAMES[LOC_SSE])
+        for index, qa in enumerate(fnty.args):
+            a = qa.type
+            info = self.elide_indirect_copy(qa, self.classify_argument_type(a))
+            size = self.target.get_sizeof(a) // 8
+            if info.is_ignore:
+                pass
+            elif info.is_indirect and info.elide_copy:
+                stack = push(index, 0, ptrsize)
+            elif info.is_expand:
+                for offset, leaf in info.leaves:
+                    stack = push(index, offset,
+                                 self.target.get_sizeof(leaf) // 8)
+            elif a.is_vector and size == 16 and freesse:
+                regno = len(self.REG_NAMES[LOC_SSE]) - freesse
+                freesse -= 1
+                parts.append((index, 0, LOC_SSE, regno, size, 0))
+            elif a.is_vector:
+                stack = push(index, 0, size, max(size, 4))
+            else:
+                stack = push(index, 0, size)
+            self.arg_infos.append(info)
+
+        self.call_plan = CallPlan(self.REG_NAMES, stack, parts)
 
 
 #------------------------------------------------------------------------------
@@ -125,147 +467,399 @@ class X86_32ABIInfo(ABIInfo):
 
 
 class X86_64ABIClasses(support.Classifier):
+    '''Classes are small integers (`support.ClassCode`) so that merging
+    and post-merging are table lookups.  `names` maps a code to its name.
+    '''
     # initializer in algorithm.  For padding and empty structures and unions.
-    NO_CLASS    = 'no_class'
+    NO_CLASS    = support.ClassCode(0, 'no_class')
     # integers that fits into GP-register
-    INTEGER     = 'integer'
+    INTEGER     = support.ClassCode(1, 'integer')
     # floats, decimals, vectors fit into vector registers
-    SSE         = 'sse'
+    SSE         = support.ClassCode(2, 'sse')
     # upper bytes of vector register; MSB of 128-bits floats/decimal
-    SSEUP       = 'sseup'
+    SSEUP       = support.ClassCode(3, 'sseup')
     # x87 FPU (long double's 64-bit mantissa)
-    X87         = 'x87'
+    X87         = support.ClassCode(4, 'x87')
     # x87 FPU upper register (long double's 16-bit exponent + 48-bit padding)
-    X87UP       = 'x87up'
+    X87UP       = support.ClassCode(5, 'x87up')
     # complex long double
-    COMPLEX_X87 = 'complex_x87'
+    COMPLEX_X87 = support.ClassCode(6, 'complex_x87')
     # stack memory
-    MEMORY      = 'memory'
+    MEMORY      = support.ClassCode(7, 'memory')
 
     classes = NO_CLASS, INTEGER, SSE, SSEUP, X87, X87UP, COMPLEX_X87, MEMORY
+    names = tuple(c.name for c in classes)
     default = NO_CLASS
 
+def _merge_rule(accum, field):
+    '''AMD64 ABI 3.2.3p2 Rule 4.  Used to build the merge table.
+    '''
+    C = X86_64ABIClasses
+    if accum is C.MEMORY or accum is C.COMPLEX_X87:
+        # classification already settled on memory
+        return C.MEMORY
+    if accum is field or field is C.NO_CLASS:
+        return accum
+    if field is C.MEMORY:
+        return field
+    if accum is C.NO_CLASS:
+        return field
+    if accum is C.INTEGER or field is C.INTEGER:
+        return C.INTEGER
+    if (field is C.X87 or field is C.X87UP or field is C.COMPLEX_X87 or
+            accum is C.X87 or accum is C.X87UP):
+        return C.MEMORY
+    return C.SSE
+
+def _postmerge_rule(lo, hi, big, honors_rev_0_98):
+    '''AMD64 ABI 3.2.3p2 Rule 5.  Used to build the postmerge table.
+    `big` is true for aggregates larger than two eightbytes.
+
+    Returns ``(lo, hi, rules)`` where `rules` names the sub-rules (5a to
+    5d) that applied.
+    '''
+    C = X86_64ABIClasses
+    rules = []
+    if hi is C.MEMORY:
+        lo = C.MEMORY
+        rules.append('5a')
+    if hi is C.X87UP and lo is not C.X87 and honors_rev_0_98:
+        lo = C.MEMORY
+        rules.append('5b')
+    if big and (lo is not C.SSE or hi is not C.SSEUP):
+        lo = C.MEMORY
+        rules.append('5c')
+    if hi is C.SSEUP and lo is not C.SSE:
+        hi = C.SSE
+        rules.append('5d')
+    return lo, hi, tuple(rules)
+
+# MERGE_TABLE[accum << 3 | field]
+MERGE_TABLE = tuple(_merge_rule(a, f)
+                    for a in X86_64ABIClasses.classes
+                    for f in X86_64ABIClasses.classes)
+
+# POSTMERGE_TABLES[honorsRevision0_98][big << 6 | lo << 3 | hi] -> (lo, hi)
+POSTMERGE_TABLES = dict((honors, tuple(_postmerge_rule(lo, hi, big, honors)[:2]
+                                       for big in (False, True)
+                                       for lo in X86_64ABIClasses.classes
+                                       for hi in X86_64ABIClasses.classes))
+                        for honors in (False, True))
+
+# POSTMERGE_RULES[honorsRevision0_98][big << 6 | lo << 3 | hi] -> rule ids
+POSTMERGE_RULES = dict((honors, tuple(_postmerge_rule(lo, hi, big, honors)[2]
+                                      for big in (False, True)
+                                      for lo in X86_64ABIClasses.classes
+                                      for hi in X86_64ABIClasses.classes))
+                       for honors in (False, True))
+
+# widest vector passed in one register, in bits, indexed by avx_level
+NATIVE_VECTOR_SIZES = (128, 256, 512)
+
 class X86_64Classifier(object):
+    '''Classes `lo` and `hi` of the eightbytes of a type at a byte offset.
+
+    Aggregates are classified in a single pass over their fields, at the
+    offsets of the cached layout.  Nested aggregates are kept on an
+    explicit stack and scalar fields are classified in place, so no object
+    is created per field.
+    '''
     honorsRevision0_98 = True
 
     def __init__(self, target, ty, offset):
         self.hi = self.lo = X86_64ABIClasses.NO_CLASS
-        self._active_lo = offset < 8
         self.target = target
         self.type = ty
         self.offset = offset
 
-    @property
-    def current(self):
-        if self._active_lo:
-            return self.lo
+    def classify(self):
+        if self.type.is_struct or self.type.is_array:
+            self.lo, self.hi = self.classify_aggregate(self.type, self.offset)
         else:
-            return self.hi
+            self.lo, self.hi = self.classify_leaf(self.type, self.offset)
 
-    @current.setter
-    def current(self, val):
-        if self._active_lo:
-            self.lo = val
-        else:
-            self.hi = val
+    @property
+    def native_vector_size(self):
+        '''Widest vector passed in a single register, in bits.
+        '''
+        return NATIVE_VECTOR_SIZES[self.target.avx_level]
 
-    def classify(self):
-        self.current = X86_64ABIClasses.MEMORY
-        # classify lo
-        if self.type.is_void:
-            self.current = X86_64ABIClasses.NO_CLASS
-        elif self.type.is_scalar:
-            if self.type.is_integer:
-                if self.target.get_sizeof(self.type) > 64:
-                    raise NotImplementedError
-                else:
-                    self.current = X86_64ABIClasses.INTEGER
-            elif self.type.is_float:
-                if self.target.get_sizeof(self.type) > 64:
-                    raise NotImplementedError
-                else:
-                    self.current = X86_64ABIClasses.SSE
-        elif self.type.is_pointer:
-            self.current = X86_64ABIClasses.INTEGER
-        elif self.type.is_struct:
-            sizeof = self.target.get_sizeof(self.type)
-
-            # larger than 4 eightbytes, then MEMORY
-            if sizeof > 4 * 8 * 8:
-                assert self.lo is X86_64ABIClasses.MEMORY
-                return
+    @staticmethod
+    def place(cls, offset):
+        '''Returns (lo, hi) with `cls` in the eightbyte of byte `offset`.
+        '''
+        if offset < 8:
+            return cls, X86_64ABIClasses.NO_CLASS
+        return X86_64ABIClasses.NO_CLASS, cls
 
-            self.current = X86_64ABIClasses.NO_CLASS
+    def classify_leaf(self, ty, offset):
+        '''Returns the (lo, hi) classes of a type other than a struct or an
+        array at byte `offset`.
+        '''
+        C = X86_64ABIClasses
+        cls = C.MEMORY
+        if ty.is_void:
+            cls = C.NO_CLASS
+        elif ty.is_scalar:
+            if ty.is_integer:
+                if self.target.get_sizeof(ty) > 64:
+                    raise NotImplementedError
+                cls = C.INTEGER
+            elif ty.is_float:
+                if self.target.get_sizeof(ty) > 64:
+                    # x87 long double
+                    return C.X87, C.X87UP
+                cls = C.SSE
+        elif ty.is_pointer:
+            cls = C.INTEGER
+        elif ty.is_vector:
+            return self.classify_vector(ty, offset)
+        elif ty.is_complex:
+            return self.classify_complex(ty, offset)
+        return self.place(cls, offset)
+
+    def get_shape(self, ty):
+        '''Returns the (sizeof, align, layout) of a field type; the layout
+        is None except for structs.
+        '''
+        if ty.is_struct:
+            layout = self.target.get_layout(ty)
+            return layout.size, layout.align, layout
+        return self.target.get_sizeof(ty), self.target.get_align(ty), None
+
+    def iter_fields(self, ty, layout=None):
+        '''Returns an iterator of ``(name, bit offset, bit-field width,
+        type)`` over the fields of a struct or the elements of an array.
+        Names and widths of array elements are None.
+        '''
+        if ty.is_struct:
+            if layout is None:
+                layout = self.target.get_layout(ty)
+            return zip(ty.fieldnames(), layout.offsets, layout.widths, ty)
+        elemsize = self.target.get_sizeof(ty.basetype)
+        return zip(itertools.repeat(None), itertools.count(0, elemsize),
+                   itertools.repeat(None),
+                   itertools.repeat(ty.basetype, ty.size))
+
+    def classify_aggregate(self, ty, offset):
+        '''Returns the (lo, hi) classes of a struct or an array at byte
+        `offset`.
+        '''
+        C = X86_64ABIClasses
+        target = self.target
+        native = self.native_vector_size
+        postmerge = POSTMERGE_TABLES[self.honorsRevision0_98]
+        tracer = _tracing.tracer
+
+        sizeof = target.get_sizeof(ty)
+        # larger than 8 eightbytes (an AVX-512 vector), then MEMORY
+        if sizeof > 8 * 8 * 8:
+            return self.place(C.MEMORY, offset)
+        lo = hi = C.NO_CLASS
+        fields = self.iter_fields(ty)
+        # (aggregate, offset, sizeof, lo, hi, fields, field type) of the
+        # enclosing aggregates
+        parents = []
+        # id(type) -> (sizeof, align, layout) of the field types seen
+        shapes = {}
+        while True:
+            descend = False
+            for fieldname, fieldoff, width, fieldty in fields:
+                if width is not None and fieldname in ty.unnamed_bitfields:
+                    # padding
+                    continue
+                fty = fieldty.type
+                if width is None or sizeof > 128:
+                    shape = shapes.get(id(fty))
+                    if shape is None:
+                        shape = shapes[id(fty)] = self.get_shape(fty)
+                    fldsize, fldalign, fldlayout = shape
 
-            # classify each field
-            for fieldname, fieldty in self.type.fields():
                 # Rule 5c
                 #    If the size of the aggregate exceeds two eightbytes
                 #   and the first eight-byte isn't SSE or any other eightbyte
                 #   isn't SSEUP, the whole argument is passed in memory.
                 #
                 # Clang said that this rule will only apply to a structure
-                # with a single 256-bit element.
-                if sizeof > 128 and self.target.get_sizeof(fieldty) != 256:
-
-                    self.lo = X86_64ABIClasses.MEMORY
-                    return
-
-                fieldty = fieldty.type
-                field_offset = self.type.get_field_offset(name=fieldname,
-                                                   target=self.target)
-
-                classifier = X86_64Classifier(self.target, fieldty,
-                                              offset=field_offset)
-                classifier.classify()
-                fldhi, fldlo = classifier.hi, classifier.lo
-
-                self.lo = self.merge(self.lo, fldlo)
-                self.hi = self.merge(self.hi, fldhi)
-
-                if self.lo is self.hi is X86_64ABIClasses.MEMORY:
-                    break;
-
-            self.postmerge(sizeof)
-
-    def postmerge(self, sizeof):
-        if self.hi is X86_64ABIClasses.MEMORY:
-            self.lo = X86_64ABIClasses.MEMORY
-        if (self.hi is X86_64ABIClasses.X87UP and
-                self.lo is not X86_64ABIClasses.X87 and
-                self.honorsRevision0_98):
-            self.lo = X86_64ABIClasses.MEMORY
-        if sizeof > 128 and (self.lo is not X86_64ABIClasses.SSE and
-                             self.hi is not X86_64ABIClasses.SSEUP):
-            self.lo = X86_64ABIClasses.MEMORY
-        if (self.hi is X86_64ABIClasses.SSEUP and
-                self.lo is not X86_64ABIClasses.SSE):
-            self.hi = X86_64ABIClasses.SSE
+                # with a single vector element no wider than the native
+                # vector size.  Post-merging still applies (SSEUP without
+                # SSE becomes SSE), as in clang.
+                if sizeof > 128 and (fldsize != sizeof or sizeof > native):
+                    lo = C.MEMORY
+                    if tracer is not None:
+                        tracer.event('memory', '%s: %d bits but field %s is '
+                                     'not a native vector (rule 5c)',
+                                     ty, sizeof, fieldty)
+                    break
+
+                if width is not None:
+                    fldlo, fldhi = self.classify_bitfield(offset * 8 +
+                                                          fieldoff, width)
+                    if tracer is not None:
+                        tracer.event('field', '%s : %d at bit %d: %s/%s',
+                                     fieldty, width, offset * 8 + fieldoff,
+                                     fldlo, fldhi)
+                else:
+                    fldoff = offset + fieldoff // 8
+                    # Unaligned fields of packed structs are passed in memory
+                    if (offset * 8 + fieldoff) % fldalign:
+                        lo = C.MEMORY
+                        if tracer is not None:
+                            tracer.event('memory', '%s: field %s at byte %d '
+                                         'is unaligned', ty, fieldty, fldoff)
+                        break
+
+                    if fty.is_struct or fty.is_array:
+                        if fldsize <= 8 * 8 * 8:
+                            # continue with the fields of the nested
+                            # aggregate; merged into this one when done
+                            parents.append((ty, offset, sizeof, lo, hi,
+                                            fields, fieldty))
+                            ty, offset, sizeof = fty, fldoff, fldsize
+                            lo = hi = C.NO_CLASS
+                            fields = self.iter_fields(fty, fldlayout)
+                            descend = True
+                            if tracer is not None:
+                                tracer.enter()
+                            break
+                        fldlo, fldhi = self.place(C.MEMORY, fldoff)
+                    else:
+                        fldlo, fldhi = self.classify_leaf(fty, fldoff)
+                    if tracer is not None:
+                        tracer.event('field', '%s at byte %d: %s/%s',
+                                     fieldty, fldoff, fldlo, fldhi)
+
+                if tracer is not None:
+                    tracer.event('merge', '%s/%s + %s/%s -> %s/%s',
+                                 lo, hi, fldlo, fldhi,
+                                 MERGE_TABLE[lo << 3 | fldlo],
+                                 MERGE_TABLE[hi << 3 | fldhi])
+                lo = MERGE_TABLE[lo << 3 | fldlo]
+                hi = MERGE_TABLE[hi << 3 | fldhi]
+                if lo is C.MEMORY or hi is C.MEMORY:
+                    break
+
+            if descend:
+                continue
+            key = (sizeof > 128) << 6 | lo << 3 | hi
+            if tracer is not None:
+                rules = POSTMERGE_RULES[self.honorsRevision0_98][key]
+                if rules:
+                    tracer.event('postmerge', '%s/%s -> %s/%s by rule %s',
+                                 lo, hi, postmerge[key][0],
+                                 postmerge[key][1], ', '.join(rules))
+            lo, hi = postmerge[key]
+            if not parents:
+                return lo, hi
+
+            # merge the nested aggregate into its parent
+            fldlo, fldhi, fldoff = lo, hi, offset
+            ty, offset, sizeof, lo, hi, fields, fieldty = parents.pop()
+            if tracer is not None:
+                tracer.leave()
+                tracer.event('field', '%s at byte %d: %s/%s',
+                             fieldty, fldoff, fldlo, fldhi)
+                tracer.event('merge', '%s/%s + %s/%s -> %s/%s',
+                             lo, hi, fldlo, fldhi,
+                             MERGE_TABLE[lo << 3 | fldlo],
+                             MERGE_TABLE[hi << 3 | fldhi])
+            lo = MERGE_TABLE[lo << 3 | fldlo]
+            hi = MERGE_TABLE[hi << 3 | fldhi]
+            if lo is C.MEMORY or hi is C.MEMORY:
+                # skip the remaining fields of the parent
+                fields = iter(())
+
+    def classify_vector(self, ty, offset):
+        C = X86_64ABIClasses
+        sizeof = self.target.get_sizeof(ty)
+        elemty = ty.basetype.type
+        cls = C.MEMORY
+        if sizeof == 32:
+            # e.g. <4 x char>
+            cls = C.INTEGER
+        elif sizeof == 64:
+            if len(ty) == 1 and elemty.is_scalar and elemty.is_integer:
+                # <1 x long long> is passed like a long long
+                cls = C.INTEGER
+            else:
+                cls = C.SSE
+            # vector straddling an eightbyte boundary
+            if offset % 8:
+                lo = self.place(cls, offset)[0]
+                return lo, lo
+        elif sizeof == 128 or (sizeof in (256, 512) and
+                               sizeof <= self.native_vector_size):
+            # one (xmm, ymm or zmm) register
+            return C.SSE, C.SSEUP
+        return self.place(cls, offset)
+
+    def classify_bitfield(self, bitoffset, width):
+        '''Returns the (lo, hi) classes of a bit-field at absolute bit
+        offset `bitoffset`: INTEGER in the eightbytes holding its bits.
+        '''
+        C = X86_64ABIClasses
+        if bitoffset // 64:
+            return C.NO_CLASS, C.INTEGER
+        elif (bitoffset + width - 1) // 64:
+            return C.INTEGER, C.INTEGER
+        return C.INTEGER, C.NO_CLASS
+
+    def classify_complex(self, ty, offset):
+        C = X86_64ABIClasses
+        sizeof = self.target.get_sizeof(ty)
+        elemty = ty.basetype.type
+        lo, hi = self.place(C.MEMORY, offset)
+        if elemty.is_integer:
+            if sizeof <= 64:
+                lo, hi = self.place(C.INTEGER, offset)
+            elif sizeof <= 128:
+                lo = hi = C.INTEGER
+        elif self.target.get_sizeof(elemty) == 32:
+            # float _Complex
+            lo, hi = self.place(C.SSE, offset)
+        elif self.target.get_sizeof(elemty) == 64:
+            # double _Complex
+            lo = hi = C.SSE
+        else:
+            # long double _Complex
+            return self.place(C.COMPLEX_X87, offset)
+        # real and imaginary parts in different eightbytes
+        if offset // 8 != (offset + sizeof // 8 - 1) // 8 and sizeof <= 64:
+            hi = lo
+        return lo, hi
 
     def merge(self, accum, field):
-        assert accum is not X86_64ABIClasses.MEMORY
-        assert accum is not X86_64ABIClasses.COMPLEX_X87
-
-        if accum is field or field is X86_64ABIClasses.NO_CLASS:
-            return accum
-        if field is X86_64ABIClasses.MEMORY:
-            return field
-        if accum is X86_64ABIClasses.NO_CLASS:
-            return field
-        if (accum is X86_64ABIClasses.INTEGER or
-                field is X86_64ABIClasses.INTEGER):
-            return X86_64ABIClasses.INTEGER
-        if (field is X86_64ABIClasses.X87 or field is X86_64ABIClasses.X87UP or
-              field is X86_64ABIClasses.COMPLEX_X87 or
-              accum is X86_64ABIClasses.X87 or accum is X86_64ABIClasses.X87UP):
-            return X86_64ABIClasses.MEMORY
-        return X86_64ABIClasses.SSE
+        return MERGE_TABLE[accum << 3 | field]
 
 
 class X86_64Registers(object):
+    '''Registers needed by an argument, with the kind of each eightbyte.
+    '''
     def __init__(self):
         self.need_int = 0
         self.need_sse = 0
+        self.parts = []     # (LOC_GPR, LOC_SSE or LOC_X87, byte offset,
+                            #  byte size)
+
+    def use_int(self, offset, size=8):
+        self.need_int += 1
+        self.parts.append((LOC_GPR, offset, size))
+
+    def use_sse(self, offset, size=8):
+        self.need_sse += 1
+        self.parts.append((LOC_SSE, offset, size))
+
+    def use_x87(self, offset):
+        self.parts.append((LOC_X87, offset, 16))
+
+def get_pair_struct(target, lo, hi):
+    '''Returns the unnamed struct of the eightbyte types `lo` and `hi`.
+    Interned per target, so classifying a stream of signatures does not
+    allocate (and cache the layout of) a new struct per argument.
+    '''
+    return target.get_cache('pairs').get(
+        (lo, hi), lambda key: target.typesystem.get_unnamed_struct(
+                                                    list(key)).type)
 
 class X86_64ABIInfo(ABIInfo):
     '''This ABI is used by most opensource OSes, various *nix flavours
@@ -275,16 +869,114 @@ class X86_64ABIInfo(ABIInfo):
     '''
     MIN_ABI_STACK_ALIGN = 16   # bytes
 
-    def classify_return_type(self, retty):
+    # registers in assignment order, indexed by LOC_* kind
+    REG_NAMES = (('rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9'),
+                 tuple('xmm%d' % i for i in range(8)),
+                 (),
+                 ('rax', 'rdx'),
+                 ('xmm0', 'xmm1'),
+                 ('st0', 'st1'))
+
+    # kind of a return register
+    RETURN_KINDS = {LOC_GPR: LOC_RET_GPR, LOC_SSE: LOC_RET_SSE,
+                    LOC_X87: LOC_X87}
+
+    def classify_return_type(self, retty, reg=None):
+        '''
+        Corresponds to clang X86_64ABIInfo::classifyReturnType
+
+        The return registers used are recorded in `reg`.
+        '''
         if isinstance(retty, llcc.typesystem.QualType):
             retty = retty.type
+        if reg is None:
+            reg = X86_64Registers()
 
         hi, lo = self.classify(retty, offset=0)
 
-        if hi is lo is X86_64ABIClasses.NO_CLASS:
-            return IgnoreArgInfo()
+        assert (not hi is X86_64ABIClasses.MEMORY or
+                lo is X86_64ABIClasses.MEMORY)
+        assert (not hi is X86_64ABIClasses.SSEUP or
+                lo is X86_64ABIClasses.SSE)
+        resty = None
 
-        assert False, 'TODO'
+        # Lo class
+        if lo is X86_64ABIClasses.NO_CLASS:
+            if hi is X86_64ABIClasses.NO_CLASS:
+                return IgnoreArgInfo()
+        elif lo in (X86_64ABIClasses.SSEUP, X86_64ABIClasses.X87UP):
+            raise AssertionError("invalid ABI classification")
+        elif lo is X86_64ABIClasses.MEMORY:
+            return self.get_indirect_return_result(retty)
+        elif lo is X86_64ABIClasses.INTEGER:
+            # rax
+            reg.use_int(0)
+            resty = self.get_integer_type(retty, offset=0)
+            if (hi == X86_64ABIClasses.NO_CLASS and resty.is_scalar and
+                resty.is_integer and resty.is_promotable):
+                return ExtendArgInfo()
+        elif lo is X86_64ABIClasses.SSE:
+            # xmm0
+            if hi is X86_64ABIClasses.SSEUP:
+                reg.use_sse(0, size=self.target.get_sizeof(retty) // 8)
+            else:
+                reg.use_sse(0)
+            resty = self.get_sse_type(retty, offset=0)
+        elif lo is X86_64ABIClasses.X87:
+            # st0
+            reg.use_x87(0)
+            resty = retty
+        elif lo is X86_64ABIClasses.COMPLEX_X87:
+            # st0 and st1
+            reg.use_x87(0)
+            reg.use_x87(16)
+            return DirectArgInfo()
+        else:
+            assert False
+
+        # Hi class
+        highpart = None
+        if hi is X86_64ABIClasses.NO_CLASS:
+            pass
+        elif hi is X86_64ABIClasses.INTEGER:
+            # rax, or rdx after an INTEGER or SSE lo
+            reg.use_int(8)
+            highpart = self.get_integer_type(retty, offset=8)
+            if lo is X86_64ABIClasses.NO_CLASS:
+                return DirectArgInfo(highpart, offset=8)
+        elif hi is X86_64ABIClasses.SSE:
+            reg.use_sse(8)
+            highpart = self.get_sse_type(retty, offset=8)
+            if lo is X86_64ABIClasses.NO_CLASS:
+                return DirectArgInfo(highpart, offset=8)
+        elif hi is X86_64ABIClasses.SSEUP:
+            resty = self.get_byte_vector_type(retty)
+        elif hi is X86_64ABIClasses.X87UP:
+            # the upper half of something that is not a long double goes
+            # in xmm
+            if lo is not X86_64ABIClasses.X87:
+                reg.use_sse(8)
+                highpart = self.get_sse_type(retty, offset=8)
+                if lo is X86_64ABIClasses.NO_CLASS:
+                    return DirectArgInfo(highpart, offset=8)
+        else:
+            assert False
+
+        if highpart is not None:
+            resty = self.get_byval_argument(resty, highpart, target=self.target)
+        return DirectArgInfo(coerce_type=resty)
+
+    def get_indirect_return_result(self, ty):
+        '''Returns of MEMORY class go through a caller-allocated slot whose
+        address is passed as a hidden first argument (sret).
+
+        Corresponds to clang X86_64ABIInfo::getIndirectReturnResult
+        '''
+        if not ty.is_aggregate:
+            if ty.is_scalar and ty.is_integer and ty.is_promotable:
+                return ExtendArgInfo()
+            return DirectArgInfo()
+        return IndirectArgInfo(align=self.target.get_align(ty) // 8)
 
     def classify_argument_type(self, argty, reg):
         if isinstance(argty, llcc.typesystem.QualType):
@@ -295,7 +987,7 @@ class X86_64ABIInfo(ABIInfo):
         assert (not hi is X86_64ABIClasses.MEMORY or
                 lo is X86_64ABIClasses.MEMORY)
         assert (not hi is X86_64ABIClasses.SSEUP or
-                lo is X86_64ABIClasses.MEMORY.SSE)
+                lo is X86_64ABIClasses.SSE)
         restype = None
 
         # Lo class
@@ -303,20 +995,25 @@ class X86_64ABIInfo(ABIInfo):
             if hi is X86_64ABIClasses.NO_CLASS:
                 return IgnoreArgInfo()
         elif lo in (X86_64ABIClasses.X87, X86_64ABIClasses.COMPLEX_X87):
-            assert False, 'TODO'
+            # x87 arguments are passed in memory
+            return self.get_indirect_result(argty)
         elif lo in (X86_64ABIClasses.SSEUP, X86_64ABIClasses.X87UP):
             raise AssertionError("invalid ABI classification")
         elif lo is X86_64ABIClasses.INTEGER:
-            reg.need_int += 1
+            reg.use_int(0)
             resty = self.get_integer_type(argty, offset=0)
             if (hi == X86_64ABIClasses.NO_CLASS and resty.is_scalar and
                 resty.is_integer and resty.is_promotable):
                 return ExtendArgInfo()
         elif lo is X86_64ABIClasses.SSE:
-            reg.need_sse += 1
+            if hi is X86_64ABIClasses.SSEUP:
+                # a whole vector register
+                reg.use_sse(0, size=self.target.get_sizeof(argty) // 8)
+            else:
+                reg.use_sse(0)
             resty = self.get_sse_type(argty, offset=0)
         elif lo is X86_64ABIClasses.MEMORY:
-            return IndirectArgInfo()
+            return self.get_indirect_result(argty)
         else:
             assert False
 
@@ -324,11 +1021,15 @@ class X86_64ABIInfo(ABIInfo):
         highpart = None
         if hi is X86_64ABIClasses.NO_CLASS:
             pass
+        elif hi is X86_64ABIClasses.SSEUP:
+            resty = self.get_byte_vector_type(argty)
         elif hi is X86_64ABIClasses.SSE:
+            reg.use_sse(8)
             highpart = self.get_sse_type(argty, offset=8)
             if lo is X86_64ABIClasses.NO_CLASS:
                 return DirectArgInfo(highpart, offset=8)
         elif hi is X86_64ABIClasses.INTEGER:
+            reg.use_int(8)
             highpart = self.get_integer_type(argty, offset=8)
             if lo is X86_64ABIClasses.NO_CLASS:
                 return DirectArgInfo(highpart, offset=8)
@@ -341,94 +1042,315 @@ class X86_64ABIInfo(ABIInfo):
 
     def classify(self, typ, offset):
         classifier = X86_64Classifier(self.target, typ, offset)
+        tracer = _tracing.tracer
+        if tracer is not None:
+            tracer.event('classify', '%s', typ)
+            tracer.enter()
         classifier.classify()
+        if tracer is not None:
+            tracer.leave()
+            tracer.event('class', '%s: %s/%s', typ, classifier.lo,
+                         classifier.hi)
         return classifier.hi, classifier.lo
 
     def get_byval_argument(self, lo, hi, target):
-        stty = target.typesystem.get_unnamed_struct([lo, hi]).type
+        '''Returns the struct passing `lo` and `hi` in two eightbytes.
+
+        Corresponds to clang GetX86_64ByValArgumentPair
+        '''
+        ts = target.typesystem
+        stty = get_pair_struct(target, lo, hi)
         histart = stty.get_field_offset('__1', target=self.target)
         assert 0 < histart <= 8
         if histart != 8:
-            raise NotImplementedError
+            # widen lo so that hi starts at the second eightbyte; lo is
+            # a float or a small integer here
+            if lo.is_scalar and lo.is_float:
+                lo = ts.get_double()
+            else:
+                lo = ts.get_uint(64)
+            stty = get_pair_struct(target, lo, hi)
         return stty
 
     def get_integer_type(self, ty, offset):
-        '''
+        '''The integer type of the eightbyte of `ty` at byte `offset`.
+
+        A scalar starting at `offset` is used as is if nothing else lives
+        in the rest of the eightbyte; otherwise the eightbyte is passed as
+        an unsigned integer covering the data.
+
         Corresponds to clang X86_64ABIInfo::GetINTEGERTypeAtOffset
         '''
-        if offset == 0:
-            if self.target.ptrsize == 64 and ty.is_pointer:
-                return ty
-            if (ty.is_scalar and ty.is_integer and
-                (ty.bitwidth in (8, 16, 32) or ty.is_pointer)):
-                return ty
-
-        if ty.is_struct:
-            # recurse the the field at offset
-            field = ty.get_field_at_offset(offset, self.target)
-            return self.get_integer_type(ty=field.type, offset=0)
+        if not ty.is_aggregate:
+            index = None
+            leaf = ty if offset == 0 else None
+        else:
+            index = self.target.get_leaf_index(ty)
+            leaf = index.type_at(offset)
+
+        if leaf is not None:
+            if leaf.is_pointer and self.target.ptrsize == 64:
+                return leaf
+            if leaf.is_scalar and leaf.is_integer:
+                if leaf.bitwidth == 64:
+                    return leaf
+                if (leaf.bitwidth in (8, 16, 32) and
+                        (index is None or
+                         index.no_data(offset + leaf.bitwidth // 8,
+                                       offset + 8))):
+                    return leaf
 
-        assert False
         tybytesize = (self.target.get_sizeof(ty) + 7) // 8      # roundup
-        return self.target.typesystem.get_uint(min(tybytesize - offset, 8) * 8)
-
+        bytesize = min(tybytesize - offset, 8)
+        # no odd-sized integers, such as clang's i24; round up
+        bits = 8
+        while bits < bytesize * 8:
+            bits *= 2
+        return self.target.typesystem.get_uint(bits).type
 
     def get_sse_type(self, ty, offset):
-        '''
+        '''The SSE type of the eightbyte of `ty` at byte `offset`.
+
         Note: Float and double are returned on XMM.
               Float at byte offset 0 and 4 of aggregate are passed
               as vector <float x 2>.
+
+        Corresponds to clang X86_64ABIInfo::GetSSETypeAtOffset
         '''
         ts = self.target.typesystem
-        if ty.is_aggregate:
-            offlo = offset
-            offhi = offset + 4
-            float_t = ts.get_float()
-            floatat0 = ty.has_type_at_offset(float_t, offset=offlo,
-                                             target=self.target)
-            floatat4 = ty.has_type_at_offset(float_t, offset=offhi,
-                                             target=self.target)
-            if floatat0 and floatat4:
-                    vecty = ts.get_vector(ts.get_float(), 2)
-                    return vecty
-
-            ty = ty.get_field_at_offset(offset=0, target=self.target).type
-
-        if ty.is_scalar and (ty.is_float or ty.is_double):
+        if not ty.is_aggregate or ty.is_vector:
             return ty
 
-        assert False
+        index = self.target.get_leaf_index(ty)
+        leaf = index.type_at(offset)
+        if leaf is not None and leaf.is_vector:
+            return leaf
+        if index.all_float(offset, offset + 8):
+            if index.no_data(offset + 4, offset + 8):
+                return ts.get_float().type
+            return ts.get_vector(ts.get_float(), 2)
+        return ts.get_double().type
+
+    def get_byte_vector_type(self, ty):
+        '''The vector type of an SSE/SSEUP argument.
+
+        Corresponds to clang X86_64ABIInfo::GetByteVectorType
+        '''
+        # unwrap single element structs
+        while ty.is_struct and len(ty) == 1:
+            ty = next(ty.fieldtypes()).type
+        if ty.is_vector:
+            return ty
+        ts = self.target.typesystem
+        count = self.target.get_sizeof(ty) // 64
+        return ts.get_vector(ts.get_double(), count).type
 
     def compute_info(self, fnty):
-        self.return_info = self.classify_return_type(fnty.return_type)
+        tracer = _tracing.tracer
+        if tracer is not None:
+            tracer.event('function', '%s', fnty)
+            start = time.time()
+
+        retreg = X86_64Registers()
+        self.return_info = self.classify_return_type(fnty.return_type, retreg)
         self.arg_infos = []
-        free_int = 6
-        free_sse = 8
-        for a in fnty.args:
+        parts = []
+        free = [len(names) for names in self.REG_NAMES]
+        stack = 0
+
+        def take(kind, arg, offset, size):
+            regno = len(self.REG_NAMES[kind]) - free[kind]
+            free[kind] -= 1
+            parts.append((arg, offset, kind, regno, size, 0))
+
+        if retreg.parts:
+            retsize = self.target.get_sizeof(fnty.return_type) // 8
+        for kind, offset, partsize in retreg.parts:
+            take(self.RETURN_KINDS[kind], RETURN_ARG, offset,
+                 min(retsize - offset, partsize))
+
+        if self.return_info.is_indirect:
+            # hidden pointer to the return slot is the first argument and
+            # is returned in rax
+            take(LOC_GPR, SRET_ARG, 0, 8)
+            take(LOC_RET_GPR, RETURN_ARG, 0, 8)
+
+        for index, a in enumerate(fnty.args):
             needreg = X86_64Registers()
-            info = self.classify_argument_type(a, needreg)
-            if (free_int >= needreg.need_int
-                    and free_sse >= needreg.need_sse):
-                free_int -= needreg.need_int
-                free_sse -= needreg.need_sse
+            info = None
+            if self.internal:
+                info = self.classify_expanded(a, needreg)
+                if info is not None and (free[LOC_GPR] < needreg.need_int or
+                                         free[LOC_SSE] < needreg.need_sse):
+                    # not worth spilling; use the ABI
+                    info = None
+                    needreg = X86_64Registers()
+            if info is None:
+                info = self.classify_argument_type(a, needreg)
+            if (free[LOC_GPR] >= needreg.need_int
+                    and free[LOC_SSE] >= needreg.need_sse):
+                size = self.target.get_sizeof(a) // 8
+                for kind, offset, partsize in needreg.parts:
+                    take(kind, index, offset, min(size - offset, partsize))
             else:
-                assert info.coerce_type is not None
-                info = self.get_indirect_result(info.coerce_type,
-                                                free_int)
+                if tracer is not None:
+                    tracer.event('exhausted', 'arg %d needs %d gpr + %d sse, '
+                                 '%d + %d left; passed in memory', index,
+                                 needreg.need_int, needreg.need_sse,
+                                 free[LOC_GPR], free[LOC_SSE])
+                info = self.get_indirect_result(a)
+                needreg = X86_64Registers()
+
+            info = self.elide_indirect_copy(a, info)
+            if info.is_indirect and info.elide_copy:
+                # pointer to the caller's object
+                if free[LOC_GPR]:
+                    take(LOC_GPR, index, 0, 8)
+                else:
+                    parts.append((index, 0, LOC_STACK, stack, 8, 8))
+                    stack += 8
+            elif not needreg.parts and not info.is_ignore:
+                # passed in the stack argument area
+                size = self.target.get_sizeof(a) // 8
+                if info.is_indirect:
+                    align = info.align
+                else:
+                    align = max(self.target.get_align(a) // 8, 8)
+                stack = support.align_to(stack, align)
+                parts.append((index, 0, LOC_STACK, stack, size, align))
+                stack += support.align_to(size, 8)
 
             self.arg_infos.append(info)
 
-    def get_indirect_result(self, ty, free_int):
-        if ty.is_scalar:
-            # scalars are passed directly to LLVM
+        self.call_plan = CallPlan(self.REG_NAMES, stack, parts)
+
+        if tracer is not None:
+            tracer.event('time', '%.1f us', (time.time() - start) * 1e6)
+
+    # most leaves of a struct expanded into registers by internal functions
+    MAX_EXPAND_LEAVES = 4
+
+    def classify_expanded(self, argty, reg):
+        '''For internal functions: a small struct is passed as its scalar
+        leaves, each in its own register, instead of being coerced to
+        eightbytes or copied to memory.  LLVM can then keep the fields in
+        registers after inlining.  Returns None if the struct does not
+        qualify.
+        '''
+        if isinstance(argty, llcc.typesystem.QualType):
+            argty = argty.type
+        leaves = self.get_expansion(argty, self.MAX_EXPAND_LEAVES)
+        if leaves is None:
+            return None
+        for offset, leaf in leaves:
+            size = self.target.get_sizeof(leaf) // 8
+            if leaf.is_scalar and leaf.is_float:
+                reg.use_sse(offset, size)
+            else:
+                reg.use_int(offset, size)
+        return ExpandArgInfo(leaves)
+
+    def get_indirect_result(self, ty):
+        '''How to pass an argument that does not get registers.
+
+        Corresponds to clang X86_64ABIInfo::getIndirectResult
+        '''
+        if isinstance(ty, llcc.typesystem.QualType):
+            ty = ty.type
+        if not ty.is_aggregate:
+            # scalars are passed directly to LLVM which puts them on stack
+            if ty.is_scalar and ty.is_integer and ty.is_promotable:
+                return ExtendArgInfo()
             return DirectArgInfo()
         else:
             # aggregates are passed on the stack
-            raise NotImplementedError
             align = max(self.target.get_align(ty) // 8, 8)
-            return IndirectArgInfo(align=align)
+            return IndirectArgInfo(align=align, byval=True)
+
+
+#------------------------------------------------------------------------------
+# Streaming
+#------------------------------------------------------------------------------
+
+def as_function_type(sig, typesystem=None):
+    '''Accepts a CFunctionType, a QualType of one, a
+    ``(return_type, args[, is_vararg])`` tuple or, given a `typesystem`, a
+    signature string such as ``"void(int32_t, float*)"``.
+    '''
+    if isinstance(sig, str) and typesystem is not None:
+        sig = typesystem.parse(sig)
+    if isinstance(sig, llcc.typesystem.QualType):
+        sig = sig.type
+    if isinstance(sig, llcc.typesystem.CFunctionType):
+        return sig
+    if isinstance(sig, (tuple, list)) and len(sig) in (2, 3):
+        return llcc.typesystem.CFunctionType(*sig)
+    raise TypeError("not a function signature: %r" % (sig,))
+
+def iter_abi_info(target, signatures, batch_size=None, cache_size=1024):
+    '''Lazily classify an iterable of signatures.
+
+    Yields one ABIResult per signature, or lists of at most `batch_size`
+    results if batching is requested.  At most one batch of the input is
+    read ahead of the consumer.  Results are memoized by signature
+    fingerprint in a LRU table of `cache_size` entries, so repeated
+    signatures share their result and memory stays bounded however long
+    the stream is.
+    '''
+    cache = adt.LRUDict(cache_size)
+
+    def classify(sig):
+        fnty = as_function_type(sig, target.typesystem)
+        key = fnty.fingerprint
+        try:
+            return cache[key]
+        except KeyError:
+            result = cache[key] = target.compute_abi_info(fnty).compact()
+            return result
+
+    if batch_size is None:
+        for sig in signatures:
+            yield classify(sig)
+    else:
+        sigiter = iter(signatures)
+        while True:
+            batch = [classify(sig)
+                     for sig in itertools.islice(sigiter, batch_size)]
+            if not batch:
+                return
+            yield batch
 
 
 ABI_INFOS = {
-    'SystemV/x86_64': X86_64ABIInfo
+    'SystemV/x86': X86_32ABIInfo,
+    'SystemV/x86_64': X86_64ABIInfo,
 }
+
+#------------------------------------------------------------------------------
+# Command line
+#------------------------------------------------------------------------------
+
+USAGE = '''usage: python -m llcc.abi explain "<signature>"
+
+Prints the ABI classification of a signature for the host target with a
+trace of the decisions, e.g.
+
+    python -m llcc.abi explain "void(int32_t, struct{float;float;double})"
+'''
+
+def main(argv):
+    if len(argv) != 2 or argv[0] != 'explain':
+        print(USAGE, file=sys.stderr)
+        return 2
+    from llcc.target import TargetInfo
+    target = TargetInfo.get_host_target()
+    with trace() as tracer:
+        abi_info = target.compute_abi_info(argv[1])
+    print(tracer)
+    print(abi_info)
+    return 0
+
+if __name__ == '__main__':
+    # run with the imported module so that the tracer it checks is set
+    import llcc.abi
+    sys.exit(llcc.abi.main(sys.argv[1:]))
@@ -1,10 +1,21 @@
+import threading
 from pprint import pformat
-from collections import MutableMapping, MutableSet, Sequence
+from collections import MutableMapping, MutableSet, Sequence, OrderedDict
 
 class AttrDict(MutableMapping):
-    __slots__ = '__kv'
+    __slots__ = '__kv', '__frozen'
     def __init__(self, dic={}):
         self.__kv = dic.copy()
+        object.__setattr__(self, '_AttrDict__frozen', False)
+
+    def freeze(self):
+        '''Disallow any further modification.
+        '''
+        object.__setattr__(self, '_AttrDict__frozen', True)
+
+    @property
+    def is_frozen(self):
+        return self.__frozen
 
     def __getattr__(self, k):
         return self.__kv[k]
@@ -12,18 +23,22 @@ class AttrDict(MutableMapping):
     def __setattr__(self, k, v):
         if k == '_AttrDict__kv':
             return super(AttrDict, self).__setattr__(k, v)
-        self.__kv[k] = v
+        self[k] = v
 
     def __getitem__(self, k):
         return self.__kv[k]
 
     def __setitem__(self, k, v):
+        if self.__frozen:
+            raise TypeError("cannot modify a frozen %s" % type(self).__name__)
         self.__kv[k] = v
 
     def __iter__(self):
         return iter(self.__kv)
 
-    def __delitem__(self):
+    def __delitem__(self, k):
+        if self.__frozen:
+            raise TypeError("cannot modify a frozen %s" % type(self).__name__)
         del self.__kv[k]
 
     def __len__(self):
@@ -32,6 +47,93 @@ class AttrDict(MutableMapping):
     def __repr__(self):
         return pformat(self.__kv)
 
+class ChainAttrDict(AttrDict):
+    '''An AttrDict that falls back to a parent mapping for lookups.
+
+    Insertions and deletions only affect the local mapping, so a child
+    shadows entries of the same key in its parents.
+    '''
+    __slots__ = '__parent'
+    def __init__(self, dic={}, parent=None):
+        super(ChainAttrDict, self).__init__(dic)
+        object.__setattr__(self, '_ChainAttrDict__parent', parent)
+
+    @property
+    def parent(self):
+        return self.__parent
+
+    def new_child(self):
+        return ChainAttrDict(parent=self)
+
+    def is_local(self, k):
+        return k in self._AttrDict__kv
+
+    def __getattr__(self, k):
+        return self[k]
+
+    def __getitem__(self, k):
+        try:
+            return super(ChainAttrDict, self).__getitem__(k)
+        except KeyError:
+            if self.__parent is None:
+                raise
+            return self.__parent[k]
+
+    def __contains__(self, k):
+        return self.is_local(k) or (self.__parent is not None and
+                                    k in self.__parent)
+
+    def __iter__(self):
+        seen = set()
+        scope = self
+        while scope is not None:
+            for k in scope._AttrDict__kv:
+                if k not in seen:
+                    seen.add(k)
+                    yield k
+            scope = scope.parent
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+class LRUDict(MutableMapping):
+    '''A mapping that holds at most `maxsize` entries, evicting the least
+    recently used one.  Safe to share between threads.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.__od = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __getitem__(self, k):
+        with self.__lock:
+            v = self.__od.pop(k)
+            self.__od[k] = v
+            return v
+
+    def __setitem__(self, k, v):
+        with self.__lock:
+            self.__od.pop(k, None)
+            self.__od[k] = v
+            while len(self.__od) > self.maxsize:
+                self.__od.popitem(last=False)
+
+    def __delitem__(self, k):
+        with self.__lock:
+            del self.__od[k]
+
+    def __contains__(self, k):
+        return k in self.__od
+
+    def __iter__(self):
+        return iter(list(self.__od))
+
+    def __len__(self):
+        return len(self.__od)
+
+    def __repr__(self):
+        return pformat(dict(self.__od))
+
 class OrderedAttrs(Sequence):
     __slots__ = '__seq', '__kv'
     def __init__(self, pairs):
@@ -71,7 +173,12 @@ class FlagSet(MutableSet):
 
     def __contains__(self, val):
         i = self.possibilities.index(val)
-        return self.flags[val]
+        return self.flags[i]
+
+    def __hash__(self):
+        # Flags are set up right after construction and then treated as a
+        # value (see QualType), so allow use in hashed containers.
+        return hash(tuple(self.flags))
 
     def __len__(self):
         '''Not very useful for this class.
@@ -1,5 +1,8 @@
 from __future__ import print_function
 import llvm.core
+import llvm.passes
+import llcc.typesystem
+from llcc import support
 
 #-------------------------------------------------------------------------------
 # Value
@@ -11,6 +14,500 @@ class Value(object):
         self.lv = lv
 
 
+#-------------------------------------------------------------------------------
+# ABI Lowering
+#-------------------------------------------------------------------------------
+
+def _strip(ty):
+    if isinstance(ty, llcc.typesystem.QualType):
+        return ty.type
+    return ty
+
+class CallLowering(object):
+    '''LLVM-level signature of a C function type under its ABIInfo.
+
+    Coerced struct types are flattened into one LLVM parameter per element,
+    as clang does, and expanded structs into one per leaf.  `arg_params[i]`
+    is the ``(first, count)`` range of LLVM parameters used by C argument
+    `i`.
+    '''
+    def __init__(self, module, fnty, internal=False):
+        fnty = _strip(fnty)
+        self.module = module
+        self.fnty = fnty
+        self.internal = internal
+        self.abi = module.get_function_abi(fnty, internal)
+        self.params = []
+        self.param_attrs = []       # (param index, attribute)
+        self.param_aligns = []      # (param index, alignment in bytes)
+        self.arg_params = []
+
+        # return
+        retinfo = self.abi.return_info
+        retty = fnty.return_type.type
+        self.has_sret = retinfo.is_indirect
+        if retinfo.is_ignore or retinfo.is_indirect:
+            self.return_type = llvm.core.Type.void()
+        else:
+            self.return_type = module.get_llvm_type(self.coerced_type(retty,
+                                                                      retinfo))
+        if self.has_sret:
+            self.params.append(llvm.core.Type.pointer(
+                                                module.get_llvm_type(retty)))
+            self.param_attrs.append((0, llvm.core.ATTR_STRUCT_RET))
+
+        # arguments
+        for argty, info in zip(fnty.args, self.abi.arg_infos):
+            argty = argty.type
+            first = len(self.params)
+            if info.is_ignore:
+                pass
+            elif info.is_indirect:
+                self.params.append(llvm.core.Type.pointer(
+                                                module.get_llvm_type(argty)))
+                if info.byval:
+                    self.param_attrs.append((first, llvm.core.ATTR_BY_VAL))
+                    # the callee finds the copy at this alignment
+                    self.param_aligns.append((first, info.align))
+                elif info.elide_copy:
+                    self.param_attrs.append((first, llvm.core.ATTR_READONLY))
+            elif info.is_expand:
+                for _, leaf in info.leaves:
+                    self.params.append(module.get_llvm_type(leaf))
+            else:
+                for elem in self.coerced_elements(argty, info):
+                    self.params.append(module.get_llvm_type(elem))
+                if info.is_extend:
+                    if argty.is_signed:
+                        attr = llvm.core.ATTR_SIGN_EXT
+                    else:
+                        attr = llvm.core.ATTR_ZEXT
+                    self.param_attrs.append((first, attr))
+            self.arg_params.append((first, len(self.params) - first))
+
+        self.type = llvm.core.Type.function(self.return_type, self.params,
+                                            fnty.is_vararg)
+
+    def coerced_type(self, ty, info):
+        '''The C type a value is passed as.
+        '''
+        if info.can_have_coerce_to_type and info.coerce_type is not None:
+            return _strip(info.coerce_type)
+        return ty
+
+    def coerced_elements(self, ty, info):
+        coerced = self.coerced_type(ty, info)
+        if coerced is not ty and coerced.is_struct:
+            return [fty.type for fty in coerced]
+        return [coerced]
+
+    def declare(self, name):
+        '''Declares (or gets) a function with this signature.
+        '''
+        fn = self.module.ir.get_or_insert_function(self.type, name)
+        for idx, attr in self.param_attrs:
+            fn.args[idx].add_attribute(attr)
+        for idx, align in self.param_aligns:
+            fn.args[idx].alignment = align
+        return fn
+
+    def define(self, name):
+        '''Adds a function with this signature, to be given a body.
+        Internal functions get internal linkage.
+        '''
+        fn = self.declare(name)
+        if self.internal:
+            fn.linkage = llvm.core.LINKAGE_INTERNAL
+        return fn
+
+    def call(self, builder, callee, args):
+        call = builder.call(callee, args)
+        for idx, attr in self.param_attrs:
+            call.add_parameter_attribute(idx + 1, attr)
+        for idx, align in self.param_aligns:
+            call.set_parameter_alignment(idx + 1, align)
+        return call
+
+    def is_oversized(self, ty, info):
+        '''Whether the coerced image of a `ty` value is larger than `ty`
+        (e.g. a 3-byte struct passed as a 32-bit integer).  Such values go
+        through a temporary slot so that no memory past them is accessed.
+        '''
+        target = self.module.target
+        coerced = self.coerced_type(ty, info)
+        return (coerced is not ty and target.get_sizeof(coerced) +
+                8 * getattr(info, 'offset', 0) > target.get_sizeof(ty))
+
+    def alloca_temps(self, builder):
+        '''Allocates the temporary slots of `load_args` and `store_return`.
+        Returns a slot or None per argument, and one for the return value.
+        Loops allocate them once, in their entry block.
+        '''
+        args = [self.alloca(builder, argty.type, info)
+                if self.is_oversized(argty.type, info) else None
+                for argty, info in zip(self.fnty.args, self.abi.arg_infos)]
+        info = self.abi.return_info
+        retty = self.fnty.return_type.type
+        ret = None
+        if (not (info.is_ignore or info.is_indirect) and
+                self.is_oversized(retty, info)):
+            ret = self.alloca(builder, retty, info)
+        return args, ret
+
+    def load_args(self, builder, ptrs, temps=None):
+        '''Returns the LLVM arguments for C arguments held in memory.
+
+        `ptrs` point to each C argument in its natural type.  `temps` are
+        the argument slots of `alloca_temps`; allocated here if needed
+        otherwise.
+        '''
+        if temps is None:
+            temps = [None] * len(self.fnty.args)
+        out = []
+        for argty, info, ptr, temp in zip(self.fnty.args, self.abi.arg_infos,
+                                          ptrs, temps):
+            argty = argty.type
+            if info.is_ignore:
+                continue
+            elif info.is_indirect:
+                # byval makes LLVM copy the pointee; an elided copy passes
+                # the caller's object itself
+                out.append(ptr)
+                continue
+            elif info.is_expand:
+                for offset, leaf in info.leaves:
+                    out.append(builder.load(self._cast_at(builder, ptr, leaf,
+                                                          offset)))
+                continue
+            coerced = self.coerced_type(argty, info)
+            if coerced is argty:
+                out.append(builder.load(ptr))
+                continue
+            if self.is_oversized(argty, info):
+                # copy to a slot wide enough for the coerced load
+                if temp is None:
+                    temp = self.alloca(builder, argty, info)
+                builder.store(builder.load(ptr), temp)
+                ptr = temp
+            cptr = self._cast_at(builder, ptr, coerced,
+                                 getattr(info, 'offset', 0))
+            if coerced.is_struct:
+                for name in coerced.fieldnames():
+                    out.append(self.module.load_field(builder, cptr, coerced,
+                                                      name))
+            else:
+                out.append(builder.load(cptr))
+        return out
+
+    def store_return(self, builder, value, ptr, temp=None):
+        '''Stores the returned LLVM value to `ptr`, a pointer to the C
+        return type.  Nothing to do for sret calls, which were given `ptr`.
+        `temp` is the return slot of `alloca_temps`; allocated here if
+        needed otherwise.
+        '''
+        info = self.abi.return_info
+        if info.is_ignore or info.is_indirect:
+            return
+        retty = self.fnty.return_type.type
+        coerced = self.coerced_type(retty, info)
+        if coerced is retty:
+            builder.store(value, ptr)
+        elif self.is_oversized(retty, info):
+            # store the coerced image to a slot, then copy the value
+            if temp is None:
+                temp = self.alloca(builder, retty, info)
+            builder.store(value, self._cast_at(builder, temp, coerced,
+                                               getattr(info, 'offset', 0)))
+            builder.store(builder.load(temp), ptr)
+        else:
+            builder.store(value, self._cast_at(builder, ptr, coerced,
+                                               getattr(info, 'offset', 0)))
+
+    def alloca(self, builder, ty, info):
+        '''Returns a pointer to a new stack slot for a value of C type `ty`
+        that is also large enough for the coerced image of the value.
+        '''
+        target = self.module.target
+        slotty = ty
+        if self.is_oversized(ty, info):
+            # whole eightbytes up to the end of the coerced image
+            ts = self.module.typesystem
+            end = (target.get_sizeof(self.coerced_type(ty, info))
+                   // 8 + getattr(info, 'offset', 0))
+            slotty = ts.get_array(ts.get_uint(64), (end + 7) // 8).type
+        ptr = builder.alloca(self.module.get_llvm_type(slotty))
+        # the LLVM type may be less aligned than the C type (aligned(N))
+        ptr.alignment = max(target.get_align(ty),
+                            target.get_align(slotty)) // 8
+        if slotty is not ty:
+            ptr = builder.bitcast(ptr, llvm.core.Type.pointer(
+                                            self.module.get_llvm_type(ty)))
+        return ptr
+
+    def emit_prologue(self, builder, fn):
+        '''Stores the incoming parameters of `fn` to memory and returns a
+        pointer to each C argument in its natural type.  Indirect arguments
+        are used in place; with an elided copy, they are the caller's
+        object and must not be written.
+        '''
+        ptrs = []
+        for argty, info, (first, count) in zip(self.fnty.args,
+                                               self.abi.arg_infos,
+                                               self.arg_params):
+            argty = argty.type
+            params = fn.args[first:first + count]
+            if info.is_indirect:
+                ptrs.append(params[0])
+                continue
+            ptr = self.alloca(builder, argty, info)
+            ptrs.append(ptr)
+            if info.is_ignore:
+                continue
+            elif info.is_expand:
+                for (offset, leaf), param in zip(info.leaves, params):
+                    builder.store(param, self._cast_at(builder, ptr, leaf,
+                                                       offset))
+                continue
+            coerced = self.coerced_type(argty, info)
+            if coerced is argty:
+                builder.store(params[0], ptr)
+                continue
+            cptr = self._cast_at(builder, ptr, coerced,
+                                 getattr(info, 'offset', 0))
+            if coerced.is_struct:
+                for name, param in zip(coerced.fieldnames(), params):
+                    self.module.store_field(builder, param, cptr, coerced,
+                                            name)
+            else:
+                builder.store(params[0], cptr)
+        return ptrs
+
+    def emit_epilogue(self, builder, fn, retptr):
+        '''Returns the C value at `retptr` (None for void functions) from
+        `fn` following the ABI.
+        '''
+        info = self.abi.return_info
+        if retptr is None or info.is_ignore:
+            return builder.ret_void()
+        elif info.is_indirect:
+            # copy to the caller's slot
+            builder.store(builder.load(retptr), fn.args[0])
+            return builder.ret_void()
+        retty = self.fnty.return_type.type
+        coerced = self.coerced_type(retty, info)
+        if coerced is not retty:
+            retptr = self._cast_at(builder, retptr, coerced,
+                                   getattr(info, 'offset', 0))
+        return builder.ret(builder.load(retptr))
+
+    def _cast_at(self, builder, ptr, ty, offset):
+        i8ptr = llvm.core.Type.pointer(llvm.core.Type.int(8))
+        if offset:
+            ptr = builder.bitcast(ptr, i8ptr)
+            ptr = builder.gep(ptr, [self.module.constant_int(offset)])
+        lty = llvm.core.Type.pointer(self.module.get_llvm_type(ty))
+        return builder.bitcast(ptr, lty)
+
+class FunctionBody(object):
+    '''A function being defined by `Module.add_function`.
+
+    `builder` is positioned after the prologue, `args` point to the C
+    arguments in their natural types and `retval` to the slot of the return
+    value (None for void functions).  Store the result to `retval` and call
+    `ret()` to emit the epilogue.
+    '''
+    def __init__(self, lowering, fn):
+        self.lowering = lowering
+        self.function = fn
+        self.builder = llvm.core.Builder.new(fn.append_basic_block('entry'))
+        self.args = lowering.emit_prologue(self.builder, fn)
+        retty = lowering.fnty.return_type.type
+        if retty.is_void:
+            self.retval = None
+        else:
+            self.retval = lowering.alloca(self.builder, retty,
+                                          lowering.abi.return_info)
+
+    def ret(self):
+        return self.lowering.emit_epilogue(self.builder, self.function,
+                                           self.retval)
+
+#-------------------------------------------------------------------------------
+# Struct Lowering
+#-------------------------------------------------------------------------------
+
+class StructLowering(object):
+    '''LLVM identified struct type of a CStructType.
+
+    Elements follow the target layout: gaps become explicit `[n x i8]`
+    padding and the type is packed when LLVM's natural layout would not
+    match.  `elements` maps field names to element indices.  Consecutive
+    bit-fields share one integer (or byte array) element covering their
+    bytes and have no element of their own.
+
+    An incomplete struct stays opaque until `complete` gives it the body
+    of its definition.
+    '''
+    def __init__(self, module, ty):
+        self.ctype = ty
+        tag = ty.name or 'anon.%s' % ty.fingerprint[:8]
+        self.type = llvm.core.Type.opaque('struct.%s' % tag)
+        self.elements = {}
+        self.packed = False
+        self.align = 1          # alignment of the LLVM type, in bytes
+        self.is_complete = False
+        if ty.is_defined:
+            self.complete(module)
+        else:
+            module.llvm_types[ty.fingerprint] = self.type
+            module.struct_lowerings[ty.fingerprint] = self
+            module.opaque_structs[ty.tag] = self
+
+    def complete(self, module):
+        '''Sets the body of the LLVM type from the struct definition.
+        '''
+        ty = self.ctype
+        target = module.target
+        # memoize before lowering fields so that self-references resolve
+        module.llvm_types[ty.fingerprint] = self.type
+        module.struct_lowerings[ty.fingerprint] = self
+
+        layout = target.get_layout(ty)
+        fields = []
+        run = None              # [begin, end) bytes of the current bit-fields
+        for name, fty, off, width in zip(ty.fieldnames(), ty, layout.offsets,
+                                         layout.widths):
+            if width is not None:
+                if width:
+                    end = (off + width + 7) // 8
+                    if run is None:
+                        run = [off // 8, end]
+                    run[1] = end
+                continue
+            if run is not None:
+                fields.append(self._bitfield_storage(*run))
+                run = None
+            fields.append((name, module.get_llvm_type(fty), off // 8,
+                           target.get_sizeof(fty) // 8,
+                           self._llvm_align(module, fty)))
+        if run is not None:
+            fields.append(self._bitfield_storage(*run))
+
+        size = layout.size // 8
+        self.packed = not self._fits_natural(fields, size)
+        elems = []
+        pos = 0
+        maxalign = 1
+        for name, lty, off, fsize, align in fields:
+            start = pos if self.packed else support.align_to(pos, align)
+            if off > start:
+                elems.append(self._padding(off - pos))
+            if name is not None:
+                self.elements[name] = len(elems)
+            elems.append(lty)
+            pos = off + fsize
+            maxalign = max(maxalign, align)
+        if not self.packed:
+            pos = support.align_to(pos, maxalign)
+            self.align = maxalign
+        if size > pos:
+            elems.append(self._padding(size - pos))
+        self.type.set_body(elems, self.packed)
+        self.is_complete = True
+
+    @staticmethod
+    def _llvm_align(module, ty):
+        # alignment LLVM gives the lowered type, which is less than the C
+        # alignment for structs holding bit-fields
+        ty = _strip(ty)
+        if ty.is_struct:
+            return module.get_struct_lowering(ty).align
+        elif ty.is_array:
+            return StructLowering._llvm_align(module, ty.basetype)
+        return module.target.get_align(ty) // 8
+
+    @staticmethod
+    def _bitfield_storage(begin, end):
+        # an integer when naturally aligned, otherwise bytes
+        size = end - begin
+        if size in (1, 2, 4, 8) and begin % size == 0:
+            return None, llvm.core.Type.int(size * 8), begin, size, size
+        return (None, llvm.core.Type.array(llvm.core.Type.int(8), size),
+                begin, size, 1)
+
+    @staticmethod
+    def _fits_natural(fields, size):
+        # Does LLVM's natural layout, with explicit padding where the target
+        # leaves gaps, give the target offsets and size?
+        pos = 0
+        maxalign = 1
+        for name, fty, off, fsize, align in fields:
+            if off % align or off < support.align_to(pos, align):
+                return False
+            pos = off + fsize
+            maxalign = max(maxalign, align)
+        return support.align_to(pos, maxalign) <= size and size % maxalign == 0
+
+    @staticmethod
+    def _padding(count):
+        return llvm.core.Type.array(llvm.core.Type.int(8), count)
+
+#-------------------------------------------------------------------------------
+# Optimization
+#-------------------------------------------------------------------------------
+
+# passes run at each optimization level, in order.  ABI adapters are marked
+# always-inline so inlining them first exposes their allocas and loads to
+# SROA and mem2reg.
+OPT_PASSES = {
+    0: (),
+    1: ('always-inline', 'sroa', 'mem2reg'),
+    2: ('always-inline', 'sroa', 'mem2reg', 'instcombine', 'simplifycfg'),
+}
+
+def run_passes(ir, level):
+    '''Runs the passes of `OPT_PASSES[level]` over an LLVM module.
+    '''
+    if level not in OPT_PASSES:
+        raise ValueError("invalid optimization level %r" % (level,))
+    if OPT_PASSES[level]:
+        pm = llvm.passes.PassManager.new()
+        for name in OPT_PASSES[level]:
+            pm.add(name)
+        pm.run(ir)
+
+def count_instructions(fn):
+    return sum(len(bb.instructions) for bb in fn.basic_blocks)
+
+class OptimizationReport(object):
+    '''Instruction counts per function before and after optimization.
+    '''
+    def __init__(self, level, before, after):
+        self.level = level
+        self.before = before        # function name -> count
+        self.after = after
+
+    @property
+    def total_before(self):
+        return sum(self.before.values())
+
+    @property
+    def total_after(self):
+        return sum(self.after.get(name, 0) for name in self.before)
+
+    def __str__(self):
+        buf = ['optimization level %d' % self.level]
+        for name in sorted(self.before):
+            if name in self.after:
+                after = '%d' % self.after[name]
+            else:
+                after = 'removed'
+            buf.append('    %-30s %6d -> %s' % (name, self.before[name],
+                                                after))
+        buf.append('    %-30s %6d -> %d' % ('total', self.total_before,
+                                            self.total_after))
+        return '\n'.join(buf)
+
 #-------------------------------------------------------------------------------
 # Module
 #-------------------------------------------------------------------------------
@@ -19,19 +516,273 @@ class Module(object):
     def __init__(self, target, name=''):
         self.target = target
         self.ir = llvm.core.Module.new(name)
+        self.function_abis = {}
+        self.lowerings = {}
+        self.llvm_types = {}            # fingerprint -> llvm.core.Type
+        self.struct_lowerings = {}      # fingerprint -> StructLowering
+        self.opaque_structs = {}        # tag -> StructLowering of an
+                                        # incomplete struct
 
     @property
     def typesystem(self):
         return self.target.typesystem
 
-    @property
-    def abi(self):
-        return self.abi_info
-
-    def add_function(self, fnty, name):
-        fnabi = self.abi.get_function_abi(fnty)
-        print(fnabi)
-        raise NotImplementedError
-#        self.ir.add_function()
-#        fv = Value(fnty, )
-#        return fv
+    def get_function_abi(self, fnty, internal=False):
+        '''Returns the ABIInfo of a function type, under the convention of
+        internal functions if `internal`.
+
+        Computed once per signature in this module; callers read the
+        register and stack assignment from its `call_plan`.
+        '''
+        if isinstance(fnty, llcc.typesystem.QualType):
+            fnty = fnty.type
+        key = fnty.fingerprint, internal
+        try:
+            return self.function_abis[key]
+        except KeyError:
+            fnabi = self.target.compute_abi_info(fnty, internal=internal)
+            self.function_abis[key] = fnabi
+            return fnabi
+
+    def get_call_lowering(self, fnty, internal=False):
+        '''Returns the CallLowering of a function type.
+        '''
+        fnty = _strip(fnty)
+        key = fnty.fingerprint, internal
+        try:
+            return self.lowerings[key]
+        except KeyError:
+            lowering = CallLowering(self, fnty, internal)
+            self.lowerings[key] = lowering
+            return lowering
+
+    def get_llvm_type(self, ty):
+        '''Returns the LLVM type of a C type in memory.
+
+        Memoized per canonical type in this module; structs become
+        identified struct types (see StructLowering).
+        '''
+        ty = _strip(ty)
+        key = ty.fingerprint
+        try:
+            return self.llvm_types[key]
+        except KeyError:
+            if ty.is_struct:
+                return self.get_struct_lowering(ty).type
+            lty = self.llvm_types[key] = self._lower_type(ty)
+            return lty
+
+    def _lower_type(self, ty):
+        lc = llvm.core
+        if ty.is_void:
+            return lc.Type.void()
+        elif ty.is_pointer:
+            pointee = ty.basetype.type
+            if pointee.is_void or pointee.is_function:
+                return lc.Type.pointer(lc.Type.int(8))
+            return lc.Type.pointer(self.get_llvm_type(pointee))
+        elif ty.is_scalar and ty.is_integer:
+            return lc.Type.int(self.target.get_sizeof(ty))
+        elif ty.is_scalar and ty.is_float:
+            size = self.target.get_sizeof(ty)
+            if size == 32:
+                return lc.Type.float()
+            elif size == 64:
+                return lc.Type.double()
+            return lc.Type.x86_fp80()
+        elif ty.is_complex:
+            elem = self.get_llvm_type(ty.basetype)
+            return lc.Type.struct([elem, elem])
+        elif ty.is_vector:
+            return lc.Type.vector(self.get_llvm_type(ty.basetype), ty.size)
+        elif ty.is_array:
+            return lc.Type.array(self.get_llvm_type(ty.basetype), ty.size)
+        raise TypeError("cannot lower %s" % ty)
+
+    def get_struct_lowering(self, ty):
+        ty = _strip(ty)
+        if not ty.is_struct:
+            raise TypeError("not a struct: %s" % ty)
+        try:
+            return self.struct_lowerings[ty.fingerprint]
+        except KeyError:
+            pass
+        if ty.name and ty.is_defined:
+            # lowered as opaque before its definition, e.g. by a pointer;
+            # pointers to the type must see the body
+            lowering = self.opaque_structs.pop(ty.tag, None)
+            if lowering is not None and lowering.ctype is ty:
+                lowering.complete(self)
+                return lowering
+        return StructLowering(self, ty)
+
+    #---------------------------------------------------------------------------
+    # Layout constants
+
+    def sizeof(self, ty):
+        '''Returns the byte size of `ty` as an i64 constant.
+        '''
+        return self.constant_int(self.target.get_sizeof(ty) // 8)
+
+    def alignof(self, ty):
+        '''Returns the byte alignment of `ty` as an i64 constant.
+        '''
+        return self.constant_int(self.target.get_align(ty) // 8)
+
+    def offsetof(self, ty, field):
+        '''Returns the byte offset of `field` in struct `ty` as an i64
+        constant.  `field` may be a dotted path through nested structs.
+        '''
+        offset = 0
+        for name in field.split('.'):
+            ty = _strip(ty)
+            if not ty.is_struct:
+                raise TypeError("not a struct: %s" % ty)
+            if ty.is_bitfield(name):
+                raise TypeError("offsetof bit-field %s" % name)
+            offset += ty.get_field_offset(name, target=self.target)
+            ty = ty[name]
+        return self.constant_int(offset)
+
+    #---------------------------------------------------------------------------
+    # Field access
+
+    def gep_field(self, builder, ptr, ty, name):
+        '''Returns a pointer to field `name` of the struct `ty` at `ptr`.
+        Emits a constant-index GEP.
+        '''
+        lowering = self.get_struct_lowering(ty)
+        if lowering.ctype.is_bitfield(name):
+            raise TypeError("cannot take the address of bit-field %s" % name)
+        index = lowering.elements[name]
+        return builder.gep(ptr, [self.constant_int(0, 32),
+                                 self.constant_int(index, 32)])
+
+    def load_field(self, builder, ptr, ty, name):
+        return builder.load(self.gep_field(builder, ptr, ty, name))
+
+    def store_field(self, builder, value, ptr, ty, name):
+        return builder.store(value, self.gep_field(builder, ptr, ty, name))
+
+    def constant_int(self, value, bits=64):
+        return llvm.core.Constant.int(llvm.core.Type.int(bits), value)
+
+    def declare_function(self, fnty, name):
+        '''Declares an external C function following the ABI.
+        '''
+        return self.get_call_lowering(fnty).declare(name)
+
+    def add_call_loop(self, fnty, callee, name):
+        '''Emits a kernel calling a C function once per element of its
+        argument columns:
+
+            void name(i64 n, A0* col0, ..., An* coln[, R* out])
+
+        Each column is a contiguous array of the natural type of an argument
+        and `out` receives the results.  Arguments are coerced and passed in
+        native code following the ABI, so looping over n elements costs a
+        single foreign call.
+
+        `callee` is the name of the C function, declared if necessary.
+        '''
+        lc = llvm.core
+        fnty = _strip(fnty)
+        lowering = self.get_call_lowering(fnty)
+        target_fn = lowering.declare(callee)
+
+        retty = fnty.return_type.type
+        params = [lc.Type.int(64)]
+        params += [lc.Type.pointer(self.get_llvm_type(a)) for a in fnty.args]
+        if not retty.is_void:
+            params.append(lc.Type.pointer(self.get_llvm_type(retty)))
+        kernel = self.ir.add_function(lc.Type.function(lc.Type.void(), params),
+                                      name)
+        count = kernel.args[0]
+        columns = kernel.args[1:1 + len(fnty.args)]
+        out = kernel.args[-1] if not retty.is_void else None
+
+        entry = kernel.append_basic_block('entry')
+        cond = kernel.append_basic_block('cond')
+        body = kernel.append_basic_block('body')
+        exit = kernel.append_basic_block('exit')
+
+        builder = lc.Builder.new(entry)
+        argtemps, rettemp = lowering.alloca_temps(builder)
+        builder.branch(cond)
+
+        builder.position_at_end(cond)
+        index = builder.phi(lc.Type.int(64), 'i')
+        index.add_incoming(self.constant_int(0), entry)
+        builder.cbranch(builder.icmp(lc.ICMP_SLT, index, count), body, exit)
+
+        builder.position_at_end(body)
+        ptrs = [builder.gep(col, [index]) for col in columns]
+        args = lowering.load_args(builder, ptrs, argtemps)
+        if lowering.has_sret:
+            args.insert(0, builder.gep(out, [index]))
+        result = lowering.call(builder, target_fn, args)
+        if out is not None:
+            lowering.store_return(builder, result, builder.gep(out, [index]),
+                                  rettemp)
+        index.add_incoming(builder.add(index, self.constant_int(1)), body)
+        builder.branch(cond)
+
+        builder.position_at_end(exit)
+        builder.ret_void()
+        return kernel
+
+    def emit_object(self, cache=None, opt_level=2):
+        '''Returns the object code of the module for the target machine.
+
+        A copy of the module is optimized at `opt_level` (see `optimize`);
+        the module itself is left as is.  With an
+        `llcc.jitcache.ObjectCache`, the code is only optimized and compiled
+        if no object for the same IR, triple and level is cached.
+        '''
+        if opt_level not in OPT_PASSES:
+            raise ValueError("invalid optimization level %r" % (opt_level,))
+        machine = self.target.machine
+
+        def compile():
+            ir = self.ir
+            if OPT_PASSES[opt_level]:
+                ir = ir.clone()
+                run_passes(ir, opt_level)
+            return machine.emit_object(ir)
+
+        if cache is None:
+            return compile()
+        return cache.get_or_compile(str(self.ir), self.target.triple,
+                                    opt_level, compile)
+
+    def mark_adapter(self, fn):
+        '''Marks a generated ABI adapter (prologue, epilogue or wrapper)
+        for inlining into its callers by `optimize`.
+        '''
+        fn.add_attribute(llvm.core.ATTR_ALWAYS_INLINE)
+        return fn
+
+    def instruction_counts(self):
+        return dict((fn.name, count_instructions(fn))
+                    for fn in self.ir.functions if fn.basic_blocks)
+
+    def optimize(self, level=2):
+        '''Runs the passes of `OPT_PASSES[level]` over the module and
+        returns an OptimizationReport.
+        '''
+        if level not in OPT_PASSES:
+            raise ValueError("invalid optimization level %r" % (level,))
+        before = self.instruction_counts()
+        run_passes(self.ir, level)
+        return OptimizationReport(level, before, self.instruction_counts())
+
+    def add_function(self, fnty, name, internal=False):
+        '''Defines a C function and emits its prologue.  Returns a
+        FunctionBody.
+
+        An `internal` function can only be called from this module, through
+        `get_call_lowering(fnty, internal=True)`; small struct arguments are
+        then expanded into scalar parameters.
+        '''
+        lowering = self.get_call_lowering(fnty, internal)
+        return FunctionBody(lowering, lowering.define(name))
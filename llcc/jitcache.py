@@ -0,0 +1,146 @@
+'''
+Persistent cache of compiled object code
+
+Object files are stored in a directory, one file per module, named by the
+sha256 of the module IR, the target triple and the optimization level.
+When the directory grows beyond `max_size` bytes, the least recently used
+objects are removed.
+
+    cache = ObjectCache()
+    obj = cache.get_or_compile(str(module), triple, 2,
+                               lambda: machine.emit_object(module))
+
+Writes go through a temporary file and an atomic rename, so several
+processes can share a cache directory.
+'''
+from __future__ import print_function
+import os
+import hashlib
+import tempfile
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'llcc')
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024    # bytes
+
+def _replace(src, dst):
+    '''os.replace for python 2.  On Windows rename does not overwrite; an
+    existing `dst` holds the same object (filled by another process), so it
+    is kept and `src` removed.
+    '''
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.unlink(src)
+
+replace = getattr(os, 'replace', _replace)
+
+def cache_key(ir, triple, opt_level):
+    '''Returns the hex key of a module compiled for a target.
+    '''
+    h = hashlib.sha256()
+    for part in (triple, str(opt_level), ir):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+class ObjectCache(object):
+    '''Object code cache in a local directory.
+
+    The directory defaults to $LLCC_CACHE_DIR or ~/.cache/llcc.
+    '''
+    SUFFIX = '.o'
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        if directory is None:
+            directory = os.environ.get('LLCC_CACHE_DIR', DEFAULT_DIRECTORY)
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        '''Returns the cached object code or None.
+        '''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as fobj:
+                data = fobj.read()
+        except (IOError, OSError):
+            return None
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fobj:
+                fobj.write(data)
+            replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def get_or_compile(self, ir, triple, opt_level, compile):
+        '''Returns the object code of `ir`, calling `compile()` to produce
+        it on a miss.
+        '''
+        key = cache_key(ir, triple, opt_level)
+        data = self.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = compile()
+        self.put(key, data)
+        return data
+
+    def entries(self):
+        '''Returns ``(mtime, size, path)`` of cached objects, oldest first.
+        '''
+        out = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue        # removed by another process
+            out.append((st.st_mtime, st.st_size, path))
+        out.sort()
+        return out
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        '''Removes least recently used objects until the cache fits in
+        `max_size`.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
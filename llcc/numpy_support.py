@@ -0,0 +1,135 @@
+'''
+Conversion between llcc struct types and NumPy structured dtypes
+
+The dtype of a struct carries explicit offsets and itemsize from the target
+layout, so arrays of records written by C code can be viewed without copying:
+
+    np.frombuffer(buf, dtype=to_dtype(ts.get_struct('rec'), target))
+
+A dtype is only as aligned as its most aligned field, so the alignment
+of `aligned(N)` structs beyond that is lost (itemsize and offsets are
+kept); structs rebuilt by `from_dtype` have natural alignment.
+
+Requires NumPy.
+'''
+from __future__ import print_function
+import numpy as np
+import llcc.typesystem
+from llcc import support
+from llcc.packing import scalar_format
+
+#-------------------------------------------------------------------------------
+# llcc -> NumPy
+#-------------------------------------------------------------------------------
+
+def to_dtype(ty, target):
+    '''Returns the numpy.dtype matching the layout of `ty` on `target`.
+    Unless packed, structs give aligned dtypes.  Computed once per type.
+    '''
+    if isinstance(ty, llcc.typesystem.QualType):
+        ty = ty.type
+    return target.get_cache('dtype').get(ty, lambda ty: _to_dtype(ty, target))
+
+def _to_dtype(ty, target):
+    if ty.is_struct:
+        if target.get_layout(ty).has_bitfields:
+            raise TypeError("no dtype for the bit-fields of %s" % ty)
+        offsets = target.get_field_offsets(ty)
+        return np.dtype({'names': list(ty.fieldnames()),
+                         'formats': [to_dtype(fty, target) for fty in ty],
+                         'offsets': [off // 8 for off in offsets],
+                         'itemsize': target.get_sizeof(ty) // 8,
+                         'aligned': not ty.packed})
+    elif ty.is_complex and ty.basetype.type.is_float:
+        return np.dtype('=c%d' % (target.get_sizeof(ty) // 8))
+    elif ty.is_aggregate:
+        return np.dtype((to_dtype(ty.basetype, target), (ty.size,)))
+    return np.dtype('=' + scalar_format(ty, target))
+
+#-------------------------------------------------------------------------------
+# NumPy -> llcc
+#-------------------------------------------------------------------------------
+
+def from_dtype(dtype, target):
+    '''Returns an unnamed struct type (as a QualType) whose layout on
+    `target` matches a structured dtype.  Gaps between fields become
+    explicit `uint8_t` padding arrays; the struct is packed if the fields
+    are not naturally aligned.  Computed once per dtype.
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.fields is None:
+        raise TypeError("not a structured dtype: %s" % dtype)
+    return target.get_cache('from_dtype').get(dtype,
+                                              lambda dt: _from_dtype(dt,
+                                                                     target))
+
+def _from_dtype(dtype, target):
+    fields = sorted(((off, name, _scalar_or_aggregate(fdt, target),
+                      fdt.itemsize)
+                     for name, (fdt, off) in dtype.fields.items()),
+                    key=lambda x: x[0])
+    pos = 0
+    for off, name, _, size in fields:
+        if off < pos:
+            raise ValueError("field %r at offset %d overlaps" % (name, off))
+        pos = off + size
+    # fall back to a packed struct when natural alignment does not fit
+    st = (_match_layout(fields, dtype.itemsize, target, packed=False) or
+          _match_layout(fields, dtype.itemsize, target, packed=True))
+    if st is None:
+        raise ValueError("cannot match itemsize %d of %s" % (dtype.itemsize,
+                                                             dtype))
+    return st
+
+def _match_layout(fields, itemsize, target, packed):
+    ts = target.typesystem
+    members = []
+    pos = 0
+    npad = 0
+    for off, name, fty, size in fields:
+        falign = 1 if packed else target.get_align(fty) // 8
+        if off % falign:
+            return None
+        if support.align_to(pos, falign) != off:
+            members.append(('__pad%d' % npad,
+                            ts.get_array(ts.get_uint(8), off - pos)))
+            npad += 1
+        members.append((name, fty))
+        pos = off + size
+
+    st = ts.get_unnamed_struct(members, packed=packed)
+    size = target.get_sizeof(st) // 8
+    if size < itemsize:
+        members.append(('__pad%d' % npad,
+                        ts.get_array(ts.get_uint(8), itemsize - pos)))
+        st = ts.get_unnamed_struct(members, packed=packed)
+        size = target.get_sizeof(st) // 8
+    if size != itemsize:
+        return None
+    return st
+
+def _scalar_or_aggregate(dtype, target):
+    ts = target.typesystem
+    if dtype.subdtype is not None:
+        base, shape = dtype.subdtype
+        ty = _scalar_or_aggregate(base, target)
+        for dim in reversed(shape):
+            ty = ts.get_array(ty, dim)
+        return ty
+    elif dtype.fields is not None:
+        return from_dtype(dtype, target)
+    elif dtype.kind == 'b':
+        return llcc.typesystem.QualType(ts.builtins.bool_type)
+    elif dtype.kind == 'i':
+        return ts.get_int(dtype.itemsize * 8)
+    elif dtype.kind == 'u':
+        return ts.get_uint(dtype.itemsize * 8)
+    elif dtype.kind == 'f' and dtype.itemsize == 4:
+        return ts.get_float()
+    elif dtype.kind == 'f' and dtype.itemsize == 8:
+        return ts.get_double()
+    elif dtype.kind == 'c' and dtype.itemsize == 8:
+        return ts.get_complex(ts.get_float())
+    elif dtype.kind == 'c' and dtype.itemsize == 16:
+        return ts.get_complex(ts.get_double())
+    raise TypeError("unsupported dtype %s" % dtype)
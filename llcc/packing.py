@@ -0,0 +1,230 @@
+'''
+Pack Python values into ABI argument buffers with precompiled `struct.Struct`
+
+The argument buffer holds every argument that is not ignored by the ABI, in
+order, each in a slot aligned to at least the pointer size of the target
+(the size of a register or stack slot).  A slot contains the memory image of the argument in its C
+layout, which is also what the ABI loads into registers eightbyte by
+eightbyte; so coerced arguments such as a struct passed as `<2 x float>`
+need no special treatment.  Promotable integers passed with
+`ExtendArgInfo` are widened to 32 bits.  Arguments expanded into scalars
+or passed by reference without a copy (`ExpandArgInfo`, `IndirectArgInfo`
+without byval) have no memory image in a slot and cannot be packed.
+
+The return buffer holds the memory image of the return value.
+
+Aggregate values are given as (nested) sequences in field order.
+'''
+from __future__ import print_function
+import struct
+import llcc.typesystem
+from llcc import support
+
+#-------------------------------------------------------------------------------
+# Formats
+#-------------------------------------------------------------------------------
+
+SIGNED_FORMATS = {8: 'b', 16: 'h', 32: 'i', 64: 'q'}
+UNSIGNED_FORMATS = {8: 'B', 16: 'H', 32: 'I', 64: 'Q'}
+FLOAT_FORMATS = {32: 'f', 64: 'd'}
+
+def scalar_format(ty, target):
+    '''Returns the struct format character of a scalar or pointer type.
+    '''
+    if isinstance(ty, llcc.typesystem.QualType):
+        ty = ty.type
+    size = target.get_sizeof(ty)
+    if ty.is_pointer:
+        return UNSIGNED_FORMATS[size]
+    elif ty.is_scalar and ty.is_integer:
+        if ty.name == '_Bool':
+            return '?'
+        elif ty.is_signed:
+            return SIGNED_FORMATS[size]
+        else:
+            return UNSIGNED_FORMATS[size]
+    elif ty.is_scalar and ty.is_float and size in FLOAT_FORMATS:
+        return FLOAT_FORMATS[size]
+    raise TypeError("cannot marshal %s" % ty)
+
+def type_format(ty, target):
+    '''Returns the format of the memory image of a type, with explicit
+    padding bytes so that no implicit alignment is applied.
+    '''
+    if isinstance(ty, llcc.typesystem.QualType):
+        ty = ty.type
+    if not ty.is_aggregate:
+        return scalar_format(ty, target)
+    if ty.is_struct and target.get_layout(ty).has_bitfields:
+        raise TypeError("cannot marshal bit-fields of %s" % ty)
+    buf = []
+    pos = 0
+    for off, fty in zip(target.get_field_offsets(ty), ty):
+        off //= 8
+        if off > pos:
+            buf.append('%dx' % (off - pos))
+        buf.append(type_format(fty, target))
+        pos = off + target.get_sizeof(fty) // 8
+    size = target.get_sizeof(ty) // 8
+    if size > pos:
+        buf.append('%dx' % (size - pos))
+    return ''.join(buf)
+
+#-------------------------------------------------------------------------------
+# Flattening of aggregate values
+#-------------------------------------------------------------------------------
+
+def make_flattener(ty):
+    '''Returns a function appending the scalars of a value of type `ty` to
+    a list, or None if the type is a scalar.
+    '''
+    if isinstance(ty, llcc.typesystem.QualType):
+        ty = ty.type
+    if not ty.is_aggregate:
+        return None
+    subs = [make_flattener(fty) for fty in ty]
+    count = len(subs)
+
+    if not any(subs):
+        def flatten(value, out):
+            if len(value) != count:
+                raise ValueError("expecting %d values for %s" % (count, ty))
+            out.extend(value)
+    else:
+        def flatten(value, out):
+            if len(value) != count:
+                raise ValueError("expecting %d values for %s" % (count, ty))
+            for sub, v in zip(subs, value):
+                if sub is None:
+                    out.append(v)
+                else:
+                    sub(v, out)
+    return flatten
+
+def make_unflattener(ty):
+    '''Inverse of `make_flattener`: returns a function that takes the next
+    value of type `ty` from an iterator of scalars.
+    '''
+    if isinstance(ty, llcc.typesystem.QualType):
+        ty = ty.type
+    if not ty.is_aggregate:
+        return next
+    subs = [make_unflattener(fty) for fty in ty]
+
+    def unflatten(it):
+        return tuple(sub(it) for sub in subs)
+    return unflatten
+
+#-------------------------------------------------------------------------------
+# Packer
+#-------------------------------------------------------------------------------
+
+class ArgPacker(object):
+    '''Converts between Python values and the argument and return buffers
+    of a function type.  Use `get_packer` to get a cached instance.
+    '''
+    def __init__(self, target, fnty, abi_info=None):
+        if isinstance(fnty, llcc.typesystem.QualType):
+            fnty = fnty.type
+        if abi_info is None:
+            abi_info = target.compute_abi_info(fnty)
+        self.fnty = fnty
+        self.slot_align = target.ptrsize // 8     # bytes
+
+        # arguments
+        fmt = ['=']
+        pos = 0
+        self.arg_offsets = []
+        self.flatteners = []
+        for argty, info in zip(fnty.args, abi_info.arg_infos):
+            if info.is_ignore:
+                self.arg_offsets.append(None)
+                self.flatteners.append(None)
+                continue
+            if info.is_expand or (info.is_indirect and not info.byval):
+                raise TypeError("cannot marshal %s passed as %s"
+                                % (argty, type(info).__name__))
+            align = max(target.get_align(argty) // 8, self.slot_align)
+            start = support.align_to(pos, align)
+            if start > pos:
+                fmt.append('%dx' % (start - pos))
+            if info.is_extend:
+                argfmt = scalar_format(argty, target)
+                argfmt = 'i' if argfmt.islower() else 'I'
+                size = 4
+            else:
+                argfmt = type_format(argty, target)
+                size = target.get_sizeof(argty) // 8
+            fmt.append(argfmt)
+            self.arg_offsets.append(start)
+            self.flatteners.append(make_flattener(argty))
+            pos = start + size
+        end = support.align_to(pos, self.slot_align)
+        if end > pos:
+            fmt.append('%dx' % (end - pos))
+        self.args = struct.Struct(''.join(fmt))
+
+        self.ignored = [i for i, info in enumerate(abi_info.arg_infos)
+                        if info.is_ignore]
+        self.is_flat = not any(self.flatteners) and not self.ignored
+
+        # return value
+        retty = fnty.return_type.type
+        if retty.is_void:
+            self.result = struct.Struct('')
+            self.flatten_result = self.unflatten_result = None
+        else:
+            self.result = struct.Struct('=' + type_format(retty, target))
+            self.flatten_result = make_flattener(retty)
+            self.unflatten_result = make_unflattener(retty)
+
+    def flatten(self, args):
+        if len(args) != len(self.flatteners):
+            raise TypeError("expecting %d arguments" % len(self.flatteners))
+        if self.is_flat:
+            return args
+        out = []
+        for i, (flatten, value) in enumerate(zip(self.flatteners, args)):
+            if self.arg_offsets[i] is None:
+                continue
+            elif flatten is None:
+                out.append(value)
+            else:
+                flatten(value, out)
+        return out
+
+    def pack(self, *args):
+        '''Returns the argument buffer for the given argument values.
+        '''
+        return self.args.pack(*self.flatten(args))
+
+    def pack_into(self, buffer, offset, *args):
+        self.args.pack_into(buffer, offset, *self.flatten(args))
+
+    def unpack_result(self, buffer, offset=0):
+        '''Returns the value held in a return buffer.
+        '''
+        if self.unflatten_result is None:
+            return None
+        values = self.result.unpack_from(buffer, offset)
+        return self.unflatten_result(iter(values))
+
+    def pack_result(self, value):
+        '''Returns the return buffer holding a value.
+        '''
+        if self.unflatten_result is None:
+            return b''
+        if self.flatten_result is None:
+            return self.result.pack(value)
+        out = []
+        self.flatten_result(value, out)
+        return self.result.pack(*out)
+
+
+def get_packer(target, fnty):
+    '''Returns the ArgPacker of a function type; built once per target.
+    '''
+    if isinstance(fnty, llcc.typesystem.QualType):
+        fnty = fnty.type
+    return target.get_cache('packer').get(fnty,
+                                          lambda fnty: ArgPacker(target, fnty))
@@ -0,0 +1,278 @@
+'''
+Zero-copy record accessors over buffer-protocol objects
+
+`record_class(ty, target)` generates a class whose instances wrap any
+writable or read-only buffer (`bytearray`, `mmap`, `memoryview`, ...) at an
+offset and read or write the fields of struct `ty` in place, at the offsets
+computed by the target layout.  Nested structs and arrays are returned as
+views into the same buffer; nothing is copied.  Bit-fields read and write
+their bits in place.
+
+    Point = record_class(ts.get_struct('point'), target)
+    for pt in iter_records(mm, ts.get_struct('point'), target):
+        pt.x += 1
+'''
+from __future__ import print_function
+import struct
+import llcc.typesystem
+from llcc.packing import scalar_format, UNSIGNED_FORMATS
+
+#-------------------------------------------------------------------------------
+# Accessors
+#-------------------------------------------------------------------------------
+
+class ScalarAccessor(object):
+    '''Reads and writes a scalar at a byte offset of a buffer.
+    '''
+    __slots__ = 'struct', 'size'
+
+    def __init__(self, fmt):
+        self.struct = struct.Struct('=' + fmt)
+        self.size = self.struct.size
+
+    def get(self, buffer, offset):
+        return self.struct.unpack_from(buffer, offset)[0]
+
+    def set(self, buffer, offset, value):
+        self.struct.pack_into(buffer, offset, value)
+
+class BitFieldAccessor(object):
+    '''Reads and writes a bit-field in the bytes holding its bits, at a
+    byte offset of a buffer.  Bits are numbered from the least significant
+    of a little-endian value, as on x86; stored values are truncated to
+    the width like in C.
+    '''
+    __slots__ = 'struct', 'size', 'shift', 'width', 'mask', 'signed'
+
+    def __init__(self, shift, width, signed):
+        self.size = (shift + width + 7) // 8
+        if self.size in (1, 2, 4, 8):
+            self.struct = struct.Struct('<' + UNSIGNED_FORMATS[self.size * 8])
+        else:
+            # odd spans of packed bit-fields are read bytewise
+            self.struct = struct.Struct('<%dB' % self.size)
+        self.shift = shift
+        self.width = width
+        self.mask = (1 << width) - 1
+        self.signed = signed
+
+    def _load(self, buffer, offset):
+        values = self.struct.unpack_from(buffer, offset)
+        unit = 0
+        for i, byte in enumerate(values):
+            unit |= byte << (8 * i)
+        return unit
+
+    def _store(self, buffer, offset, unit):
+        if self.size in (1, 2, 4, 8):
+            self.struct.pack_into(buffer, offset, unit)
+        else:
+            self.struct.pack_into(buffer, offset,
+                                  *[(unit >> (8 * i)) & 0xff
+                                    for i in range(self.size)])
+
+    def get(self, buffer, offset):
+        value = (self._load(buffer, offset) >> self.shift) & self.mask
+        if self.signed and value >> (self.width - 1):
+            value -= 1 << self.width
+        return value
+
+    def set(self, buffer, offset, value):
+        unit = self._load(buffer, offset)
+        unit &= ~(self.mask << self.shift)
+        unit |= (value & self.mask) << self.shift
+        self._store(buffer, offset, unit)
+
+class ArrayAccessor(object):
+    '''Returns ArrayViews of a C array at a byte offset of a buffer.
+    '''
+    __slots__ = 'element', 'stride', 'count', 'size'
+
+    def __init__(self, element, stride, count):
+        self.element = element
+        self.stride = stride
+        self.count = count
+        self.size = stride * count
+
+    def get(self, buffer, offset):
+        return ArrayView(buffer, offset, self)
+
+    def set(self, buffer, offset, values):
+        if len(values) != self.count:
+            raise ValueError("expecting %d values" % self.count)
+        for i, value in enumerate(values):
+            self.element.set(buffer, offset + i * self.stride, value)
+
+class RecordAccessor(object):
+    '''Returns Record views of a struct at a byte offset of a buffer.
+    '''
+    __slots__ = 'cls', 'size'
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.size = cls._size
+
+    def get(self, buffer, offset):
+        return self.cls(buffer, offset)
+
+    def set(self, buffer, offset, values):
+        record = self.cls(buffer, offset)
+        if len(values) != len(record._fields):
+            raise ValueError("expecting %d values" % len(record._fields))
+        for name, value in zip(record._fields, values):
+            setattr(record, name, value)
+
+class Field(object):
+    '''Descriptor of a field of a Record subclass.
+    '''
+    __slots__ = 'accessor', 'offset'
+
+    def __init__(self, accessor, offset):
+        self.accessor = accessor
+        self.offset = offset
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        return self.accessor.get(obj._buffer, obj._offset + self.offset)
+
+    def __set__(self, obj, value):
+        self.accessor.set(obj._buffer, obj._offset + self.offset, value)
+
+#-------------------------------------------------------------------------------
+# Views
+#-------------------------------------------------------------------------------
+
+class ArrayView(object):
+    '''A C array inside a buffer.  Elements are read and written in place;
+    aggregate elements are returned as views.
+    '''
+    __slots__ = '_buffer', '_offset', '_accessor'
+
+    def __init__(self, buffer, offset, accessor):
+        self._buffer = buffer
+        self._offset = offset
+        self._accessor = accessor
+
+    def __len__(self):
+        return self._accessor.count
+
+    def _locate(self, i):
+        count = self._accessor.count
+        if i < 0:
+            i += count
+        if not 0 <= i < count:
+            raise IndexError(i)
+        return self._offset + i * self._accessor.stride
+
+    def __getitem__(self, i):
+        return self._accessor.element.get(self._buffer, self._locate(i))
+
+    def __setitem__(self, i, value):
+        self._accessor.element.set(self._buffer, self._locate(i), value)
+
+    def __iter__(self):
+        get = self._accessor.element.get
+        stride = self._accessor.stride
+        for i in range(self._accessor.count):
+            yield get(self._buffer, self._offset + i * stride)
+
+    def __repr__(self):
+        return '<ArrayView %s>' % list(self)
+
+class Record(object):
+    '''Base class of generated record accessors.
+
+    Subclasses have one `Field` descriptor per struct member and the
+    class attributes `_type` and `_size` (in bytes).
+    '''
+    __slots__ = '_buffer', '_offset'
+    _type = None
+    _size = 0
+    _fields = ()
+
+    def __init__(self, buffer, offset=0):
+        self._buffer = buffer
+        self._offset = offset
+
+    def _astuple(self):
+        '''Copies the field values out of the buffer.
+        '''
+        out = []
+        for name in self._fields:
+            value = getattr(self, name)
+            if isinstance(value, (Record, ArrayView)):
+                value = _astuple(value)
+            out.append(value)
+        return tuple(out)
+
+    def __repr__(self):
+        fields = ', '.join('%s=%r' % (name, getattr(self, name))
+                           for name in self._fields)
+        return '<%s %s>' % (type(self).__name__, fields)
+
+def _astuple(view):
+    if isinstance(view, Record):
+        return view._astuple()
+    return tuple(_astuple(v) if isinstance(v, (Record, ArrayView)) else v
+                 for v in view)
+
+#-------------------------------------------------------------------------------
+# Generation
+#-------------------------------------------------------------------------------
+
+def record_class(ty, target):
+    '''Returns the Record subclass for struct `ty`; generated once per
+    target.
+    '''
+    if isinstance(ty, llcc.typesystem.QualType):
+        ty = ty.type
+    if not ty.is_struct:
+        raise TypeError("not a struct: %s" % ty)
+    return get_accessor(ty, target).cls
+
+def get_accessor(ty, target):
+    if isinstance(ty, llcc.typesystem.QualType):
+        ty = ty.type
+    return target.get_cache('record').get(ty,
+                                          lambda ty: _make_accessor(ty,
+                                                                    target))
+
+def _make_accessor(ty, target):
+    if ty.is_struct:
+        names = tuple(name for name in ty.fieldnames()
+                      if name not in ty.unnamed_bitfields)
+        attrs = {'__slots__': (),
+                 '_type': ty,
+                 '_size': target.get_sizeof(ty) // 8,
+                 '_fields': names}
+        layout = target.get_layout(ty)
+        for name, fty, off, width in zip(ty.fieldnames(), ty, layout.offsets,
+                                         layout.widths):
+            if name in ty.unnamed_bitfields:
+                continue
+            elif width is None:
+                attrs[name] = Field(get_accessor(fty, target), off // 8)
+            else:
+                signed = scalar_format(fty, target).islower()
+                attrs[name] = Field(BitFieldAccessor(off % 8, width, signed),
+                                    off // 8)
+        clsname = 'Record_%s' % (ty.name or ty.fingerprint[:8])
+        return RecordAccessor(type(clsname.replace('.', '_'), (Record,),
+                                   attrs))
+    elif ty.is_aggregate:
+        stride = target.get_sizeof(ty.basetype) // 8
+        return ArrayAccessor(get_accessor(ty.basetype, target), stride,
+                             ty.size)
+    return ScalarAccessor(scalar_format(ty, target))
+
+def iter_records(buffer, ty, target, offset=0, count=None):
+    '''Yields record views over consecutive structs `ty` in a buffer.
+    Without `count`, iterates as many whole records as the buffer holds.
+    '''
+    cls = record_class(ty, target)
+    size = cls._size
+    if count is None:
+        count = (memoryview(buffer).nbytes - offset) // size
+    for i in range(count):
+        yield cls(buffer, offset + i * size)
@@ -1,26 +1,73 @@
 import re
+import weakref
 
 #-------------------------------------------------------------------------------
 # Renamer
 #-------------------------------------------------------------------------------
 
-rename_regex = re.compile('.*\.(\d+)$')
+rename_regex = re.compile(r'.*\.(\d+)$')
 
-def rename_until(name, cond):
-    while not cond(name):
+class UniqueNamer(object):
+    '''Unique name allocator.
+
+    A taken name gets the next numeric suffix: "foo" becomes "foo.0",
+    "foo.3" becomes "foo.4".  The next free suffix of each base name is
+    remembered, so allocating many copies of a name stays amortized O(1).
+    Names must stay taken once `cond` rejects them.
+    '''
+    def __init__(self):
+        self.counters = {}
+
+    def rename(self, name, cond):
+        if cond(name):
+            return name
         m = rename_regex.match(name)
         if m:
-            ct = m.group(1)
-            s = m.start(1)
-            name = name[:s] + str(int(ct) + 1)
+            base, ct = name[:m.start(1) - 1], int(m.group(1)) + 1
         else:
-            name = '%s.0' % name
-    return name
+            base, ct = name, 0
+        # suffixes below the counter are all taken
+        known = self.counters.get(base, 0)
+        contiguous = ct <= known
+        ct = max(ct, known)
+        while True:
+            candidate = '%s.%d' % (base, ct)
+            ct += 1
+            if cond(candidate):
+                break
+        if contiguous:
+            self.counters[base] = ct
+        return candidate
+
+#-------------------------------------------------------------------------------
+# Arithmetic
+#-------------------------------------------------------------------------------
+
+def align_to(value, align):
+    '''Round `value` up to a multiple of `align`.
+    '''
+    return (value + align - 1) // align * align
 
 #-------------------------------------------------------------------------------
 # Classifier
 #-------------------------------------------------------------------------------
 
+class ClassCode(int):
+    '''A small integer code for a class that prints as the class name.
+
+    Codes can index lookup tables directly while `repr` and `str` still
+    show the public name.
+    '''
+    def __new__(cls, value, name):
+        obj = int.__new__(cls, value)
+        obj.name = name
+        return obj
+
+    def __repr__(self):
+        return self.name
+
+    __str__ = __repr__
+
 class Classifier(object):
     classes = ()    # a sequence of possible classes
     default = None  # default value of the classifier
@@ -30,8 +77,16 @@ class Classifier(object):
             value = self.default
         self.set(value)
 
+    @classmethod
+    def valid_classes(cls):
+        valid = cls.__dict__.get('_valid_classes')
+        if valid is None:
+            valid = frozenset(cls.classes)
+            setattr(cls, '_valid_classes', valid)
+        return valid
+
     def set(self, value):
-        assert value in self.classes
+        assert value in self.valid_classes()
         self.value = value
 
     def get(self):
@@ -45,3 +100,37 @@ class Classifier(object):
 
     def __ne__(self, other):
         return not (self == other)
+
+#-------------------------------------------------------------------------------
+# Caches
+#-------------------------------------------------------------------------------
+
+class OnceCache(object):
+    '''A memo table that is safe to share between threads.
+
+    Lookups never lock.  On a miss the value is computed outside of any lock
+    and published with an atomic `dict.setdefault`, so concurrent callers
+    racing on the same key all get the first published object.  `compute`
+    must therefore be a pure function of its key.
+
+    A `weak` cache holds its keys by weak reference, so entries go away with
+    their keys; the values must not refer back to their key.
+    '''
+    def __init__(self, weak=False):
+        self.weak = weak
+        self.values = weakref.WeakKeyDictionary() if weak else {}
+
+    def get(self, key, compute):
+        try:
+            return self.values[key]
+        except KeyError:
+            return self.values.setdefault(key, compute(key))
+
+    def clear(self):
+        self.values = weakref.WeakKeyDictionary() if self.weak else {}
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
@@ -1,8 +1,101 @@
 import sys
 import ctypes
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
 import llvm.ee
 import llcc.typesystem
 import llcc.abi
+from llcc import support
+
+#-------------------------------------------------------------------------------
+# Struct Layout
+#-------------------------------------------------------------------------------
+
+class StructLayout(object):
+    '''Layout of a struct on a target.  Sizes and offsets are in bits.
+
+    `widths` holds the width of each bit-field and None for other fields.
+    '''
+    __slots__ = 'size', 'align', 'offsets', 'widths', '_by_name'
+
+    def __init__(self, size, align, names, offsets, widths=None):
+        self.size = size
+        self.align = align
+        self.offsets = tuple(offsets)
+        if widths is None:
+            widths = [None] * len(self.offsets)
+        self.widths = tuple(widths)
+        self._by_name = dict(zip(names, self.offsets))
+
+    def offset_of(self, name):
+        return self._by_name[name]
+
+    @property
+    def has_bitfields(self):
+        return any(w is not None for w in self.widths)
+
+    def __repr__(self):
+        return '<StructLayout size=%d align=%d offsets=%s>' % (self.size,
+                                                               self.align,
+                                                               self.offsets)
+
+#-------------------------------------------------------------------------------
+# Scalar Leaves
+#-------------------------------------------------------------------------------
+
+class LeafIndex(object):
+    '''The scalar leaves of a type: every scalar, pointer or vector found
+    through nested structs, arrays and complex types, sorted by offset.
+    Offsets and sizes are in bytes.
+
+    Queries are binary searches over the leaf offsets.
+    '''
+    __slots__ = 'starts', 'ends', 'types', '_nonfloats'
+
+    def __init__(self, leaves):
+        self.starts = array('l', (off for off, _, _ in leaves))
+        self.ends = array('l', (off + size for off, size, _ in leaves))
+        self.types = tuple(ty for _, _, ty in leaves)
+        # prefix count of leaves that are not a C float
+        nonfloats = array('l', [0])
+        for _, size, ty in leaves:
+            isfloat = ty.is_scalar and ty.is_float and size == 4
+            nonfloats.append(nonfloats[-1] + (not isfloat))
+        self._nonfloats = nonfloats
+
+    def __len__(self):
+        return len(self.types)
+
+    def leaf_at(self, offset):
+        '''Returns the index of the leaf covering byte `offset`, or None.
+        '''
+        i = bisect_right(self.starts, offset) - 1
+        if i >= 0 and offset < self.ends[i]:
+            return i
+
+    def type_at(self, offset):
+        '''Returns the type of the leaf starting at byte `offset`, or None.
+        '''
+        i = bisect_left(self.starts, offset)
+        if i < len(self.starts) and self.starts[i] == offset:
+            return self.types[i]
+
+    def _span(self, begin, end):
+        return bisect_right(self.ends, begin), bisect_left(self.starts, end)
+
+    def no_data(self, begin, end):
+        '''True if no leaf overlaps bytes [begin, end).
+        '''
+        lo, hi = self._span(begin, end)
+        return lo >= hi
+
+    def all_float(self, begin, end):
+        '''True if bytes [begin, end) overlap only `float` leaves (and at
+        least one).
+        '''
+        lo, hi = self._span(begin, end)
+        return lo < hi and self._nonfloats[hi] == self._nonfloats[lo]
 
 #-------------------------------------------------------------------------------
 # Target Information
@@ -12,7 +105,15 @@ import llcc.abi
 class TargetInfo(object):
     '''
     Use one of the factory methods to construct a TargetInfo.
+
+    Call `freeze()` once the target is set up to share it between threads.
     '''
+    is_frozen = False
+
+    # Widest vector extension usable for argument passing
+    AVX_NONE, AVX, AVX512 = 0, 1, 2
+    avx_level = AVX_NONE
+
     @staticmethod
     def get_host_target():
         ti = TargetInfo()
@@ -46,6 +147,67 @@ class TargetInfo(object):
         # FIXME: verify that alignment is the same as sizeof?
         self._init_host_sizeofs()
         self.align_table = self.sizeof_table.copy()
+        self.align_table[self.typesystem.builtins.longdouble_type] = \
+                                    ctypes.alignment(ctypes.c_longdouble) * 8
+
+    def freeze(self):
+        '''Make the target and its typesystem immutable.
+
+        A frozen target can be read from any number of threads without
+        locking; its lazily filled caches are race-free (see
+        `support.OnceCache`).
+        '''
+        self.typesystem.freeze()
+        # readers share these caches from the start
+        object.__setattr__(self, '_caches', (self._cache_epoch(), {}))
+        object.__setattr__(self, 'is_frozen', True)
+
+    def __setattr__(self, k, v):
+        if self.is_frozen:
+            raise TypeError("cannot modify a frozen TargetInfo")
+        super(TargetInfo, self).__setattr__(k, v)
+
+    def set_avx_level(self, level):
+        '''Select the vector extension assumed by the ABI: AVX_NONE, AVX
+        (256-bit vectors in ymm registers) or AVX512 (512-bit vectors in zmm
+        registers).  Must be called before computing any ABI info.
+        '''
+        if level not in (self.AVX_NONE, self.AVX, self.AVX512):
+            raise ValueError("invalid AVX level %r" % (level,))
+        self.avx_level = level
+        # results derived from the ABI are stale
+        object.__setattr__(self, '_caches', None)
+
+    _caches_lock = threading.Lock()
+
+    def _cache_epoch(self):
+        return (self.typesystem.epoch.value,
+                llcc.typesystem.UNOWNED_EPOCH.value)
+
+    # caches holding their keys weakly (see support.OnceCache), so that
+    # streams of short lived types do not pile up
+    WEAK_CACHES = frozenset(['layout', 'leaves'])
+
+    def get_cache(self, name):
+        '''Returns the named cache of values derived from types.
+
+        All caches are dropped when a struct of the typesystem (or one
+        created outside of any typesystem) changes definition.
+        '''
+        epoch = self._cache_epoch()
+        caches = self.__dict__.get('_caches')
+        if caches is None or caches[0] != epoch:
+            # swapped once, so that threads share the new caches
+            with self._caches_lock:
+                caches = self.__dict__.get('_caches')
+                if caches is None or caches[0] != epoch:
+                    caches = (epoch, {})
+                    object.__setattr__(self, '_caches', caches)
+        try:
+            return caches[1][name]
+        except KeyError:
+            return caches[1].setdefault(name, support.OnceCache(
+                                            name in self.WEAK_CACHES))
 
     def _init_host_sizeofs(self):
         sizeofs = self.sizeof_table = {}
@@ -67,6 +229,7 @@ class TargetInfo(object):
         # real
         sizeofs[tsb.float_type] = 32
         sizeofs[tsb.double_type] = 64
+        sizeofs[tsb.longdouble_type] = ctypes.sizeof(ctypes.c_longdouble) * 8
 
     def get_align(self, ty):
         if isinstance(ty, llcc.typesystem.QualType):
@@ -75,6 +238,16 @@ class TargetInfo(object):
             return self.ptrsize
         elif ty.is_function:
             raise ValueError("illegal align of function type")
+        elif ty.is_struct:
+            return self.get_layout(ty).align
+        elif ty.is_vector:
+            # vectors are aligned to their size rounded to a power of two
+            align = 8
+            while align < self.get_sizeof(ty):
+                align *= 2
+            return align
+        elif ty.is_aggregate:
+            return self.get_align(ty.basetype)
         return self.align_table[ty]
 
     def get_sizeof(self, ty):
@@ -84,14 +257,125 @@ class TargetInfo(object):
             return self.ptrsize
         elif ty.is_function:
             raise ValueError("illegal sizeof function type")
+        elif ty.is_struct:
+            return self.get_layout(ty).size
         elif ty.is_aggregate:
-            return sum(self.get_sizeof(field) for field in ty)
+            return self.get_sizeof(ty.basetype) * ty.size
         return self.sizeof_table[ty]
 
-    def compute_abi_info(self, fnty):
-        abi_info = self.abi_info(target=self)
-        if isinstance(fnty, llcc.typesystem.QualType):
-            fnty = fnty.type
+    def get_layout(self, ty):
+        '''Returns the StructLayout of a struct type.
+        Computed once per struct, and kept as long as the struct is alive.
+        '''
+        if isinstance(ty, llcc.typesystem.QualType):
+            ty = ty.type
+        return self.get_cache('layout').get(ty, self._compute_layout)
+
+    def _compute_layout(self, ty):
+        if not ty.is_defined:
+            raise ValueError("incomplete type %s" % ty)
+        offset = 0
+        align = 8
+        offsets = []
+        widths = []
+        for name, fty in ty.fields():
+            unit = self.get_align(fty)
+            # packed fields are byte aligned unless explicitly aligned
+            falign = 8 if ty.packed else unit
+            if name in ty.field_aligns:
+                falign = max(falign, ty.field_aligns[name] * 8)
+            width = ty.bitwidths.get(name)
+            if width is None:
+                offset = support.align_to(offset, falign)
+                offsets.append(offset)
+                offset += self.get_sizeof(fty)
+            else:
+                # System V: a bit-field is packed after the previous one
+                # unless it would straddle a storage unit of its declared
+                # type (packed ones may); a zero-width bit-field ends the
+                # unit.
+                if width == 0:
+                    offset = support.align_to(offset, unit)
+                elif name in ty.field_aligns:
+                    offset = support.align_to(offset, falign)
+                elif not ty.packed and offset % unit + width > unit:
+                    offset = support.align_to(offset, unit)
+                offsets.append(offset)
+                offset += width
+            widths.append(width)
+            # unnamed bit-fields do not affect the struct alignment
+            if name not in ty.unnamed_bitfields:
+                align = max(align, falign)
+        if ty.align is not None:
+            align = max(align, ty.align * 8)
+        size = support.align_to(offset, align)
+        return StructLayout(size, align, ty.fieldnames(), offsets, widths)
+
+    def get_field_offsets(self, ty):
+        '''Returns the bit offsets of the elements of an aggregate type.
+        '''
+        if isinstance(ty, llcc.typesystem.QualType):
+            ty = ty.type
+        if ty.is_struct:
+            return self.get_layout(ty).offsets
+        elemsize = self.get_sizeof(ty.basetype)
+        return tuple(i * elemsize for i in range(ty.size))
+
+    def get_leaf_index(self, ty):
+        '''Returns the LeafIndex of a type.  Computed once per type, and
+        kept as long as the type is alive.
+        '''
+        if isinstance(ty, llcc.typesystem.QualType):
+            ty = ty.type
+        return self.get_cache('leaves').get(ty, self._compute_leaf_index)
+
+    def _compute_leaf_index(self, ty):
+        leaves = []
+        self._collect_leaves(ty, 0, leaves)
+        return LeafIndex(leaves)
+
+    def _collect_leaves(self, ty, offset, leaves):
+        if isinstance(ty, llcc.typesystem.QualType):
+            ty = ty.type
+        if ty.is_struct:
+            layout = self.get_layout(ty)
+            for name, off, width, fty in zip(ty.fieldnames(), layout.offsets,
+                                             layout.widths, ty):
+                if width is None:
+                    self._collect_leaves(fty, offset + off // 8, leaves)
+                elif width and name not in ty.unnamed_bitfields:
+                    self._add_bitfield_leaf(fty.type, offset, off, width,
+                                            leaves)
+        elif ty.is_aggregate and not ty.is_vector:
+            for off, fty in zip(self.get_field_offsets(ty), ty):
+                self._collect_leaves(fty, offset + off // 8, leaves)
+        else:
+            leaves.append((offset, self.get_sizeof(ty) // 8, ty))
+
+    def _add_bitfield_leaf(self, ty, offset, bitoffset, width, leaves):
+        # a bit-field covers the bytes holding its bits; bit-fields sharing
+        # a byte are merged into one leaf
+        start = offset + bitoffset // 8
+        end = offset + (bitoffset + width + 7) // 8
+        if leaves and leaves[-1][0] + leaves[-1][1] > start:
+            start, _, ty = leaves.pop()
+        leaves.append((start, end - start, ty))
+
+    def compute_abi_info(self, fnty, internal=False):
+        '''`fnty` is anything `llcc.abi.as_function_type` accepts, including
+        signature strings.  `internal` functions are only called from
+        generated code and may use a cheaper convention (see
+        `llcc.abi.ABIInfo`).
+        '''
+        abi_info = self.abi_info(target=self, internal=internal)
+        fnty = llcc.abi.as_function_type(fnty, self.typesystem)
         abi_info.compute_info(fnty)
         return abi_info
 
+    def iter_abi_info(self, signatures, batch_size=None, cache_size=1024):
+        '''Streaming version of `compute_abi_info`.
+        See `llcc.abi.iter_abi_info`.
+        '''
+        return llcc.abi.iter_abi_info(self, signatures, batch_size=batch_size,
+                                      cache_size=cache_size)
+
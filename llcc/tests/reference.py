@@ -0,0 +1,43 @@
+'''
+Reference implementations checked against the optimized ones by the tests
+and used as baselines by the benchmarks.
+'''
+from __future__ import print_function
+from llcc.abi import X86_64ABIClasses, MERGE_TABLE, POSTMERGE_TABLES
+from llcc.abi import X86_64Classifier
+
+class RecursiveClassifier(X86_64Classifier):
+    '''Reference classifier creating one child classifier per field, as
+    before the single-pass walk.
+    '''
+    def classify_aggregate(self, ty, offset):
+        C = X86_64ABIClasses
+        sizeof = self.target.get_sizeof(ty)
+        if sizeof > 8 * 8 * 8:
+            return self.place(C.MEMORY, offset)
+        lo = hi = C.NO_CLASS
+        for name, fieldoff, width, fieldty in self.iter_fields(ty):
+            if width is not None and name in ty.unnamed_bitfields:
+                continue
+            fty = fieldty.type
+            if sizeof > 128 and (self.target.get_sizeof(fty) != sizeof or
+                                 sizeof > self.native_vector_size):
+                lo = C.MEMORY
+                break
+            if width is not None:
+                fldlo, fldhi = self.classify_bitfield(offset * 8 + fieldoff,
+                                                      width)
+            elif (offset * 8 + fieldoff) % self.target.get_align(fty):
+                lo = C.MEMORY
+                break
+            else:
+                child = RecursiveClassifier(self.target, fty,
+                                            offset + fieldoff // 8)
+                child.classify()
+                fldlo, fldhi = child.lo, child.hi
+            lo = MERGE_TABLE[lo << 3 | fldlo]
+            hi = MERGE_TABLE[hi << 3 | fldhi]
+            if lo is C.MEMORY or hi is C.MEMORY:
+                break
+        key = (sizeof > 128) << 6 | lo << 3 | hi
+        return POSTMERGE_TABLES[self.honorsRevision0_98][key]
@@ -1,6 +1,14 @@
 from __future__ import print_function
+import gc
+import random
+import threading
 import unittest
 from llcc.target import TargetInfo
+from llcc.abi import X86_64ABIClasses, MERGE_TABLE, POSTMERGE_TABLES
+from llcc.abi import POSTMERGE_RULES, trace, X86_64Classifier
+import llcc.abi
+from llcc.abi import LOC_STACK, SRET_ARG, RETURN_ARG
+from llcc.tests.reference import RecursiveClassifier
 
 class TestABI_X86_64(unittest.TestCase):
     def setUp(self):
@@ -174,5 +182,628 @@ class TestABI_X86_64(unittest.TestCase):
         abi = self.ti.compute_abi_info(fnty)
         print(abi)
 
+    def test_nested_eightbytes(self):
+        ts = self.ts
+        # float pair inside a nested struct, then an int
+        st = ts.parse('struct {struct {float x; float y} p; int i}')
+        # char then int share the first eightbyte
+        st2 = ts.parse('struct {char c; int i; double d}')
+        # int at offset 4 of an array
+        st3 = ts.parse('struct {int a[3]}')
+        fnty = ts.get_function(ts.get_void(), [st, st2, st3])
+        abi = self.ti.compute_abi_info(fnty)
+        print(abi)
+        lo, hi = abi.arg_infos[0].coerce_type.fieldtypes()
+        self.assertEqual(lo, ts.get_vector(ts.get_float(), 2))
+        self.assertEqual(hi, ts.get_int())
+        lo, hi = abi.arg_infos[1].coerce_type.fieldtypes()
+        self.assertEqual(lo, ts.get_uint(64))
+        self.assertEqual(hi, ts.get_double())
+        lo, hi = abi.arg_infos[2].coerce_type.fieldtypes()
+        self.assertEqual(lo, ts.get_uint(64))
+        self.assertEqual(hi, ts.get_int())
+
+    def test_bitfields(self):
+        ts = self.ts
+        uint = ts.get_uint(32)
+        # flags packed in the first eightbyte
+        flags = ts.get_unnamed_struct([('a', uint, 4), ('b', uint, 4),
+                                       ('c', uint, 24), ('d', ts.get_double())])
+        # a bit-field pushed into the second eightbyte
+        wide = ts.get_unnamed_struct([('x', ts.get_uint(64), 60),
+                                      ('y', ts.get_uint(64), 8)])
+        # unnamed bit-fields are padding
+        pad = ts.parse('struct {float f; unsigned : 0; float g}')
+        fnty = ts.get_function(ts.get_void(), [flags, wide, pad])
+        abi = self.ti.compute_abi_info(fnty)
+        print(abi)
+        self.assertEqual(self.ti.get_sizeof(flags), 128)
+        lo, hi = abi.arg_infos[0].coerce_type.fieldtypes()
+        self.assertEqual(lo, uint)
+        self.assertEqual(hi, ts.get_double())
+        lo, hi = abi.arg_infos[1].coerce_type.fieldtypes()
+        self.assertEqual(lo, ts.get_uint(64))
+        self.assertEqual(hi, ts.get_uint(64))
+        self.assertEqual(abi.arg_infos[2].coerce_type,
+                         ts.get_vector(ts.get_float(), 2))
+
+    def test_packed_aligned(self):
+        ts = self.ts
+        # an unaligned field forces MEMORY
+        unaligned = ts.parse('struct __attribute__((packed)) '
+                             '{char c; int i}')
+        # packing that keeps fields aligned changes nothing
+        aligned = ts.parse('struct __attribute__((packed)) {int a; int b}')
+        # cache-line aligned record
+        line = ts.parse('struct {long x} __attribute__((aligned(64)))')
+        fnty = ts.get_function(ts.get_void(), [unaligned, aligned, line])
+        abi = self.ti.compute_abi_info(fnty)
+        print(abi)
+        self.assertTrue(abi.arg_infos[0].is_indirect)
+        self.assertTrue(abi.arg_infos[1].is_direct)
+        self.assertEqual(abi.arg_infos[1].coerce_type, ts.get_uint(64).type)
+        self.assertTrue(abi.arg_infos[2].is_indirect)
+        self.assertEqual(abi.arg_infos[2].align, 64)
+
+    def test_call_plan(self):
+        ity = self.ts.get_int()
+        dty = self.ts.get_double()
+        args = [ity, dty,
+                self.ts.get_unnamed_struct([dty, dty]),
+                self.ts.get_unnamed_struct([self.ts.get_float()] * 5)]
+        args += [ity] * 6
+        fnty = self.ts.get_function(self.ts.get_void(), args)
+        abi = self.ti.compute_abi_info(fnty)
+        print(abi)
+        plan = abi.call_plan
+
+        locs = [(plan.arg[i], plan.location(i)) for i in range(len(plan))]
+        self.assertEqual(locs, [(0, 'rdi'), (1, 'xmm0'),
+                                (2, 'xmm1'), (2, 'xmm2'),
+                                (3, 'stack+0'),
+                                (4, 'rsi'), (5, 'rdx'), (6, 'rcx'),
+                                (7, 'r8'), (8, 'r9'),
+                                (9, 'stack+24')])
+
+        # {double, double} is split in two eightbytes
+        first, second = plan.parts_of(2)
+        self.assertEqual((plan.offset[first], plan.offset[second]), (0, 8))
+
+        # struct of 5 floats is copied to the stack
+        self.assertTrue(abi.arg_infos[3].is_indirect)
+        self.assertTrue(abi.arg_infos[3].byval)
+        part, = plan.parts_of(3)
+        self.assertEqual(plan.kind[part], LOC_STACK)
+        self.assertEqual(plan.size[part], 20)
+        self.assertEqual(plan.align[part], 8)
+        self.assertEqual(plan.stack_size, 32)
+
+        self.assertRaises(TypeError, setattr, plan, 'stack_size', 0)
+        def assign():
+            plan.loc[0] = 5
+        self.assertRaises(TypeError, assign)
+
+    def test_stream(self):
+        fty = self.ts.get_float()
+        ity = self.ts.get_int()
+        pair = self.ts.get_unnamed_struct([fty, fty])
+
+        def signatures(n):
+            for i in range(n):
+                if i % 2:
+                    yield (self.ts.get_void(), [ity] * (i % 9))
+                else:
+                    yield self.ts.get_function(self.ts.get_void(), [pair, ity])
+
+        results = list(self.ti.iter_abi_info(signatures(1000)))
+        self.assertEqual(len(results), 1000)
+        self.assertTrue(results[0] is results[2], "memoized by fingerprint")
+        self.assertTrue(results[0].return_info.is_ignore)
+        self.assertEqual(len(results[0].arg_infos), 2)
+        self.assertEqual(results[0].arg_infos[0].coerce_type,
+                         self.ts.get_vector(fty, 2))
+        self.assertEqual(len(results[7].arg_infos), 7)
+
+        batches = list(self.ti.iter_abi_info(signatures(25), batch_size=10))
+        self.assertEqual([len(b) for b in batches], [10, 10, 5])
+
+    def test_stream_memory(self):
+        ti = self.ti
+        ti.freeze()
+
+        ts = self.ts
+        ity = ts.get_int()
+
+        def signatures(n):
+            # a new struct per signature, dropped once classified
+            for i in range(n):
+                st = ts.get_unnamed_struct([('x%d' % i, ts.get_double()),
+                                            ('y', ity)])
+                yield (ts.get_void(), [ity] * (i % 7) + [st])
+
+        def cache_sizes():
+            gc.collect()
+            return len(ti.get_cache('layout')), len(ti.get_cache('pairs'))
+
+        for result in ti.iter_abi_info(signatures(100), cache_size=8):
+            pass
+        sizes = cache_sizes()
+        for result in ti.iter_abi_info(signatures(2000), cache_size=8):
+            pass
+        print(sizes, cache_sizes())
+        self.assertEqual(cache_sizes(), sizes)
+        self.assertEqual(sizes[1], 1, "one interned {double, int} pair")
+
+    def test_stream_scopes(self):
+        # same struct tag in two scopes, referenced before its definition
+        sigs = []
+        for members in ('int x', 'double x; double y'):
+            tu = self.ts.new_scope()
+            sig = tu.parse('void(struct foo*, struct foo)')
+            sig.fingerprint
+            tu.parse('struct foo {%s}' % members)
+            sigs.append(sig)
+        streamed = list(self.ti.iter_abi_info(sigs))
+        for sig, result in zip(sigs, streamed):
+            expected = self.ti.compute_abi_info(sig)
+            self.assertEqual(str(result.arg_infos[1]),
+                             str(expected.arg_infos[1]))
+        self.assertNotEqual(str(streamed[0].arg_infos[1]),
+                            str(streamed[1].arg_infos[1]))
+
+class TestABI_X86_64_Return(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+
+    def classify(self, retty, args=()):
+        fnty = self.ts.get_function(retty, list(args))
+        abi = self.ti.compute_abi_info(fnty)
+        print(abi)
+        plan = abi.call_plan
+        return abi, [plan.location(i) for i in plan.parts_of(RETURN_ARG)]
+
+    def test_scalars(self):
+        ts = self.ts
+        abi, regs = self.classify(ts.get_char())
+        self.assertTrue(abi.return_info.is_extend)
+        self.assertEqual(regs, ['rax'])
+        abi, regs = self.classify(ts.get_double())
+        self.assertTrue(abi.return_info.is_direct)
+        self.assertEqual(regs, ['xmm0'])
+
+    def test_pairs(self):
+        ts = self.ts
+        ints = ts.get_unnamed_struct([('a', ts.get_long()),
+                                      ('b', ts.get_long())])
+        abi, regs = self.classify(ints)
+        self.assertEqual(regs, ['rax', 'rdx'])
+        doubles = ts.get_unnamed_struct([('a', ts.get_double()),
+                                         ('b', ts.get_double())])
+        abi, regs = self.classify(doubles)
+        self.assertEqual(regs, ['xmm0', 'xmm1'])
+        mixed = ts.get_unnamed_struct([('a', ts.get_double()),
+                                       ('b', ts.get_long())])
+        abi, regs = self.classify(mixed)
+        self.assertEqual(regs, ['xmm0', 'rax'])
+        self.assertTrue(abi.return_info.coerce_type.is_struct)
+        abi, regs = self.classify(ts.get_complex(ts.get_double()))
+        self.assertEqual(regs, ['xmm0', 'xmm1'])
+
+    def test_sret(self):
+        ts = self.ts
+        big = ts.get_unnamed_struct([('a', ts.get_long()),
+                                     ('b', ts.get_long()),
+                                     ('c', ts.get_long())])
+        args = [ts.get_long()] * 6
+        abi, regs = self.classify(big, args)
+        self.assertTrue(abi.return_info.is_indirect)
+        self.assertFalse(abi.return_info.byval)
+        self.assertEqual(regs, ['rax'])
+        plan = abi.call_plan
+        self.assertEqual([plan.location(i) for i in plan.parts_of(SRET_ARG)],
+                         ['rdi'])
+        # the hidden pointer takes a register from the arguments
+        self.assertEqual([plan.location(i) for i in plan.parts_of(5)],
+                         ['stack+0'])
+
+    def test_x87(self):
+        ts = self.ts
+        abi, regs = self.classify(ts.get_complex(ts.get_longdouble()))
+        self.assertTrue(abi.return_info.is_direct)
+        self.assertEqual(regs, ['st0', 'st1'])
+
+class TestABI_X86_64_Complex(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+
+    def test_complex_args(self):
+        ts = self.ts
+        cf = ts.get_complex(ts.get_float())
+        cd = ts.get_complex(ts.get_double())
+        cld = ts.get_complex(ts.get_longdouble())
+        ci = ts.get_complex(ts.get_int())
+        fnty = ts.get_function(ts.get_void(), [cf, cd, cld, ci])
+        abi = self.ti.compute_abi_info(fnty)
+        print(abi)
+        self.assertEqual(abi.arg_infos[0].coerce_type,
+                         ts.get_vector(ts.get_float(), 2))
+        self.assertTrue(abi.arg_infos[1].is_direct)
+        self.assertTrue(abi.arg_infos[2].is_indirect)
+        self.assertTrue(abi.arg_infos[3].is_direct)
+        plan = abi.call_plan
+        self.assertEqual([plan.location(i) for i in range(len(plan))],
+                         ['xmm0', 'xmm1', 'xmm2', 'stack+0', 'rdi'])
+        self.assertEqual(self.ti.get_sizeof(cld), 256)
+        self.assertEqual(self.ti.get_align(cd), 64)
+
+    def test_complex_return(self):
+        ts = self.ts
+        for base in (ts.get_float(), ts.get_double()):
+            fnty = ts.get_function(ts.get_complex(base), [])
+            abi = self.ti.compute_abi_info(fnty)
+            print(abi)
+            self.assertTrue(abi.return_info.is_direct)
+        fnty = ts.get_function(ts.get_longdouble(), [ts.get_longdouble()])
+        abi = self.ti.compute_abi_info(fnty)
+        print(abi)
+        self.assertTrue(abi.return_info.is_direct)
+        plan = abi.call_plan
+        self.assertEqual([plan.location(i) for i in plan.parts_of(0)],
+                         ['stack+0'])
+        self.assertEqual([plan.location(i) for i in plan.parts_of(RETURN_ARG)],
+                         ['st0'])
+
+class TestABI_X86_64_AVX(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+
+    def classify(self, *args):
+        fnty = self.ts.get_function(self.ts.get_void(), list(args))
+        abi = self.ti.compute_abi_info(fnty)
+        print(abi)
+        return abi
+
+    def test_sse_vectors(self):
+        v2f = self.ts.get_vector(self.ts.get_float(), 2)
+        v4f = self.ts.get_vector(self.ts.get_float(), 4)
+        v8f = self.ts.get_vector(self.ts.get_float(), 8)
+        abi = self.classify(v2f, v4f, v8f)
+        self.assertTrue(abi.arg_infos[0].is_direct)
+        self.assertEqual(abi.arg_infos[0].coerce_type, v2f.type)
+        self.assertTrue(abi.arg_infos[1].is_direct)
+        self.assertEqual(abi.arg_infos[1].coerce_type, v4f.type)
+        # no AVX: __m256 goes in memory
+        self.assertTrue(abi.arg_infos[2].is_indirect)
+        plan = abi.call_plan
+        self.assertEqual([plan.location(i) for i in range(len(plan))],
+                         ['xmm0', 'xmm1', 'stack+0'])
+
+    def test_avx(self):
+        self.ti.set_avx_level(self.ti.AVX)
+        v8f = self.ts.get_vector(self.ts.get_float(), 8)
+        v8d = self.ts.get_vector(self.ts.get_double(), 8)
+        wrapped = self.ts.get_unnamed_struct([('v', v8f)])
+        abi = self.classify(v8f, wrapped, v8d)
+        self.assertTrue(abi.arg_infos[0].is_direct)
+        self.assertEqual(abi.arg_infos[0].coerce_type, v8f.type)
+        self.assertTrue(abi.arg_infos[1].is_direct)
+        self.assertEqual(abi.arg_infos[1].coerce_type, v8f.type)
+        self.assertTrue(abi.arg_infos[2].is_indirect)
+        plan = abi.call_plan
+        self.assertEqual(plan.location(0), 'ymm0')
+        self.assertEqual(plan.size[0], 32)
+        self.assertEqual(plan.location(1), 'ymm1')
+
+        # rule 5c after a vector; SSEUP is post-merged to SSE
+        st = self.ts.parse('struct {<8 x float> v; struct {} e}')
+        abi = self.classify(st)
+        self.assertTrue(abi.arg_infos[0].is_indirect)
+        abi = self.ti.compute_abi_info(self.ts.get_function(st, []))
+        self.assertTrue(abi.return_info.is_indirect)
+        C = X86_64ABIClasses
+        self.assertEqual(llcc.abi.X86_64ABIInfo(self.ti).classify(st.type, 0),
+                         (C.SSE, C.MEMORY))
+
+    def test_avx512(self):
+        self.ti.set_avx_level(self.ti.AVX512)
+        v16f = self.ts.get_vector(self.ts.get_float(), 16)
+        abi = self.classify(v16f)
+        self.assertTrue(abi.arg_infos[0].is_direct)
+        self.assertEqual(abi.call_plan.location(0), 'zmm0')
+        self.assertRaises(ValueError, self.ti.set_avx_level, 3)
+
+class TestABI_X86_64_Internal(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+
+    def test_expand(self):
+        fnty = self.ts.parse('void(struct {float x; int y; double z}, '
+                             'struct {double a; double b; double c}, '
+                             'struct {char c[8]})')
+        abi = self.ti.compute_abi_info(fnty, internal=True)
+        print(abi)
+        first, second, third = abi.arg_infos
+        self.assertTrue(first.is_expand)
+        self.assertEqual([off for off, _ in first.leaves], [0, 4, 8])
+        # MEMORY class under the ABI
+        self.assertTrue(second.is_expand)
+        # too many leaves
+        self.assertFalse(third.is_expand)
+        plan = abi.call_plan
+        self.assertEqual([plan.location(i) for i in plan.parts_of(0)],
+                         ['xmm0', 'rdi', 'xmm1'])
+        self.assertEqual([plan.location(i) for i in plan.parts_of(1)],
+                         ['xmm2', 'xmm3', 'xmm4'])
+
+        self.assertFalse(any(info.is_expand for info in
+                             self.ti.compute_abi_info(fnty).arg_infos))
+
+    def test_exhausted(self):
+        big = 'struct {double a; double b; double c}'
+        abi = self.ti.compute_abi_info('void(%s, %s, %s)' % (big, big, big),
+                                       internal=True)
+        print(abi)
+        self.assertTrue(abi.arg_infos[0].is_expand)
+        self.assertTrue(abi.arg_infos[1].is_expand)
+        # only two xmm registers left
+        self.assertTrue(abi.arg_infos[2].is_indirect)
+
+    def test_const_indirect(self):
+        big = 'struct {double a[8]}'
+        sig = 'void(const %s, %s, int, int, int, int, int, const %s)' % (
+              big, big, big)
+        abi = self.ti.compute_abi_info(sig, internal=True)
+        print(abi)
+        first, second = abi.arg_infos[:2]
+        last = abi.arg_infos[-1]
+        self.assertTrue(first.is_indirect and first.elide_copy)
+        self.assertFalse(first.byval)
+        # may be modified by the callee
+        self.assertTrue(second.byval and not second.elide_copy)
+        plan = abi.call_plan
+        self.assertEqual([plan.location(i) for i in plan.parts_of(0)],
+                         ['rdi'])
+        self.assertEqual(plan.size[plan.parts_of(1)[0]], 64)
+        # out of registers; the pointer goes on the stack
+        self.assertTrue(last.elide_copy)
+        self.assertEqual([plan.location(i) for i in plan.parts_of(7)],
+                         ['stack+64'])
+        self.assertEqual(plan.stack_size, 72)
+
+        # the platform ABI always copies
+        self.assertFalse(any(getattr(info, 'elide_copy', False) for info in
+                             self.ti.compute_abi_info(sig).arg_infos))
+
+class TestABI_X86_32(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+
+    def compute(self, sig, internal=False):
+        abi = llcc.abi.ABIInfo.get_class('SystemV/x86')(self.ti, internal)
+        abi.compute_info(self.ts.parse(sig).type)
+        print(abi)
+        return abi
+
+    def test_expand(self):
+        abi = self.compute('int32_t(struct {int32_t i; float f}, '
+                           'struct {double a; double b}, '
+                           'struct {char c; int32_t i}, '
+                           'struct {int32_t a[5]}, int8_t)')
+        pair, doubles, chars, big, byte = abi.arg_infos
+        self.assertTrue(pair.is_expand)
+        self.assertTrue(doubles.is_expand)
+        # stack image would differ
+        self.assertTrue(chars.is_indirect)
+        self.assertTrue(big.is_indirect)
+        self.assertEqual(big.align, 4)
+        self.assertTrue(byte.is_extend)
+
+        plan = abi.call_plan
+        self.assertEqual([plan.location(i) for i in plan.parts_of(0)],
+                         ['stack+0', 'stack+4'])
+        self.assertEqual([plan.location(i) for i in plan.parts_of(1)],
+                         ['stack+8', 'stack+16'])
+        self.assertEqual([plan.location(i) for i in plan.parts_of(4)],
+                         ['stack+52'])
+        self.assertEqual(plan.stack_size, 56)
+        self.assertEqual([plan.location(i) for i in plan.parts_of(RETURN_ARG)],
+                         ['eax'])
+
+    def test_returns(self):
+        abi = self.compute('struct {int32_t a; int32_t b}(<4 x float>, '
+                           'struct {int64_t a; int64_t b; int64_t c})')
+        self.assertTrue(abi.return_info.is_indirect)
+        self.assertTrue(abi.arg_infos[1].realign)
+        plan = abi.call_plan
+        self.assertEqual([plan.location(i) for i in plan.parts_of(SRET_ARG)],
+                         ['stack+0'])
+        self.assertEqual([plan.location(i) for i in plan.parts_of(0)],
+                         ['xmm0'])
+        self.assertEqual(self.compute('double(void)').call_plan.location(0),
+                         'st0')
+        plan = self.compute('int64_t(void)').call_plan
+        self.assertEqual([plan.location(i) for i in range(len(plan))],
+                         ['eax', 'edx'])
+
+    def test_const_indirect(self):
+        sig = 'void(const struct {int32_t a[5]}, struct {int32_t a[5]}, int)'
+        abi = self.compute(sig, internal=True)
+        info = abi.arg_infos[0]
+        self.assertTrue(info.elide_copy and not info.byval)
+        plan = abi.call_plan
+        # a pointer, then a 20-byte copy
+        ptrsize = self.ti.ptrsize // 8
+        self.assertEqual([plan.size[i] for i in range(len(plan))],
+                         [ptrsize, 20, 4])
+        self.assertEqual(plan.stack_size, ptrsize + 24)
+        self.assertFalse(self.compute(sig).arg_infos[0].elide_copy)
+
+class TestX86_64ABIClasses(unittest.TestCase):
+    def test_codes(self):
+        C = X86_64ABIClasses
+        self.assertEqual(list(C.classes), list(range(len(C.classes))))
+        self.assertEqual(str(C.SSEUP), 'sseup')
+        self.assertEqual(C.names[C.MEMORY], 'memory')
+
+    def test_merge_table(self):
+        C = X86_64ABIClasses
+        def merge(a, b):
+            return MERGE_TABLE[a << 3 | b]
+        for c in C.classes:
+            self.assertTrue(merge(C.NO_CLASS, c) is c)
+            self.assertTrue(merge(C.MEMORY, c) is C.MEMORY)
+        self.assertTrue(merge(C.SSE, C.INTEGER) is C.INTEGER)
+        self.assertTrue(merge(C.INTEGER, C.SSE) is C.INTEGER)
+        self.assertTrue(merge(C.SSE, C.SSE) is C.SSE)
+        self.assertTrue(merge(C.SSE, C.X87) is C.MEMORY)
+        self.assertTrue(merge(C.X87, C.SSE) is C.MEMORY)
+
+    def test_postmerge_table(self):
+        C = X86_64ABIClasses
+        table = POSTMERGE_TABLES[True]
+        def postmerge(lo, hi, big=False):
+            return table[big << 6 | lo << 3 | hi]
+        self.assertEqual(postmerge(C.INTEGER, C.MEMORY), (C.MEMORY, C.MEMORY))
+        self.assertEqual(postmerge(C.SSE, C.X87UP), (C.MEMORY, C.X87UP))
+        self.assertEqual(postmerge(C.X87, C.X87UP), (C.X87, C.X87UP))
+        self.assertEqual(postmerge(C.INTEGER, C.SSEUP), (C.INTEGER, C.SSE))
+        self.assertEqual(postmerge(C.SSE, C.SSEUP, True), (C.SSE, C.SSEUP))
+        self.assertEqual(postmerge(C.SSE, C.SSE, True), (C.MEMORY, C.SSE))
+        self.assertEqual(postmerge(C.INTEGER, C.SSEUP, True),
+                         (C.MEMORY, C.SSE))
+
+        rules = POSTMERGE_RULES[True]
+        self.assertEqual(rules[C.INTEGER << 3 | C.MEMORY], ('5a',))
+        self.assertEqual(rules[1 << 6 | C.INTEGER << 3 | C.SSEUP],
+                         ('5c', '5d'))
+        self.assertEqual(rules[C.SSE << 3 | C.SSE], ())
+
+class TestX86_64Classifier(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+        ts = self.ts
+        self.leaves = [ts.get_char(), ts.get_short(), ts.get_int(),
+                       ts.get_uint(64), ts.get_float(), ts.get_double(),
+                       ts.parse('long double'), ts.get_pointer(ts.get_int()),
+                       ts.get_complex(ts.get_float()),
+                       ts.get_complex(ts.get_double()),
+                       ts.get_vector(ts.get_char(), 4),
+                       ts.get_vector(ts.get_float(), 2),
+                       ts.get_vector(ts.get_float(), 4),
+                       ts.get_vector(ts.get_double(), 4)]
+
+    def random_type(self, rng, depth=0):
+        ts = self.ts
+        r = rng.random()
+        if depth > 2 or r < 0.5:
+            return rng.choice(self.leaves)
+        elif r < 0.65:
+            return ts.get_array(self.random_type(rng, depth + 1),
+                                rng.randint(0, 4))
+        members = []
+        bitfields = rng.random() < 0.3
+        for i in range(rng.randint(0, 5)):
+            if bitfields and rng.random() < 0.5:
+                width = rng.randint(0, 9)
+                name = 'f%d' % i if width and rng.random() < 0.8 else ''
+                members.append((name, ts.get_int(), width))
+            else:
+                members.append(('f%d' % i, self.random_type(rng, depth + 1)))
+        attrs = {}
+        if rng.random() < 0.2:
+            attrs['packed'] = True
+        if rng.random() < 0.1:
+            attrs['align'] = rng.choice([2, 16, 32])
+        return ts.get_unnamed_struct(members, **attrs)
+
+    def classify(self, cls, ty):
+        classifier = cls(self.ti, ty.type, 0)
+        classifier.classify()
+        return classifier.lo, classifier.hi
+
+    def test_equivalence(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            ty = self.random_type(rng)
+            self.assertEqual(self.classify(X86_64Classifier, ty),
+                             self.classify(RecursiveClassifier, ty), str(ty))
+
+    def test_many_fields(self):
+        C = X86_64ABIClasses
+        ts = self.ts
+        flags = ts.get_unnamed_struct([('f%d' % i, ts.get_uint(8), 1)
+                                       for i in range(512)])
+        # more than two eightbytes (rule 5c)
+        self.assertEqual(self.classify(X86_64Classifier, flags),
+                         (C.MEMORY, C.NO_CLASS))
+        small = ts.get_unnamed_struct([('f%d' % i, ts.get_uint(8), 1)
+                                       for i in range(128)])
+        self.assertEqual(self.classify(X86_64Classifier, small),
+                         (C.INTEGER, C.INTEGER))
+        nested = ts.get_unnamed_struct([ts.get_array(small, 1)])
+        self.assertEqual(self.classify(X86_64Classifier, nested),
+                         (C.INTEGER, C.INTEGER))
+
+class TestTracer(unittest.TestCase):
+    def test_trace(self):
+        ti = TargetInfo.get_host_target()
+        sig = 'void(struct{float;float;double}, struct{double a[3]})'
+        with trace() as tracer:
+            ti.compute_abi_info(sig)
+        print(tracer)
+        self.assertTrue(llcc.abi._tracing.tracer is None)
+        kinds = set(kind for _, kind, _ in tracer.events)
+        self.assertTrue(set(['function', 'classify', 'field', 'merge',
+                             'memory', 'time']) <= kinds)
+        self.assertTrue(any(depth > 0 for depth, _, _ in tracer.events))
+
+        # untraced calls record nothing
+        count = len(tracer.events)
+        ti.compute_abi_info(sig)
+        self.assertEqual(len(tracer.events), count)
+
+    def test_exhausted(self):
+        ti = TargetInfo.get_host_target()
+        with trace() as tracer:
+            ti.compute_abi_info('void(%s)' % ', '.join(['long'] * 7))
+        msgs = [msg for _, kind, msg in tracer.events if kind == 'exhausted']
+        self.assertEqual(len(msgs), 1)
+        self.assertTrue(msgs[0].startswith('arg 6'))
+
+    def test_threads(self):
+        ti = TargetInfo.get_host_target()
+        ti.freeze()
+        other = []
+
+        def classify():
+            with trace() as tracer:
+                ti.compute_abi_info('void(float)')
+            other.append(tracer)
+
+        with trace() as tracer:
+            ti.compute_abi_info('void(double)')
+            thread = threading.Thread(target=classify)
+            thread.start()
+            thread.join()
+            # untraced in another thread
+            thread = threading.Thread(target=ti.compute_abi_info,
+                                      args=('void(int)',))
+            thread.start()
+            thread.join()
+        functions = lambda t: [msg for _, kind, msg in t.events
+                               if kind == 'function']
+        self.assertEqual(functions(tracer), ['void(double)'])
+        self.assertEqual(functions(other[0]), ['void(float)'])
+
+    def test_main(self):
+        self.assertEqual(llcc.abi.main(['explain', 'int(double)']), 0)
+        self.assertEqual(llcc.abi.main([]), 2)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,254 @@
+from __future__ import print_function
+import unittest
+import llvm.core
+from llcc.target import TargetInfo
+from llcc.codegen import Module
+
+class TestCallLoop(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+        self.mod = Module(self.ti, 'test')
+
+    def test_struct_types(self):
+        ts = self.ts
+        st = ts.parse('struct rec {char c; double d; int a[3]}')
+        lty = self.mod.get_llvm_type(st)
+        print(lty)
+        self.assertTrue(lty is self.mod.get_llvm_type(st), "memoized")
+        lowering = self.mod.get_struct_lowering(st)
+        self.assertFalse(lowering.packed)
+        self.assertEqual(lowering.elements, {'c': 0, 'd': 1, 'a': 2})
+
+        node = ts.get_struct('node')
+        ts.get_struct('node', [('value', ts.get_int()),
+                               ('next', ts.get_pointer(node))])
+        self.assertEqual(self.mod.get_struct_lowering(node).elements,
+                         {'value': 0, 'next': 1})
+
+    def test_struct_defined_later(self):
+        ts = self.ts
+        ptr = self.mod.get_llvm_type(ts.parse('struct later*'))
+        opaque = self.mod.get_struct_lowering(ts.get_struct('later'))
+        self.assertFalse(opaque.is_complete)
+        st = ts.parse('struct later {int a; double b}')
+        lowering = self.mod.get_struct_lowering(st)
+        self.assertTrue(lowering is opaque)
+        self.assertTrue(lowering.is_complete)
+        self.assertEqual(lowering.elements, {'a': 0, 'b': 1})
+        self.assertTrue(self.mod.get_llvm_type(st) is ptr.pointee)
+
+    def test_bitfield_types(self):
+        ts = self.ts
+        st = ts.parse('struct bits {unsigned char tag; unsigned a : 4; '
+                      'unsigned b : 12; double d}')
+        lowering = self.mod.get_struct_lowering(st)
+        print(lowering.type)
+        self.assertEqual(str(lowering.type.elements[1]), '[2 x i8]')
+        self.assertEqual(lowering.elements, {'tag': 0, 'd': 2})
+        self.assertEqual(lowering.align, 8)
+
+        # the LLVM type of `flags` is less aligned than the C type
+        flags = ts.parse('struct flags {unsigned a : 3}')
+        self.assertEqual(self.mod.get_struct_lowering(flags).align, 1)
+        outer = ts.parse('struct outer {char c; struct flags f}')
+        self.assertEqual(self.mod.get_struct_lowering(outer).elements,
+                         {'c': 0, 'f': 2})
+        self.assertRaises(TypeError, self.mod.offsetof, st, 'a')
+
+    def test_packed_types(self):
+        ts = self.ts
+        hdr = ts.parse('struct __attribute__((packed)) hdr {char c; int i}')
+        lowering = self.mod.get_struct_lowering(hdr)
+        print(lowering.type)
+        self.assertTrue(lowering.packed)
+        self.assertEqual([str(e) for e in lowering.type.elements],
+                         ['i8', 'i32'])
+        line = ts.parse('struct line {int i} __attribute__((aligned(64)))')
+        lowering = self.mod.get_struct_lowering(line)
+        print(lowering.type)
+        self.assertFalse(lowering.packed)
+        self.assertEqual(str(lowering.type.elements[-1]), '[60 x i8]')
+
+    def test_layout_constants(self):
+        ts = self.ts
+        st = ts.parse('struct outer {char c; struct {int i; double d} in; '
+                      'float f}')
+        self.assertEqual(self.mod.sizeof(st).z_ext_value, 32)
+        self.assertEqual(self.mod.alignof(st).z_ext_value, 8)
+        self.assertEqual(self.mod.offsetof(st, 'in').z_ext_value, 8)
+        self.assertEqual(self.mod.offsetof(st, 'in.d').z_ext_value, 16)
+        self.assertEqual(self.mod.offsetof(st, 'f').z_ext_value, 24)
+        self.assertEqual(self.mod.sizeof(ts.get_double()).z_ext_value, 8)
+        self.assertRaises(NameError, self.mod.offsetof, st, 'x')
+        self.assertRaises(TypeError, self.mod.offsetof, st, 'c.x')
+
+    def test_field_access(self):
+        ts = self.ts
+        st = ts.parse('struct pt {float x; float y}')
+        fnty = ts.parse('void(struct pt*)')
+        fn = self.mod.declare_function(fnty, 'swap')
+        fn.append_basic_block('entry')
+        builder = llvm.core.Builder.new(fn.basic_blocks[0])
+        ptr = builder.bitcast(fn.args[0], llvm.core.Type.pointer(
+                                            self.mod.get_llvm_type(st)))
+        x = self.mod.load_field(builder, ptr, st, 'x')
+        y = self.mod.load_field(builder, ptr, st, 'y')
+        self.mod.store_field(builder, y, ptr, st, 'x')
+        self.mod.store_field(builder, x, ptr, st, 'y')
+        builder.ret_void()
+        print(fn)
+        self.assertRaises(KeyError, self.mod.gep_field, builder, ptr, st, 'z')
+
+    def test_lowering(self):
+        fty = self.ts.get_float()
+        pair = self.ts.get_unnamed_struct([('a', fty), ('b', fty)])
+        args = [self.ts.get_char(), pair, self.ts.get_double()]
+        fnty = self.ts.get_function(self.ts.get_void(), args)
+        lowering = self.mod.get_call_lowering(fnty)
+        print(lowering.type)
+        self.assertEqual(lowering.arg_params, [(0, 1), (1, 1), (2, 1)])
+        self.assertFalse(lowering.has_sret)
+        self.assertIs(lowering, self.mod.get_call_lowering(fnty))
+
+    def test_call_loop(self):
+        fty = self.ts.get_float()
+        pair = self.ts.get_unnamed_struct([('a', fty), ('b', fty)])
+        args = [pair, self.ts.get_int()]
+        fnty = self.ts.get_function(self.ts.get_void(), args)
+        kernel = self.mod.add_call_loop(fnty, 'consume', 'consume_loop')
+        print(self.mod.ir)
+        kernel.verify()
+        self.assertEqual(len(kernel.args), 1 + len(args))
+        self.assertIn('call void @consume', str(kernel))
+
+    def test_call_loop_odd_sizes(self):
+        # 3- and 6-byte structs are coerced to wider integers
+        fnty = self.ts.parse('struct {char a; char b; char c}'
+                             '(struct {char a; char b; char c}, '
+                             'struct {char a[6]}, int)')
+        lowering = self.mod.get_call_lowering(fnty)
+        oversized = [lowering.is_oversized(a.type, info) for a, info in
+                     zip(fnty.type.args, lowering.abi.arg_infos)]
+        self.assertEqual(oversized, [True, True, False])
+        kernel = self.mod.add_call_loop(fnty, 'odd', 'odd_loop')
+        print(kernel)
+        kernel.verify()
+        entry, cond, body, exit = kernel.basic_blocks
+        allocas = lambda bb: [i for i in bb.instructions
+                              if i.opcode_name == 'alloca']
+        # arguments and result go through slots allocated once
+        self.assertEqual(len(allocas(entry)), 3)
+        self.assertEqual(allocas(body), [])
+
+    def test_aligned_struct(self):
+        ts = self.ts
+        big = ts.get_unnamed_struct([ts.get_double()] * 3, align=32)
+        small = ts.get_unnamed_struct([ts.get_double()], align=16)
+        fnty = ts.get_function(small, [big, small])
+        lowering = self.mod.get_call_lowering(fnty)
+        info = lowering.abi.arg_infos[0]
+        self.assertTrue(info.byval)
+        self.assertEqual(info.align, 32)
+        self.assertEqual(lowering.param_aligns, [(0, 32)])
+        fn = lowering.declare('aligned')
+        self.assertEqual(fn.args[0].alignment, 32)
+
+        body = self.mod.add_function(fnty, 'aligned_def')
+        # the slots of the struct aligned(16) argument and result
+        allocas = [i for i in body.function.basic_blocks[0].instructions
+                   if i.opcode_name == 'alloca']
+        self.assertEqual([a.alignment for a in allocas], [16, 16])
+
+    def test_add_function(self):
+        ts = self.ts
+        fnty = ts.parse('struct {double a; double b}(struct {float x; '
+                        'float y; float z}, int8_t)')
+        body = self.mod.add_function(fnty, 'f')
+        self.assertEqual(len(body.args), 2)
+        body.builder.store(body.builder.load(body.args[1]),
+                           body.builder.bitcast(body.retval,
+                                                llvm.core.Type.pointer(
+                                                    llvm.core.Type.int(8))))
+        body.ret()
+        print(body.function)
+        body.function.verify()
+        self.assertIsNone(body.function.linkage)
+
+    def test_internal_function(self):
+        ts = self.ts
+        fnty = ts.parse('double(struct {double a; double b; double c})')
+        body = self.mod.add_function(fnty, 'norm', internal=True)
+        self.mod.mark_adapter(body.function)
+        lowering = body.lowering
+        self.assertEqual(lowering.arg_params, [(0, 3)])
+        self.assertEqual(body.function.linkage, llvm.core.LINKAGE_INTERNAL)
+        x = self.mod.load_field(body.builder, body.args[0], fnty.type.args[0],
+                                'a')
+        body.builder.store(x, body.retval)
+        body.ret()
+        print(body.function)
+        self.assertNotEqual(lowering.type,
+                            self.mod.get_call_lowering(fnty).type)
+
+        # callers pass the leaves
+        caller = self.mod.add_function(ts.parse('double(struct {double a; '
+                                                'double b; double c}*)'),
+                                       'caller')
+        ptr = caller.builder.load(caller.args[0])
+        args = lowering.load_args(caller.builder, [ptr])
+        self.assertEqual(len(args), 3)
+        result = lowering.call(caller.builder, body.function, args)
+        caller.builder.store(result, caller.retval)
+        caller.ret()
+        print(caller.function)
+        caller.function.verify()
+
+    def test_const_indirect(self):
+        ts = self.ts
+        fnty = ts.parse('double(const struct {double a[8]})')
+        body = self.mod.add_function(fnty, 'first', internal=True)
+        lowering = body.lowering
+        self.assertTrue(lowering.abi.arg_infos[0].elide_copy)
+        self.assertEqual(lowering.param_attrs, [(0, llvm.core.ATTR_READONLY)])
+        # the callee reads the caller's object
+        self.assertTrue(body.args[0] is body.function.args[0])
+        body.builder.store(body.builder.load(body.builder.bitcast(
+                                body.args[0],
+                                llvm.core.Type.pointer(llvm.core.Type.double()))),
+                           body.retval)
+        body.ret()
+        print(body.function)
+
+        external = self.mod.get_call_lowering(fnty)
+        self.assertEqual(external.param_attrs, [(0, llvm.core.ATTR_BY_VAL)])
+
+    def test_optimize(self):
+        fnty = self.ts.parse('double(double, struct{float;float})')
+        self.mod.add_call_loop(fnty, 'f', 'f_loop')
+        report = self.mod.optimize(2)
+        print(report)
+        self.assertEqual(list(report.before), ['f_loop'])
+        self.assertTrue(report.total_after <= report.total_before)
+        self.assertEqual(self.mod.optimize(0).total_after,
+                         report.total_after)
+        self.assertRaises(ValueError, self.mod.optimize, 9)
+
+    def test_emit_object_level(self):
+        fnty = self.ts.parse('double(double, struct{float;float})')
+        self.mod.add_call_loop(fnty, 'f', 'f_loop')
+        ir = str(self.mod.ir)
+        keys = []
+        class Cache(object):
+            def get_or_compile(self, ir, triple, opt_level, compile):
+                keys.append((ir, opt_level))
+                return compile()
+        obj = self.mod.emit_object(Cache(), opt_level=2)
+        self.assertTrue(obj)
+        self.assertEqual(keys, [(ir, 2)])
+        # a copy was optimized, the module is left alone
+        self.assertEqual(str(self.mod.ir), ir)
+        self.assertRaises(ValueError, self.mod.emit_object, Cache(), 9)
+
+if __name__ == '__main__':
+    unittest.main()
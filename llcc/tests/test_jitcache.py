@@ -0,0 +1,73 @@
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+from llcc.jitcache import ObjectCache, cache_key, _replace
+
+class TestObjectCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key(self):
+        k = cache_key('define void @f()', 'x86_64-unknown-linux-gnu', 2)
+        self.assertEqual(len(k), 64)
+        self.assertNotEqual(k, cache_key('define void @f()',
+                                         'x86_64-unknown-linux-gnu', 3))
+        self.assertNotEqual(k, cache_key('define void @f()',
+                                         'i686-unknown-linux-gnu', 2))
+
+    def test_get_or_compile(self):
+        cache = ObjectCache(self.directory)
+        calls = []
+        def compile():
+            calls.append(1)
+            return b'\x7fELF object'
+        ir = 'define void @f() { ret void }'
+        obj = cache.get_or_compile(ir, 'x86_64', 2, compile)
+        self.assertEqual(obj, b'\x7fELF object')
+        # another process sharing the directory
+        other = ObjectCache(self.directory)
+        self.assertEqual(other.get_or_compile(ir, 'x86_64', 2, compile), obj)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((cache.misses, other.hits), (1, 1))
+        other.get_or_compile(ir, 'x86_64', 0, compile)
+        self.assertEqual(len(calls), 2)
+
+    def test_put_existing(self):
+        # two processes filling the same entry
+        cache = ObjectCache(self.directory)
+        cache.put('k', b'object')
+        cache.put('k', b'object')
+        self.assertEqual(cache.get('k'), b'object')
+        self.assertEqual(os.listdir(self.directory), ['k.o'])
+
+        # the fallback for python 2, where rename may not overwrite
+        src = os.path.join(self.directory, 'k.tmp')
+        with open(src, 'wb') as fobj:
+            fobj.write(b'object')
+        _replace(src, cache.path('k'))
+        self.assertEqual(os.listdir(self.directory), ['k.o'])
+        self.assertRaises(OSError, _replace, src, cache.path('missing'))
+
+    def test_eviction(self):
+        cache = ObjectCache(self.directory)
+        for i in range(3):
+            cache.put('k%d' % i, b'x' * 100)
+            # distinct ages, oldest first
+            os.utime(cache.path('k%d' % i), (1000 + i, 1000 + i))
+        cache.get('k0')     # k0 becomes the most recently used
+        cache.max_size = 250
+        cache.evict()
+        print(cache.entries())
+        self.assertTrue(cache.get('k1') is None)
+        self.assertEqual(cache.get('k0'), b'x' * 100)
+        self.assertTrue(cache.size() <= 250)
+        cache.clear()
+        self.assertEqual(cache.size(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+from __future__ import print_function
+import unittest
+from llcc.target import TargetInfo
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+else:
+    from llcc.numpy_support import to_dtype, from_dtype
+
+@unittest.skipIf(np is None, "requires numpy")
+class TestNumpySupport(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+
+    def test_to_dtype(self):
+        ts = self.ts
+        st = ts.get_struct('rec', [('tag', ts.get_char()),
+                                   ('value', ts.get_double()),
+                                   ('xy', ts.get_array(ts.get_float(), 2))])
+        dt = to_dtype(st, self.ti)
+        print(dt)
+        self.assertTrue(dt is to_dtype(st, self.ti), "cached")
+        self.assertEqual(dt.itemsize, 24)
+        self.assertEqual(dt.fields['value'][1], 8)
+        self.assertEqual(dt.fields['xy'][1], 16)
+        self.assertEqual(dt.fields['xy'][0].shape, (2,))
+
+        self.assertEqual(dt.alignment, 8)
+        packed = ts.get_unnamed_struct([ts.get_char(), ts.get_double()],
+                                       packed=True)
+        self.assertEqual(to_dtype(packed, self.ti).alignment, 1)
+        # alignment beyond the fields is lost, the layout is not
+        line = ts.get_unnamed_struct([ts.get_double()], align=64)
+        dt64 = to_dtype(line, self.ti)
+        self.assertEqual((dt64.itemsize, dt64.alignment), (64, 8))
+
+        buf = bytearray(dt.itemsize * 3)
+        arr = np.frombuffer(buf, dtype=dt)
+        arr['value'][1] = 2.5
+        self.assertEqual(np.frombuffer(bytes(buf[32:40]), np.float64)[0], 2.5)
+
+    def test_complex(self):
+        ts = self.ts
+        st = ts.get_unnamed_struct([('z', ts.get_complex(ts.get_double())),
+                                    ('w', ts.get_complex(ts.get_float()))])
+        dt = to_dtype(st, self.ti)
+        print(dt)
+        self.assertEqual(dt.fields['z'][0], np.complex128)
+        self.assertEqual(dt.fields['w'][0], np.complex64)
+        self.assertEqual(dt.itemsize, 24)
+        self.assertEqual(from_dtype(dt, self.ti).fingerprint, st.fingerprint)
+
+    def test_from_dtype(self):
+        dt = np.dtype({'names': ['a', 'b'], 'formats': ['i1', 'f8'],
+                       'offsets': [0, 16], 'itemsize': 32})
+        st = from_dtype(dt, self.ti)
+        print(st)
+        self.assertTrue(st is from_dtype(dt, self.ti), "cached")
+        self.assertEqual(st.type.get_field_offset('b', self.ti), 16)
+        self.assertEqual(self.ti.get_sizeof(st) // 8, 32)
+        self.assertEqual(to_dtype(st, self.ti).fields['b'][1], 16)
+
+        packed = np.dtype({'names': ['a', 'b'], 'formats': ['i1', 'f8'],
+                           'offsets': [0, 1], 'itemsize': 9})
+        st = from_dtype(packed, self.ti)
+        print(st)
+        self.assertTrue(st.type.packed)
+        self.assertEqual(self.ti.get_sizeof(st) // 8, 9)
+        self.assertEqual(to_dtype(st, self.ti), packed)
+
+        overlap = np.dtype({'names': ['a', 'b'], 'formats': ['i4', 'i4'],
+                            'offsets': [0, 2], 'itemsize': 8})
+        self.assertRaises(ValueError, from_dtype, overlap, self.ti)
+
+if __name__ == '__main__':
+    unittest.main()
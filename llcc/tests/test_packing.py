@@ -0,0 +1,73 @@
+from __future__ import print_function
+import struct
+import unittest
+from llcc.target import TargetInfo
+from llcc.packing import ArgPacker, get_packer, type_format
+
+class TestPacking(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+
+    def test_type_format(self):
+        ts = self.ts
+        st = ts.get_unnamed_struct([ts.get_char(), ts.get_double(),
+                                    ts.get_int(16)])
+        fmt = type_format(st, self.ti)
+        print(fmt)
+        self.assertEqual(fmt, 'b7xdh6x')
+        self.assertEqual(struct.calcsize('=' + fmt), 24)
+
+    def test_scalars(self):
+        ts = self.ts
+        fnty = ts.get_function(ts.get_void(), [ts.get_char(), ts.get_int(),
+                                               ts.get_double()])
+        packer = get_packer(self.ti, fnty)
+        self.assertTrue(packer is get_packer(self.ti, fnty), "cached")
+        print(packer.args.format)
+
+        buf = packer.pack(-2, 7, 1.5)
+        # char is promoted to a sign-extended 32-bit int in its slot
+        self.assertEqual(len(buf), 24)
+        self.assertEqual(struct.unpack_from('=i', buf, 0), (-2,))
+        self.assertEqual(struct.unpack_from('=i', buf, 8), (7,))
+        self.assertEqual(struct.unpack_from('=d', buf, 16), (1.5,))
+
+    def test_aggregates(self):
+        ts = self.ts
+        fty = ts.get_float()
+        pair = ts.get_unnamed_struct([fty, fty])        # <2 x float>
+        big = ts.get_unnamed_struct([fty] * 5)          # byval
+        nested = ts.get_unnamed_struct([ts.get_int(), pair])
+        fnty = ts.get_function(ts.get_void(), [pair, big, nested])
+        packer = get_packer(self.ti, fnty)
+        print(packer.args.format)
+
+        buf = bytearray(packer.args.size)
+        packer.pack_into(buf, 0, (1.0, 2.0), (1, 2, 3, 4, 5), (9, (3.0, 4.0)))
+        self.assertEqual(struct.unpack_from('=ff', buf, 0), (1.0, 2.0))
+        self.assertEqual(struct.unpack_from('=5f', buf, 8),
+                         (1.0, 2.0, 3.0, 4.0, 5.0))
+        self.assertEqual(struct.unpack_from('=iff', buf, 32), (9, 3.0, 4.0))
+
+        self.assertRaises(ValueError, packer.pack, (1.0,), (1,) * 5,
+                          (9, (3.0, 4.0)))
+
+    def test_unsupported(self):
+        fnty = self.ts.parse('void(struct {float x; int y; double z}, '
+                             'const struct {char c[40]})')
+        internal = self.ti.compute_abi_info(fnty, internal=True)
+        expand, elided = internal.arg_infos
+        self.assertTrue(expand.is_expand)
+        self.assertTrue(elided.elide_copy)
+        self.assertRaises(TypeError, ArgPacker, self.ti, fnty, internal)
+        single = self.ts.parse('void(const struct {char c[40]})')
+        self.assertRaises(TypeError, ArgPacker, self.ti, single,
+                          self.ti.compute_abi_info(single, internal=True))
+        # the external convention copies both to the buffer
+        packer = ArgPacker(self.ti, fnty)
+        self.assertEqual(packer.slot_align, self.ti.ptrsize // 8)
+        self.assertEqual(packer.arg_offsets, [0, 16])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+from __future__ import print_function
+import mmap
+import struct
+import tempfile
+import unittest
+from llcc.target import TargetInfo
+from llcc.records import record_class, iter_records
+
+class TestRecords(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+        ts = self.ts
+        self.point = ts.get_struct('point', [('x', ts.get_float()),
+                                             ('y', ts.get_float())])
+        self.shape = ts.get_struct('shape',
+                                   [('id', ts.get_int(16)),
+                                    ('origin', self.point),
+                                    ('weights', ts.get_array(ts.get_double(),
+                                                             3))])
+
+    def test_fields(self):
+        Shape = record_class(self.shape, self.ti)
+        self.assertTrue(Shape is record_class(self.shape, self.ti), "cached")
+        self.assertEqual(Shape._size, 40)
+
+        buf = bytearray(Shape._size * 2)
+        rec = Shape(buf, Shape._size)
+        rec.id = 7
+        rec.origin.x = 1.5
+        rec.origin.y = -2.0
+        rec.weights[2] = 4.25
+        print(rec)
+
+        self.assertEqual(struct.unpack_from('=h', buf, 40), (7,))
+        self.assertEqual(struct.unpack_from('=ff', buf, 44), (1.5, -2.0))
+        self.assertEqual(struct.unpack_from('=d', buf, 40 + 32), (4.25,))
+        self.assertEqual(rec._astuple(), (7, (1.5, -2.0), (0.0, 0.0, 4.25)))
+
+        # views share the buffer
+        origin = rec.origin
+        origin.x = 3.0
+        self.assertEqual(rec.origin.x, 3.0)
+
+        rec.weights = [1.0, 2.0, 3.0]
+        self.assertEqual(list(rec.weights), [1.0, 2.0, 3.0])
+        self.assertRaises(IndexError, rec.weights.__getitem__, 3)
+
+    def test_bitfields(self):
+        ts = self.ts
+        st = ts.parse('struct {unsigned char tag; unsigned a : 4; int b : 12; '
+                      'unsigned : 4; unsigned c : 1}')
+        Rec = record_class(st, self.ti)
+        self.assertEqual(Rec._size, 4)
+        self.assertEqual(Rec._fields, ('tag', 'a', 'b', 'c'))
+        buf = bytearray(4)
+        rec = Rec(buf)
+        rec.tag = 0xff
+        rec.a = 0x1f        # truncated
+        rec.b = -3
+        rec.c = 1
+        print(rec)
+        self.assertEqual((rec.tag, rec.a, rec.b, rec.c), (0xff, 0xf, -3, 1))
+        unit, = struct.unpack('=I', bytes(buf))
+        self.assertEqual(unit, 0xff | 0xf << 8 | (-3 & 0xfff) << 12 | 1 << 28)
+
+    def test_packed_bitfields(self):
+        st = self.ts.parse('struct __attribute__((packed)) '
+                           '{unsigned a : 4; unsigned b : 30; char c}')
+        Rec = record_class(st, self.ti)
+        self.assertEqual(Rec._size, 6)
+        buf = bytearray(6)
+        rec = Rec(buf)
+        rec.b = (1 << 30) - 2
+        rec.a = 5
+        rec.c = 120
+        print(rec)
+        self.assertEqual((rec.a, rec.b, rec.c), (5, (1 << 30) - 2, 120))
+        self.assertEqual(bytes(buf), struct.pack('<Q', 5 | ((1 << 30) - 2) << 4
+                                                 | 120 << 40)[:6])
+
+    def test_iter_mmap(self):
+        Point = record_class(self.point, self.ti)
+        with tempfile.TemporaryFile() as fobj:
+            fobj.write(struct.pack('=6f', *range(6)))
+            fobj.flush()
+            mm = mmap.mmap(fobj.fileno(), 0)
+            try:
+                points = list(iter_records(mm, self.point, self.ti))
+                self.assertEqual(len(points), 3)
+                self.assertTrue(all(type(p) is Point for p in points))
+                self.assertEqual([(p.x, p.y) for p in points],
+                                 [(0.0, 1.0), (2.0, 3.0), (4.0, 5.0)])
+                for p in points:
+                    p.x += 10
+                self.assertEqual(struct.unpack_from('=f', mm, 16), (14.0,))
+                del points, p
+            finally:
+                mm.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 from __future__ import print_function
 import unittest
+import threading
 from pprint import pprint
 from ctypes import sizeof, c_void_p
 from llcc.target import TargetInfo
@@ -25,5 +26,165 @@ class TestTargetInfo(unittest.TestCase):
         self.assertEqual(intptr_sizeof, voidptr_sizeof,
                          "void* sizeof == intptr sizeof")
 
+    def test_leaf_index(self):
+        ti = TargetInfo.get_host_target()
+        ts = ti.typesystem
+        st = ts.parse('struct {char c; struct {float x; float y} p; '
+                      'int a[2]; double _Complex z}')
+        index = ti.get_leaf_index(st)
+        print(list(zip(index.starts, index.ends, index.types)))
+        self.assertTrue(index is ti.get_leaf_index(st), "cached")
+        self.assertEqual(len(index), 7)
+        self.assertEqual(list(index.starts), [0, 4, 8, 12, 16, 24, 32])
+        self.assertTrue(index.type_at(8) is ts.get_float().type)
+        self.assertTrue(index.type_at(16) is ts.get_int().type)
+        self.assertTrue(index.type_at(2) is None)
+        self.assertEqual(index.leaf_at(14), 3)
+        self.assertEqual(index.leaf_at(2), None)
+        self.assertTrue(index.no_data(1, 4))
+        self.assertFalse(index.no_data(1, 5))
+        self.assertTrue(index.all_float(4, 12))
+        self.assertFalse(index.all_float(4, 16))
+        self.assertFalse(index.all_float(1, 4))
+        self.assertTrue(st.type.has_type_at_offset(ts.get_float(), 8, ti))
+
+    def test_bitfields(self):
+        ti = TargetInfo.get_host_target()
+        ts = ti.typesystem
+        uint = ts.get_uint(32)
+        st = ts.get_unnamed_struct([('a', uint, 3), ('b', uint, 5),
+                                    ('c', ts.get_uint(8)), ('d', uint, 30),
+                                    ('', uint, 0), ('e', ts.get_uint(8), 1)])
+        layout = ti.get_layout(st)
+        print(layout)
+        # d would straddle its unit; the zero-width bit-field ends a unit
+        self.assertEqual(layout.offsets, (0, 3, 8, 32, 64, 64))
+        self.assertEqual(layout.widths, (3, 5, None, 30, 0, 1))
+        self.assertEqual(ti.get_sizeof(st), 96)
+        self.assertEqual(ti.get_align(st), 32)
+
+        # unnamed bit-fields do not align the struct
+        pad = ts.get_unnamed_struct([('a', ts.get_uint(8), 4),
+                                     ('', ts.get_uint(64), 12)])
+        self.assertEqual(ti.get_layout(pad).size, 16)
+        self.assertEqual(ti.get_align(pad), 8)
+
+        # bit-fields sharing bytes are one leaf
+        index = ti.get_leaf_index(st)
+        self.assertEqual(list(index.starts), [0, 1, 4, 8])
+        self.assertEqual(list(index.ends), [1, 2, 8, 9])
+
+        self.assertRaises(ValueError, ts.get_unnamed_struct, [('a', uint, 33)])
+        self.assertRaises(ValueError, ts.get_unnamed_struct, [('a', uint, 0)])
+        self.assertRaises(TypeError, ts.get_unnamed_struct,
+                          [('f', ts.get_float(), 3)])
+
+    def test_attributes(self):
+        ti = TargetInfo.get_host_target()
+        ts = ti.typesystem
+        # sizes, alignments and offsets in bytes, as given by GCC
+        expect = [
+            ('struct __attribute__((packed)) {char c; int i}',
+             5, 1, [0, 1]),
+            ('struct __attribute__((packed)) {char c; '
+             'int i __attribute__((aligned(2)))}', 6, 2, [0, 2]),
+            ('struct __attribute__((packed)) {unsigned a:4; unsigned b:30}',
+             5, 1, [0, 0]),
+            ('struct __attribute__((packed)) {unsigned a:4; unsigned :0; '
+             'char c}', 5, 1, [0, 4, 4]),
+            ('struct {double d} __attribute__((aligned(32)))', 32, 32, [0]),
+            ('struct {char c; _Alignas(16) int i}', 32, 16, [0, 16]),
+            ('struct {char c; int i __attribute__((aligned(2)))}',
+             8, 4, [0, 4]),
+            ('struct __attribute__((packed, aligned(4))) {char c; int i}',
+             8, 4, [0, 1]),
+            ('struct {char c; struct __attribute__((packed)) '
+             '{char c; int i} in}', 6, 1, [0, 1]),
+        ]
+        for text, size, align, offsets in expect:
+            st = ts.parse(text)
+            print(st)
+            self.assertEqual(ti.get_sizeof(st) // 8, size, text)
+            self.assertEqual(ti.get_align(st) // 8, align, text)
+            self.assertEqual([off // 8 for off in ti.get_field_offsets(st)],
+                             offsets, text)
+
+        self.assertRaises(ValueError, ts.get_unnamed_struct, [ts.get_int()],
+                          align=3)
+        self.assertRaises(NameError, ts.get_unnamed_struct, [ts.get_int()],
+                          field_aligns={'x': 8})
+
+    def test_freeze(self):
+        ti = TargetInfo.get_host_target()
+        ts = ti.typesystem
+        pt = ts.get_struct('point', [('x', ts.get_int()), ('y', ts.get_int())])
+        ti.freeze()
+
+        self.assertTrue(ts.is_frozen)
+        self.assertTrue(ts.get_struct('point') is not None, "lookups work")
+        self.assertRaises(TypeError, ts.get_struct, 'other')
+        self.assertRaises(TypeError, ts.insert_struct, 'point')
+        self.assertRaises(TypeError, pt.type.define, [ts.get_float()])
+        self.assertRaises(TypeError, setattr, ti, 'ptrsize', 32)
+
+    def test_concurrent_readers(self):
+        ti = TargetInfo.get_host_target()
+        ts = ti.typesystem
+        structs = [ts.get_struct('s%d' % i, [ts.get_int()] * (i + 1))
+                   for i in range(50)]
+        ti.freeze()
+
+        expect = [ti.get_sizeof(s) for s in structs]
+        errors = []
+
+        def reader():
+            try:
+                for _ in range(20):
+                    got = [ti.get_sizeof(s) for s in structs]
+                    if got != expect:
+                        errors.append(got)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reader) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_cache_scope(self):
+        ti = TargetInfo.get_host_target()
+        ts = ti.typesystem
+        pt = ts.get_struct('point', [('x', ts.get_int())])
+        ti.freeze()
+        caches = []
+        start = threading.Event()
+
+        def first_touch():
+            start.wait()
+            caches.append(ti.get_cache('layout'))
+
+        threads = [threading.Thread(target=first_touch) for _ in range(8)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        self.assertTrue(all(c is caches[0] for c in caches))
+        layout = ti.get_layout(pt)
+
+        # redefinitions elsewhere leave the frozen caches alone
+        other = TargetInfo.get_host_target()
+        ots = other.typesystem
+        st = ots.get_struct('point', [('x', ots.get_int())])
+        before = other.get_layout(st)
+        ots.get_struct('point', [('x', ots.get_double())])
+        self.assertTrue(ti.get_cache('layout') is caches[0])
+        self.assertTrue(ti.get_layout(pt) is layout)
+        # but drop the caches of their own target
+        self.assertFalse(other.get_layout(st) is before)
+        self.assertEqual(other.get_sizeof(st), 64)
+
 if __name__ == '__main__':
     unittest.main()
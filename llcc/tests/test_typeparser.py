@@ -0,0 +1,87 @@
+from __future__ import print_function
+import unittest
+from llcc.target import TargetInfo
+
+class TestTypeParser(unittest.TestCase):
+    def setUp(self):
+        self.ti = TargetInfo.get_host_target()
+        self.ts = self.ti.typesystem
+
+    def test_scalars(self):
+        ts = self.ts
+        self.assertEqual(ts.parse('int32_t'), ts.get_int(32))
+        self.assertEqual(ts.parse('unsigned long'), ts.get_ulong())
+        self.assertEqual(ts.parse('long unsigned int'), ts.get_ulong())
+        self.assertEqual(ts.parse('long double'), ts.get_longdouble())
+        self.assertEqual(ts.parse('const char*'),
+                         ts.get_pointer(ts.get_char().with_const()))
+        self.assertEqual(ts.parse('char* const'),
+                         ts.get_pointer(ts.get_char()).with_const())
+        self.assertEqual(ts.parse('double[4]'),
+                         ts.get_array(ts.get_double(), 4))
+        self.assertEqual(ts.parse('<8 x float>'),
+                         ts.get_vector(ts.get_float(), 8))
+        self.assertEqual(ts.parse('double _Complex'),
+                         ts.get_complex(ts.get_double()))
+
+    def test_structs(self):
+        ts = self.ts
+        pair = ts.parse('struct{float;float}')
+        print(pair)
+        self.assertEqual(list(pair.type.fieldnames()), ['__0', '__1'])
+        self.assertEqual(pair.fingerprint,
+                         ts.get_unnamed_struct([ts.get_float(),
+                                                ts.get_float()]).fingerprint)
+        point = ts.parse('struct point {int x; int y; char tag[3]}')
+        self.assertTrue(point.type is ts.get_struct('point').type)
+        self.assertEqual(point.type['tag'], ts.get_array(ts.get_char(), 3))
+        self.assertTrue(ts.parse('struct point*').type.basetype.type
+                        is point.type)
+
+    def test_bitfields(self):
+        ts = self.ts
+        st = ts.parse('struct {unsigned a : 3; unsigned : 0; int b : 2}').type
+        print(st)
+        self.assertEqual(list(st.fieldnames()), ['a', '__1', 'b'])
+        self.assertEqual(st.bitwidths, {'a': 3, '__1': 0, 'b': 2})
+        self.assertEqual(st.unnamed_bitfields, frozenset(['__1']))
+        self.assertNotEqual(ts.parse('struct {unsigned a : 3}').fingerprint,
+                            ts.parse('struct {unsigned a : 4}').fingerprint)
+
+    def test_attributes(self):
+        ts = self.ts
+        st = ts.parse('struct __attribute__((packed)) hdr {char tag; '
+                      'alignas(2) short len; int crc __attribute__((aligned(8)))}'
+                      ' __attribute__((aligned(16)))').type
+        print(st)
+        self.assertTrue(st.packed)
+        self.assertEqual(st.align, 16)
+        self.assertEqual(st.field_aligns, {'len': 2, 'crc': 8})
+        self.assertNotEqual(st.fingerprint,
+                            ts.parse('struct {char tag; short len; '
+                                     'int crc}').fingerprint)
+        for text in ['struct __attribute__((packed)) hdr',
+                     'struct {int x __attribute__((packed))}',
+                     'struct {int x} __attribute__((hot))']:
+            self.assertRaises(ValueError, ts.parse, text)
+
+    def test_signatures(self):
+        ts = self.ts
+        fnty = ts.parse('void(int32_t, float*, struct{float;float})')
+        print(fnty)
+        self.assertTrue(fnty.type.is_function)
+        self.assertEqual(len(fnty.type.args), 3)
+        self.assertEqual(ts.parse('int(void)').type.args, ())
+        self.assertTrue(ts.parse('int(const char*, ...)').type.is_vararg)
+        # cached
+        self.assertTrue(fnty is ts.parse('void(int32_t, float*, '
+                                         'struct{float;float})'))
+        abi = self.ti.compute_abi_info('double(double, int)')
+        self.assertTrue(abi.return_info.is_direct)
+
+    def test_errors(self):
+        for text in ['', 'int(', 'struct', 'foo', 'int[x]', 'int int int']:
+            self.assertRaises(ValueError, self.ts.parse, text)
+
+if __name__ == '__main__':
+    unittest.main()
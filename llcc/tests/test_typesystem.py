@@ -1,4 +1,6 @@
 from __future__ import print_function
+import sys
+import threading
 import unittest
 from llcc.target import TargetInfo
 
@@ -76,5 +78,173 @@ class TestTypeSystem(unittest.TestCase):
         f1 = cts.get_function(cts.get_void(), [cts.get_int(), cts.get_ulong()])
         self.assertEqual('void(int32_t, uint64_t)', str(f1))
 
+    def test_struct_scopes(self):
+        ti = TargetInfo.get_host_target()
+        cts = ti.typesystem
+
+        outer = cts.get_struct('point', [('x', cts.get_int()),
+                                         ('y', cts.get_int())])
+        tu = cts.new_scope()
+        self.assertTrue(tu.get_struct('point').type is outer.type,
+                        "lookup falls back to parent scope")
+
+        inner = tu.get_struct('point', [('x', cts.get_float())])
+        print('inner =', inner)
+        self.assertFalse(inner.type is outer.type, "definition shadows")
+        self.assertTrue(cts.get_struct('point').type is outer.type,
+                        "parent scope is untouched")
+        self.assertEqual(len(outer.type), 2)
+
+        other = cts.new_scope()
+        self.assertTrue(other.get_struct('point').type is outer.type,
+                        "sibling scopes are independent")
+
+    def test_insert_many_structs(self):
+        ti = TargetInfo.get_host_target()
+        cts = ti.typesystem
+
+        names = [cts.insert_struct('anon').type.name for _ in range(1000)]
+        self.assertEqual(names[0], 'anon')
+        self.assertEqual(names[1], 'anon.0')
+        self.assertEqual(names[-1], 'anon.998')
+        self.assertEqual(len(set(names)), len(names))
+
+        # names taken by an enclosing scope are skipped
+        tu = cts.new_scope()
+        self.assertEqual(tu.insert_struct('anon').type.name, 'anon.999')
+
+        # a taken numbered name gets the next free number
+        self.assertEqual(cts.insert_struct('anon.3').type.name, 'anon.999')
+        self.assertEqual(cts.insert_struct('other.3').type.name, 'other.3')
+        self.assertEqual(cts.insert_struct('other.3').type.name, 'other.4')
+        self.assertEqual(cts.insert_struct('other').type.name, 'other')
+        self.assertEqual(cts.insert_struct('other').type.name, 'other.0')
+
+    def test_fingerprint(self):
+        ti = TargetInfo.get_host_target()
+        cts = ti.typesystem
+
+        fty = cts.get_float()
+        a = cts.get_unnamed_struct([('x', fty), ('y', fty)])
+        b = cts.get_unnamed_struct([('x', fty), ('y', fty)])
+        c = cts.get_unnamed_struct([('x', fty), ('y', cts.get_double())])
+        print('fingerprint a =', a.fingerprint)
+        self.assertEqual(len(a.fingerprint), 32, "128-bit hex digest")
+        self.assertEqual(a.fingerprint, b.fingerprint)
+        self.assertNotEqual(a.fingerprint, c.fingerprint)
+        self.assertNotEqual(fty.fingerprint, fty.with_const().fingerprint)
+
+        # self-referential through a pointer
+        node = cts.get_struct('node')
+        cts.get_struct('node', [('value', cts.get_int()),
+                                ('next', cts.get_pointer(node))])
+        self.assertEqual(len(node.fingerprint), 32)
+
+        # independent of the typesystem instance that built the type
+        other = TargetInfo.get_host_target().typesystem
+        onode = other.get_struct('node')
+        other.get_struct('node', [('value', other.get_int()),
+                                  ('next', other.get_pointer(onode))])
+        self.assertEqual(node.fingerprint, onode.fingerprint)
+
+        # function signatures
+        f1 = cts.get_function(cts.get_void(), [cts.get_int(), a])
+        f2 = cts.get_function(cts.get_void(), [cts.get_int(), a])
+        f3 = cts.get_function(cts.get_void(), [cts.get_int(), a], True)
+        self.assertEqual(f1, f2)
+        self.assertEqual(hash(f1), hash(f2))
+        self.assertNotEqual(f1, f3)
+        self.assertNotEqual(f1.fingerprint, f3.fingerprint)
+
+    def test_fingerprint_definition(self):
+        ti = TargetInfo.get_host_target()
+        cts = ti.typesystem
+
+        # incomplete, then defined
+        foo = cts.get_struct('foo')
+        fnty = cts.get_function(cts.get_void(), [foo])
+        incomplete = foo.fingerprint, fnty.fingerprint
+        cts.get_struct('foo', [('x', cts.get_int())])
+        self.assertNotEqual(foo.fingerprint, incomplete[0])
+        self.assertNotEqual(fnty.fingerprint, incomplete[1])
+
+        # same tag in sibling scopes
+        structs = []
+        for members in ([('x', cts.get_int())],
+                        [('x', cts.get_double()), ('y', cts.get_double())]):
+            tu = cts.new_scope()
+            st = tu.get_struct('bar')
+            st.fingerprint
+            structs.append(tu.get_struct('bar', members))
+        a, b = structs
+        self.assertNotEqual(a.fingerprint, b.fingerprint)
+        self.assertNotEqual(cts.get_pointer(a).fingerprint,
+                            cts.get_pointer(b).fingerprint)
+
+    def test_fingerprint_scope(self):
+        cts = TargetInfo.get_host_target().typesystem
+        other = TargetInfo.get_host_target().typesystem
+        ity = cts.get_int()
+        pair = cts.get_unnamed_struct([ity, ity])
+        arr = cts.get_array(pair, 4).with_const()
+        fingerprints = pair.fingerprint, arr.fingerprint
+        cached = pair.type._fingerprint, arr._fingerprint
+
+        # definitions elsewhere leave the fingerprints cached
+        other.get_struct('unrelated', [('x', other.get_int())])
+        cts.get_struct('sibling', [('x', ity)])
+        self.assertEqual((pair.fingerprint, arr.fingerprint), fingerprints)
+        self.assertTrue(pair.type._fingerprint is cached[0])
+        self.assertTrue(arr._fingerprint is cached[1])
+
+        # a struct inside a struct of the array still invalidates it
+        inner = cts.get_struct('inner')
+        outer = cts.get_array(cts.get_unnamed_struct([inner]), 2)
+        before = outer.fingerprint
+        cts.get_struct('inner', [('x', ity)])
+        self.assertNotEqual(outer.fingerprint, before)
+
+    def test_fingerprint_threads(self):
+        ti = TargetInfo.get_host_target()
+        cts = ti.typesystem
+        ity = cts.get_int()
+        leaf = cts.get_unnamed_struct([ity, cts.get_double()])
+        types = [cts.get_unnamed_struct([leaf] * (i + 1)) for i in range(200)]
+        ti.freeze()
+        start = threading.Event()
+        results = []
+        errors = []
+
+        def worker():
+            start.wait()
+            try:
+                results.append([ty.fingerprint for ty in types])
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        # interleave the threads often (python 3 only)
+        interval = getattr(sys, 'getswitchinterval', lambda: None)()
+        if interval is not None:
+            sys.setswitchinterval(1e-6)
+        try:
+            start.set()
+            for t in threads:
+                t.join()
+        finally:
+            if interval is not None:
+                sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(r == results[0] for r in results))
+
+    def test_fingerprint_contains_itself(self):
+        cts = TargetInfo.get_host_target().typesystem
+        st = cts.get_struct('self')
+        cts.get_struct('self', [('x', cts.get_array(st, 1))])
+        self.assertRaises(ValueError, lambda: st.fingerprint)
+
 if __name__ == '__main__':
     unittest.main()
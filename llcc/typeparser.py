@@ -0,0 +1,304 @@
+'''
+Compact notation for types and function signatures
+
+    int32_t
+    const char*
+    double[4]
+    <8 x float>
+    double _Complex
+    struct point                        (reference to a named struct)
+    struct point {float x; float y}     (definition)
+    struct flags {unsigned a : 3; unsigned : 0; unsigned b : 1}
+    struct __attribute__((packed)) hdr {char tag; int len}
+    struct line {alignas(64) char data[64]} __attribute__((aligned(64)))
+    struct {float; float}               (unnamed; fields are __0, __1, ...)
+    void(int32_t, float*, struct{float;float}, ...)
+
+Use `CTypeSystem.parse`, which caches the results.
+'''
+import re
+import llcc.typesystem
+
+#-------------------------------------------------------------------------------
+# Lexer
+#-------------------------------------------------------------------------------
+
+_token_regex = re.compile(r'\s*(?:(\.\.\.)|([A-Za-z_]\w*)|(\d+)|(\S))')
+
+_name_regex = re.compile(r'[A-Za-z_]\w*$')
+
+def is_name(tok):
+    return tok is not None and _name_regex.match(tok) is not None
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _token_regex.match(text, pos)
+        tokens.append(m.group(m.lastindex))
+        pos = m.end()
+    return tokens
+
+#-------------------------------------------------------------------------------
+# Parser
+#-------------------------------------------------------------------------------
+
+# C spelling of builtin types -> name in CTypeSystem.builtins
+# (words are sorted so that the order of specifiers does not matter)
+BUILTIN_NAMES = {
+    ('void',):                          'void_type',
+    ('_Bool',):                         'bool_type',
+    ('bool',):                          'bool_type',
+    ('char',):                          'char_type',
+    ('char', 'signed'):                 'char_type',
+    ('char', 'unsigned'):               'uchar_type',
+    ('short',):                         'short_type',
+    ('int', 'short'):                   'short_type',
+    ('short', 'unsigned'):              'ushort_type',
+    ('int', 'short', 'unsigned'):       'ushort_type',
+    ('int',):                           'int_type',
+    ('signed',):                        'int_type',
+    ('int', 'signed'):                  'int_type',
+    ('unsigned',):                      'uint_type',
+    ('int', 'unsigned'):                'uint_type',
+    ('long',):                          'long_type',
+    ('int', 'long'):                    'long_type',
+    ('long', 'unsigned'):               'ulong_type',
+    ('int', 'long', 'unsigned'):        'ulong_type',
+    ('long', 'long'):                   'longlong_type',
+    ('int', 'long', 'long'):            'longlong_type',
+    ('long', 'long', 'unsigned'):       'ulonglong_type',
+    ('int', 'long', 'long', 'unsigned'): 'ulonglong_type',
+    ('float',):                         'float_type',
+    ('double',):                        'double_type',
+    ('double', 'long'):                 'longdouble_type',
+    ('intptr_t',):                      'intptr_type',
+}
+
+for _bits in (8, 16, 32, 64):
+    BUILTIN_NAMES[('int%d_t' % _bits,)] = 'int%d_type' % _bits
+    BUILTIN_NAMES[('uint%d_t' % _bits,)] = 'uint%d_type' % _bits
+
+SPECIFIERS = frozenset(w for words in BUILTIN_NAMES for w in words)
+
+ALIGNAS = frozenset(['alignas', '_Alignas'])
+
+QUALIFIERS = {
+    'const':    'with_const',
+    'volatile': 'with_volatile',
+    'restrict': 'with_restrict',
+}
+
+class TypeParser(object):
+    '''Recursive descent parser building types with a CTypeSystem.
+
+        signature   := type '(' [params] ')'
+        params      := 'void' | param (',' param)* [',' '...'] | '...'
+        type        := qualifier* base qualifier* suffix*
+        base        := specifier+ ['_Complex'] | '_Complex' specifier+
+                     | 'struct' attrs [name] ['{' member* '}' attrs]
+                     | '<' count 'x' type '>'
+        member      := [alignas '(' count ')'] type
+                       [name ('[' count ']')*] [':' count] attrs ';'
+        suffix      := '*' qualifier* | '[' count ']'
+        attrs       := ('__attribute__' '((' attr (',' attr)* '))')*
+        attr        := 'packed' | 'aligned' '(' count ')'
+    '''
+    def __init__(self, typesystem, text):
+        self.ts = typesystem
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def parse(self):
+        ty = self.parse_type()
+        if self.peek() == '(':
+            ty = self.parse_signature(ty)
+        if self.peek() is not None:
+            self.error("unexpected %r" % self.peek())
+        return ty
+
+    # helpers
+
+    def error(self, msg):
+        raise ValueError("%s in type %r" % (msg, self.text))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+
+    def next(self):
+        tok = self.peek()
+        if tok is None:
+            self.error("unexpected end")
+        self.pos += 1
+        return tok
+
+    def accept(self, tok):
+        if self.peek() == tok:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, tok):
+        if not self.accept(tok):
+            self.error("expecting %r" % tok)
+
+    def parse_count(self):
+        tok = self.next()
+        if not tok.isdigit():
+            self.error("expecting a number")
+        return int(tok)
+
+    # grammar
+
+    def parse_signature(self, ret):
+        self.expect('(')
+        args = []
+        vararg = False
+        if self.tokens[self.pos:self.pos + 2] == ['void', ')']:
+            self.next()
+        elif self.peek() != ')':
+            while True:
+                if self.accept('...'):
+                    vararg = True
+                    break
+                args.append(self.parse_type())
+                if not self.accept(','):
+                    break
+        self.expect(')')
+        return self.ts.get_function(ret, args, vararg)
+
+    def parse_type(self):
+        quals = self.parse_qualifiers()
+        ty = self.parse_base()
+        quals += self.parse_qualifiers()
+        ty = self.qualify(ty, quals)
+        while True:
+            if self.accept('*'):
+                ty = self.qualify(self.ts.get_pointer(ty),
+                                  self.parse_qualifiers())
+            elif self.accept('['):
+                ty = self.ts.get_array(ty, self.parse_count())
+                self.expect(']')
+            else:
+                return ty
+
+    def parse_qualifiers(self):
+        quals = []
+        while self.peek() in QUALIFIERS:
+            quals.append(self.next())
+        return quals
+
+    def qualify(self, ty, quals):
+        for q in quals:
+            ty = getattr(ty, QUALIFIERS[q])()
+        return ty
+
+    def parse_base(self):
+        tok = self.peek()
+        if tok == 'struct':
+            return self.parse_struct()
+        elif tok == '<':
+            self.next()
+            count = self.parse_count()
+            self.expect('x')
+            elem = self.parse_type()
+            self.expect('>')
+            return self.ts.get_vector(elem, count)
+
+        words = []
+        complex_ = False
+        while self.peek() in SPECIFIERS or self.peek() == '_Complex':
+            tok = self.next()
+            if tok == '_Complex':
+                complex_ = True
+            else:
+                words.append(tok)
+        if not words:
+            self.error("expecting a type at %r" % self.peek())
+        try:
+            name = BUILTIN_NAMES[tuple(sorted(words))]
+        except KeyError:
+            self.error("unknown type %r" % ' '.join(words))
+        ty = self.ts.builtins[name]
+        if complex_:
+            return self.ts.get_complex(ty)
+        return llcc.typesystem.QualType(ty)
+
+    def parse_struct(self):
+        self.expect('struct')
+        attrs = self.parse_attributes()
+        name = None
+        if is_name(self.peek()):
+            name = self.next()
+        if not self.accept('{'):
+            if name is None:
+                self.error("expecting a struct name or body")
+            if attrs:
+                self.error("attributes of a struct reference")
+            return self.ts.get_struct(name)
+        members = []
+        field_aligns = {}
+        while not self.accept('}'):
+            align = None
+            if self.peek() in ALIGNAS:
+                self.next()
+                self.expect('(')
+                align = self.parse_count()
+                self.expect(')')
+            fty = self.parse_type()
+            fname = None
+            if is_name(self.peek()) and self.peek() != '__attribute__':
+                fname = self.next()
+                # C-style array declarator
+                while self.accept('['):
+                    fty = self.ts.get_array(fty, self.parse_count())
+                    self.expect(']')
+            if self.accept(':'):
+                members.append((fname or '', fty, self.parse_count()))
+            elif fname is not None:
+                members.append((fname, fty))
+            else:
+                members.append(fty)
+            fattrs = self.parse_attributes()
+            if 'packed' in fattrs:
+                self.error("packed fields are not supported")
+            if 'align' in fattrs:
+                align = max(align or 0, fattrs['align'])
+            if align is not None:
+                field_aligns[fname or '__%d' % (len(members) - 1)] = align
+            if not self.accept(';'):
+                self.expect('}')
+                break
+        attrs.update(self.parse_attributes())
+        if field_aligns:
+            attrs['field_aligns'] = field_aligns
+        if name is None:
+            return self.ts.get_unnamed_struct(members, **attrs)
+        return self.ts.get_struct(name, members, **attrs)
+
+    def parse_attributes(self):
+        '''Returns the GCC attributes as keywords of `CStructType.define`.
+        '''
+        attrs = {}
+        while self.accept('__attribute__'):
+            self.expect('(')
+            self.expect('(')
+            while True:
+                tok = self.next()
+                if tok == 'packed':
+                    attrs['packed'] = True
+                elif tok == 'aligned':
+                    self.expect('(')
+                    attrs['align'] = max(attrs.get('align', 0),
+                                         self.parse_count())
+                    self.expect(')')
+                else:
+                    self.error("unknown attribute %r" % tok)
+                if not self.accept(','):
+                    break
+            self.expect(')')
+            self.expect(')')
+        return attrs
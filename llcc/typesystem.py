@@ -1,6 +1,52 @@
 import weakref
 import ctypes
-from llcc import adt, support
+import hashlib
+from llcc import adt, support, typeparser
+
+#-------------------------------------------------------------------------------
+# Fingerprints
+#-------------------------------------------------------------------------------
+
+def digest(text):
+    '''128-bit hex digest of a canonical type description.
+    '''
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+def is_current(deps):
+    '''Whether none of the struct definitions in `deps`, pairs of a struct
+    and its `version`, changed since.
+    '''
+    for st, version in deps:
+        if st.version != version:
+            return False
+    return True
+
+class Fingerprinter(object):
+    '''Fingerprints the types nested in one canonical() description and
+    collects the struct definitions they depend on.
+
+    The structs being described are tracked per call, not on the structs,
+    so types can be fingerprinted from several threads at once.
+    '''
+    def __init__(self, visiting=frozenset(), deps=None):
+        self.visiting = visiting
+        self.deps = {} if deps is None else deps
+
+    def __call__(self, ty):
+        fingerprint, deps = ty.get_fingerprint(self.visiting)
+        self.deps.update(deps)
+        if isinstance(ty, QualType):
+            ty = ty.type
+        if ty.is_struct:
+            self.deps[ty] = ty.version
+        return fingerprint
+
+    def enter(self, st):
+        '''Returns the Fingerprinter for the members of struct `st`.
+        '''
+        if st in self.visiting:
+            raise ValueError("struct contains itself: %s" % st.name)
+        return Fingerprinter(self.visiting | frozenset([st]), self.deps)
 
 #-------------------------------------------------------------------------------
 # Types
@@ -15,6 +61,12 @@ class CType(object):
     is_struct = False
     is_pointer = False
     is_function = False
+    is_complex = False
+
+    # Bumped by structs whenever they are defined or undefined, so that
+    # fingerprints embedding them can tell they are stale.
+    version = 0
+    _fingerprint = None     # (digest, version, dependencies)
 
     def __repr__(self):
         return '<%s %s>' % (type(self).__name__, self.describe())
@@ -22,6 +74,38 @@ class CType(object):
     def describe(self):
         return '"please override"'
 
+    @property
+    def fingerprint(self):
+        '''A stable structural digest of the type.
+
+        It only depends on the structure of the type, so it is the same in
+        every process and can key persisted results.  Computed once; it is
+        recomputed only after a struct it embeds is defined or undefined.
+        '''
+        return self.get_fingerprint()[0]
+
+    def get_fingerprint(self, visiting=frozenset()):
+        '''Returns the fingerprint and the nested struct definitions it
+        depends on, as ``(struct, version)`` pairs.  The type itself is left
+        out, so that a struct does not keep a reference to itself.
+        '''
+        cached = self._fingerprint
+        if (cached is None or cached[1] != self.version or
+                not is_current(cached[2])):
+            fingerprinter = Fingerprinter(visiting)
+            text = self.canonical(fingerprinter)
+            cached = (digest(text), self.version,
+                      tuple(fingerprinter.deps.items()))
+            self._fingerprint = cached
+        return cached[0], cached[2]
+
+    def canonical(self, fingerprint):
+        '''Canonical text the fingerprint is computed from.
+        Nested types appear as their own fingerprints, given by the
+        `fingerprint` callable.
+        '''
+        raise NotImplementedError
+
 class CScalarType(CType):
     is_scalar = True
     is_integer = False
@@ -47,6 +131,10 @@ class CIntegerType(CScalarType):
         self.bitwidth = bitwidth
         self.is_promotable = promotable
 
+    def canonical(self, fingerprint):
+        sign = 'i' if self.is_signed else 'u'
+        return '%s%d:%s' % (sign, self.bitwidth, self.name)
+
 
 class CSignedType(CIntegerType):
     is_signed = True
@@ -57,6 +145,9 @@ class CUnsignedType(CIntegerType):
 class CFloatType(CScalarType):
     is_float = True
 
+    def canonical(self, fingerprint):
+        return 'f:%s' % self.name
+
 class CVoidType(CType):
     is_void = True
 
@@ -69,6 +160,9 @@ class CVoidType(CType):
     def describe(self):
         return ''
 
+    def canonical(self, fingerprint):
+        return 'v'
+
 class CPointerType(CType):
     is_pointer = True
 
@@ -83,7 +177,7 @@ class CPointerType(CType):
         return not (self == other)
 
     def __hash__(self):
-        return hash(self.basetype)
+        return hash(self.fingerprint)
 
     def __str__(self):
         return '%s*' % self.basetype
@@ -91,6 +185,14 @@ class CPointerType(CType):
     def describe(self):
         return str(self.basetype)
 
+    def canonical(self, fingerprint):
+        base = self.basetype
+        if base.type.is_struct and base.type.name:
+            # Refer to named structs by tag, as C does.  This keeps
+            # self-referential structs finite.
+            return 'P%sT%s' % (base.qualifier_code(), base.type.tag)
+        return 'P%s' % fingerprint(base)
+
 class CAggregateType(CType):
     is_aggregate = True
 
@@ -98,18 +200,20 @@ class CAggregateType(CType):
         '''
         :param offset: byte offset
         '''
-        offset = offset * 8
         if isinstance(ty, QualType):
             ty = ty.type
-        off = 0
-        for qualtype in self:
-            t = qualtype.type
-            if off > offset:
-                break
-            elif off == offset:
-                return ty == t
-            off += target.get_sizeof(t)
-        return False
+        # look through nested aggregates
+        return target.get_leaf_index(self).type_at(offset) == ty
+
+    def get_field_at_offset(self, offset, target):
+        '''
+        :param offset: byte offset
+        '''
+        offsets = target.get_field_offsets(self)
+        for off, fty in zip(offsets, self):
+            if offset * 8 == off:
+                return fty
+        raise ValueError(offset)
 
 class CHomoType(CAggregateType):
 
@@ -126,7 +230,10 @@ class CHomoType(CAggregateType):
         return not (self == other)
 
     def __hash__(self):
-        return hash((self.basetype, self.size))
+        return hash(self.fingerprint)
+
+    def canonical(self, fingerprint):
+        return '%s%d:%s' % (self.tag, self.size, fingerprint(self.basetype))
 
     def __len__(self):
         return self.size
@@ -143,6 +250,7 @@ class CHomoType(CAggregateType):
 
 class CArrayType(CHomoType):
     is_array = True
+    tag = 'A'
     
     def __str__(self):
         return '%s[%d]' % (self.basetype, self.size)
@@ -152,6 +260,7 @@ class CArrayType(CHomoType):
 
 class CVectorType(CHomoType):
     is_vector = True
+    tag = 'V'
     
     def __str__(self):
         return '<%s x %d>' % (self.basetype, self.size)
@@ -159,27 +268,142 @@ class CVectorType(CHomoType):
     def describe(self):
         return '<%s x %d>' % (self.basetype, self.size)
 
+class CComplexType(CHomoType):
+    '''C99 `_Complex` of a floating or integer type.  Laid out as an array
+    of its real and imaginary parts.
+    '''
+    is_complex = True
+    tag = 'C'
+
+    def __init__(self, basetype):
+        super(CComplexType, self).__init__(basetype, 2)
+
+    def __str__(self):
+        return '%s _Complex' % self.basetype
+
+    def describe(self):
+        return '%s _Complex' % self.basetype
+
+class DefinitionEpoch(object):
+    '''Number of struct definition changes in a tree of typesystem scopes.
+    Caches derived from its structs are stale once it moves.
+    '''
+    __slots__ = 'value',
+
+    def __init__(self):
+        self.value = 0
+
+    def bump(self):
+        self.value += 1
+
+# epoch of structs created outside of a typesystem
+UNOWNED_EPOCH = DefinitionEpoch()
+
 class CStructType(CAggregateType):
     is_struct = True
+    is_frozen = False
 
-    def __init__(self, name=''):
+    def __init__(self, name='', scope='', epoch=UNOWNED_EPOCH):
         self.name = name
+        self.scope = scope          # id of the typesystem scope of the tag
+        self.epoch = epoch          # DefinitionEpoch of the typesystem
         self.members = None
+        self.bitwidths = {}         # bit-field name -> width in bits
+        self.unnamed_bitfields = frozenset()
+        self.packed = False
+        self.align = None           # alignment override in bytes
+        self.field_aligns = {}      # field name -> alignment in bytes
+
+    def freeze(self):
+        self.is_frozen = True
+
+    def _check_mutable(self):
+        if self.is_frozen:
+            raise TypeError("cannot modify frozen %s" % self)
+
+    def _bump_epoch(self):
+        self.version += 1
+        # a struct that was never fingerprinted nor defined is in no cache
+        if self.members is not None or self._fingerprint is not None:
+            self.epoch.bump()
+
+    @property
+    def tag(self):
+        '''The name qualified by the scope it is declared in.
+        '''
+        return self.scope + self.name
 
-    def define(self, members):
-        cvtmm = [self._expand_member_desc(mm, i)
-                 for i, mm in enumerate(members)]
+    def define(self, members, packed=False, align=None, field_aligns=None):
+        '''Each member is a type, a ``(name, type)`` pair or a bit-field
+        ``(name, type, width)``.  Unnamed bit-fields (with an empty name)
+        only affect the layout; a zero width one must be unnamed.
+
+        Attributes follow GCC: `packed` drops the natural alignment of the
+        fields, `align` (in bytes) raises the alignment of the struct and
+        `field_aligns` maps field names to their minimum alignment in bytes
+        (`aligned(N)` or `alignas(N)`).
+        '''
+        self._check_mutable()
+        field_aligns = dict(field_aligns or {})
+        for value in [align] + list(field_aligns.values()):
+            if value is not None and (value <= 0 or value & (value - 1)):
+                raise ValueError("alignment %r is not a power of two"
+                                 % (value,))
+        cvtmm = []
+        bitwidths = {}
+        unnamed = []
+        for i, mm in enumerate(members):
+            name, ty, width = self._expand_member_desc(mm, i)
+            if width is not None:
+                self._check_bitfield(name, ty, width)
+                if not name:
+                    name = '__%d' % i
+                    unnamed.append(name)
+                bitwidths[name] = width
+            cvtmm.append((name, ty))
+        self._bump_epoch()
         self.members = adt.OrderedAttrs(cvtmm)
+        for name in field_aligns:
+            if name not in self.members:
+                raise NameError(name)
+        self.bitwidths = bitwidths
+        self.unnamed_bitfields = frozenset(unnamed)
+        self.packed = bool(packed)
+        self.align = align
+        self.field_aligns = field_aligns
         return self
 
     def _expand_member_desc(self, desc, count):
+        if isinstance(desc, (tuple, list)) and len(desc) == 3:
+            k, v, width = desc
+            return k, QualType(v), width
         if isinstance(desc, (tuple, list)) and len(desc) == 2:
             k, v = desc
-            return k, QualType(v)
-        return '__%d' % count, QualType(desc)
+            return k, QualType(v), None
+        return '__%d' % count, QualType(desc), None
+
+    def _check_bitfield(self, name, ty, width):
+        if not (ty.type.is_scalar and ty.type.is_integer):
+            raise TypeError("bit-field %s has non-integral type %s"
+                            % (name, ty))
+        if width < 0 or width > ty.type.bitwidth:
+            raise ValueError("invalid width %d of bit-field %s"
+                             % (width, name))
+        if width == 0 and name:
+            raise ValueError("zero-width bit-field %s must be unnamed" % name)
+
+    def is_bitfield(self, name):
+        return name in self.bitwidths
 
     def undefine(self):
+        self._check_mutable()
+        self._bump_epoch()
         self.members = None
+        self.bitwidths = {}
+        self.unnamed_bitfields = frozenset()
+        self.packed = False
+        self.align = None
+        self.field_aligns = {}
 
     @property
     def is_defined(self):
@@ -202,6 +426,9 @@ class CStructType(CAggregateType):
 
     def __str__(self):
         head = 'struct %s' % self.name
+        attrs = self.describe_attributes()
+        if attrs:
+            head = 'struct __attribute__((%s)) %s' % (attrs, self.name)
         if self.members is None:
             return head
         else:
@@ -211,37 +438,64 @@ class CStructType(CAggregateType):
         return self.members[i]
 
     def describe_members(self):
-        mms = ['%s %s' % (self.members[name], name) for name in self.members]
+        mms = []
+        for name in self.members:
+            mm = '%s %s' % (self.members[name], name)
+            if name in self.bitwidths:
+                mm += ' : %d' % self.bitwidths[name]
+            if name in self.field_aligns:
+                mm += ' aligned(%d)' % self.field_aligns[name]
+            mms.append(mm)
         return '; '.join(mms)
 
+    def describe_attributes(self):
+        attrs = []
+        if self.packed:
+            attrs.append('packed')
+        if self.align is not None:
+            attrs.append('aligned(%d)' % self.align)
+        return ', '.join(attrs)
+
     def describe(self):
         return '%s %s' % (self.name, self.describe_members())
 
     def layout_equal(self, other):
-        return all(self.members[a] == other.members[b]
-                   for a, b in zip(self.members, other.members))
+        if self.fingerprint == other.fingerprint:
+            return True
+        return (len(self) == len(other) and
+                self.packed == other.packed and
+                self.align == other.align and
+                all(self.members[a] == other.members[b] and
+                    self.bitwidths.get(a) == other.bitwidths.get(b) and
+                    self.field_aligns.get(a) == other.field_aligns.get(b)
+                    for a, b in zip(self.members, other.members)))
+
+    def canonical(self, fingerprint):
+        if self.members is None:
+            return 'T%s?' % self.tag
+        fingerprint = fingerprint.enter(self)
+        mms = []
+        for name in self.members:
+            mm = '%s:%s' % (name, fingerprint(self.members[name]))
+            if name in self.bitwidths:
+                mm += ':%d' % self.bitwidths[name]
+            if name in self.field_aligns:
+                mm += '@%d' % self.field_aligns[name]
+            mms.append(mm)
+        attrs = ''
+        if self.packed:
+            attrs += 'p'
+        if self.align is not None:
+            attrs += '@%d' % self.align
+        return 'T%s%s{%s}' % (self.tag, attrs, ','.join(mms))
 
     def get_field_offset(self, name, target):
         '''Returns byte offset to a field
         '''
-        fieldty = self.members[str(name)]
-        offset = 0
-        for fname, fty in self.fields():
-            if fname == name:
-                return offset // 8
-            else:
-                sz = target.get_sizeof(fty)
-                offset += sz
-        raise NameError(name)
-
-    def get_field_at_offset(self, offset, target):
-        off = 0
-        for fty in self.fieldtypes():
-            if offset * 8 == off:
-                return fty
-            else:
-                off += target.get_sizeof(fty)
-        raise ValueError(offset)
+        try:
+            return target.get_layout(self).offset_of(name) // 8
+        except KeyError:
+            raise NameError(name)
 
 class CFunctionType(CType):
     is_function = True
@@ -252,16 +506,25 @@ class CFunctionType(CType):
         self.is_vararg = is_vararg
 
     def __eq__(self, other):
-        if isinstance(other, CFunctionType):
-            return (self.return_type == other.return_type and
-                    all(a == b for a, b in zip(self.args, other.args)) and
-                    self.is_vararg  and other.is_vararg)
+        if not isinstance(other, CFunctionType):
+            return False
+        if self.fingerprint != other.fingerprint:
+            return False
+        return (self.return_type == other.return_type and
+                self.args == other.args and
+                self.is_vararg == other.is_vararg)
 
     def __ne__(self, other):
         return not (self == other)
 
     def __hash__(self):
-        return hash((self.return_type, self.args, self.is_vararg))
+        return hash(self.fingerprint)
+
+    def canonical(self, fingerprint):
+        args = [fingerprint(a) for a in self.args]
+        if self.is_vararg:
+            args.append('...')
+        return 'F%s(%s)' % (fingerprint(self.return_type), ','.join(args))
 
     def describe(self):
         args = [str(a) for a in self.args]
@@ -277,10 +540,54 @@ class CFunctionType(CType):
 #-------------------------------------------------------------------------------
 
 class CTypeSystem(object):
-    def __init__(self):
-        self.builtins = adt.AttrDict()
-        self.userstructs = adt.AttrDict()
-        self.cmappings = {}
+    '''
+    A typesystem created with a `parent` is a nested scope (e.g. one per
+    translation unit).  It shares the builtins of its parent and has its
+    own struct namespace that falls back to the parent for lookups.
+    Scopes are numbered in creation order under their parent; the number
+    qualifies the tags of their structs in fingerprints.
+    '''
+    PARSE_CACHE_SIZE = 4096
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.nscopes = 0
+        if parent is None:
+            self.scope = ''
+            self.epoch = DefinitionEpoch()
+            self.builtins = adt.AttrDict()
+            self.userstructs = adt.ChainAttrDict()
+            self.cmappings = {}
+        else:
+            parent.nscopes += 1
+            self.scope = '%s%d/' % (parent.scope, parent.nscopes)
+            self.epoch = parent.epoch
+            self.builtins = parent.builtins
+            self.userstructs = parent.userstructs.new_child()
+            self.cmappings = parent.cmappings
+        self.namer = support.UniqueNamer()
+        self.parse_cache = adt.LRUDict(self.PARSE_CACHE_SIZE)
+
+    def new_scope(self):
+        '''Returns a child typesystem with a nested struct namespace.
+        '''
+        return type(self)(parent=self)
+
+    @property
+    def is_frozen(self):
+        return self.userstructs.is_frozen
+
+    def freeze(self):
+        '''Make the typesystem immutable so it can be shared between threads.
+
+        Enclosing scopes are frozen too since lookups read through them.
+        '''
+        if self.parent is not None:
+            self.parent.freeze()
+        self.builtins.freeze()
+        self.userstructs.freeze()
+        for name in self.userstructs:
+            self.userstructs[name].freeze()
 
     def load_sys_independ_builtins(self):
         # specials
@@ -366,6 +673,20 @@ class CTypeSystem(object):
 
         self.init_type_mapping(cmap)
 
+    def parse(self, text):
+        '''Returns the type described by `text` in the notation of
+        `llcc.typeparser`, e.g. ``"void(int32_t, float*, struct{float;float})"``.
+
+        Results are cached by text; parsing the same string again returns
+        the same type objects.
+        '''
+        try:
+            return self.parse_cache[text]
+        except KeyError:
+            ty = self.parse_cache[text] = typeparser.TypeParser(self,
+                                                                text).parse()
+            return ty
+
     def get_function(self, ret, args, vararg=False):
         return QualType(CFunctionType(ret, args, vararg))
 
@@ -429,33 +750,46 @@ class CTypeSystem(object):
     def get_vector(self, ty, ct):
         return QualType(CVectorType(ty, ct))
 
-    def get_struct(self, name, members=None):
+    def get_complex(self, ty):
+        return QualType(CComplexType(ty))
+
+    def get_struct(self, name, members=None, **attrs):
         '''
         if members is None then creates a incomplete structure type.
         else creats a structure type with the given members.
-        '''
-        if name not in self.userstructs:
-            st = self.userstructs[name] = CStructType(name)
-        else:
-            st = self.userstructs[name]
+        `attrs` are the layout attributes of `CStructType.define`.
 
+        Like a C tag declaration, a definition always binds in the current
+        scope; a reference resolves through the enclosing scopes.
+        '''
+        if members is None:
+            if name in self.userstructs:
+                return QualType(self.userstructs[name])
+        elif self.userstructs.is_local(name):
+            return QualType(self.userstructs[name].define(members, **attrs))
+
+        st = self.userstructs[name] = CStructType(name, self.scope,
+                                                  self.epoch)
         if members is not None:
-            st.define(members)
-
+            st.define(members, **attrs)
         return QualType(st)
 
-    def insert_struct(self, name, members=None):
+    def insert_struct(self, name, members=None, **attrs):
         '''
         Rename until a unique name is available.
         '''
-        name = support.rename_until(name, lambda x: x not in self.userstructs)
-        st = self.userstructs[name] = CStructType(name)
+        if self.is_frozen:
+            raise TypeError("cannot insert struct into a frozen typesystem")
+        name = self.namer.rename(name, lambda x: x not in self.userstructs)
+        st = self.userstructs[name] = CStructType(name, self.scope,
+                                                  self.epoch)
         if members is not None:
-            st.define(members)
+            st.define(members, **attrs)
         return QualType(st)
 
-    def get_unnamed_struct(self, members):
-        return QualType(CStructType().define(members))
+    def get_unnamed_struct(self, members, **attrs):
+        return QualType(CStructType(epoch=self.epoch).define(members,
+                                                              **attrs))
 
     def get_pointer(self, ty):
         return QualType(CPointerType(ty))
@@ -498,7 +832,32 @@ class QualType(object):
         return not (self == other)
 
     def __hash__(self):
-        return hash((self.type, self.qualifiers))
+        return hash(self.fingerprint)
+
+    @property
+    def fingerprint(self):
+        '''Fingerprint of the type with its qualifiers.
+        Unqualified types share the fingerprint of the underlying type.
+        '''
+        return self.get_fingerprint()[0]
+
+    _fingerprint = None     # (qualifier code, digest, dependencies)
+
+    def get_fingerprint(self, visiting=frozenset()):
+        if not self.qualifiers:
+            return self.type.get_fingerprint(visiting)
+        code = self.qualifier_code()
+        cached = self._fingerprint
+        if cached is None or cached[0] != code or not is_current(cached[2]):
+            fingerprint, deps = self.type.get_fingerprint(visiting)
+            if self.type.is_struct:
+                deps += ((self.type, self.type.version),)
+            cached = code, digest('Q%s:%s' % (code, fingerprint)), deps
+            self._fingerprint = cached
+        return cached[1:]
+
+    def qualifier_code(self):
+        return ''.join(q[0] for q in self.qualifiers)
 
     def __repr__(self):
         return '<QualType %s>' % self